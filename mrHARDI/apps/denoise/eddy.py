@@ -5,14 +5,15 @@ import nibabel as nib
 import numpy as np
 from GPUtil import GPUtil
 from traitlets import Dict, Instance, Unicode, Bool, Enum
-from traitlets.config.loader import ArgumentError, ConfigError
+from traitlets.config.loader import ArgumentError
 
 from mrHARDI.base.application import (mrHARDIBaseApplication,
                                            output_prefix_argument,
                                            input_dwi_prefix)
 
-from mrHARDI.base.fsl import prepare_acqp_file, prepare_topup_index
+from mrHARDI.base.fsl import prepare_eddy_acquisition
 from mrHARDI.base.dwi import load_metadata, save_metadata, non_zero_bvecs
+from mrHARDI.base.io import load_text
 from mrHARDI.base.scripting import build_script
 from mrHARDI.config.eddy import EddyConfiguration
 
@@ -123,11 +124,11 @@ class Eddy(mrHARDIBaseApplication):
         super()._validate_required()
 
     def execute(self):
-        bvals = np.loadtxt("{}.bval".format(self.image), ndmin=1)
+        bvals = load_text("{}.bval".format(self.image), ndmin=1)
         non_zero_bvecs(self.image)
         metadata = load_metadata(self.image)
         if self.rev_image:
-            rev_bvals = np.loadtxt("{}.bval".format(self.rev_image), ndmin=1)
+            rev_bvals = load_text("{}.bval".format(self.rev_image), ndmin=1)
 
             if exists("{}.bvec".format(self.rev_image)):
                 non_zero_bvecs(self.rev_image)
@@ -142,16 +143,8 @@ class Eddy(mrHARDIBaseApplication):
         else:
             rev_bvals = np.array([])
 
-        if not self.acquisition_file:
-            acqp = prepare_acqp_file(
-                metadata.readout, metadata.directions
-            )
-
-            with open("{}_acqp.txt".format(self.output_prefix), 'w+') as f:
-                f.write(acqp)
-
-            acqp = acqp.split("\n")
-        else:
+        acqp = None
+        if self.acquisition_file:
             acqp = []
             with open(self.acquisition_file) as f:
                 acqp.extend(f.readlines())
@@ -161,42 +154,24 @@ class Eddy(mrHARDIBaseApplication):
         if self.eddy_on_rev:
             bvals = np.concatenate((bvals, rev_bvals))
 
-        indexes = prepare_topup_index(
-            bvals, 1, strategy=self.indexing_strategy,
+        acqp_lines, indexes, slspec = prepare_eddy_acquisition(
+            bvals, metadata, metadata.dataset_indexes, acqp,
+            strategy=self.indexing_strategy,
             ceil=self.configuration.ceil_value, **kwargs
         )
 
-        if indexes.max() > len(acqp):
-            if len(acqp) == 1:
-                indexes[:] = 1
-            else:
-                dataset_indexes = metadata.dataset_indexes[1:] + [len(bvals)]
-                if not len(acqp) == len(dataset_indexes):
-                    raise ConfigError(
-                        "No matching configuration found for index "
-                        "(maxing at {}) "
-                        "and acqp file (containing {} lines)\n{}".format(
-                            indexes.max(), len(acqp), "\n".join(acqp)
-                        )
-                    )
-
-                indexes[:dataset_indexes[0]] = 1
-                for i, idx in enumerate(dataset_indexes[1:]):
-                    indexes[dataset_indexes[i]:idx] = i + 2
+        if not self.acquisition_file:
+            with open("{}_acqp.txt".format(self.output_prefix), 'w+') as f:
+                f.write("\n".join(acqp_lines))
 
         with open(
             "{}_index.txt".format(self.output_prefix), "w+"
         ) as f:
             f.write(" ".join([str(i) for i in indexes]) + "\n")
 
-        if self.configuration.enable_cuda:
-            lines = [
-                " ".join(["{:d}".format(mm) for mm in m]) + "\n"
-                for m in metadata.slice_order
-            ]
-
+        if self.configuration.enable_cuda and slspec is not None:
             with open("{}_slspec.txt".format(self.output_prefix), "w+") as f:
-                f.writelines(lines)
+                f.write(slspec)
 
         with open(
             "{}_script.sh".format(self.output_prefix), "w+"
@@ -241,8 +216,8 @@ class Eddy(mrHARDIBaseApplication):
                 debug_args += " ".join("--{}=True".format(d) for d in dargs)
 
             if self.eddy_on_rev:
-                bvals = np.loadtxt("{}.bval".format(self.image), ndmin=1)
-                rev_bvals = np.loadtxt(
+                bvals = load_text("{}.bval".format(self.image), ndmin=1)
+                rev_bvals = load_text(
                     "{}.bval".format(self.rev_image), ndmin=1
                 )
                 if (
@@ -250,10 +225,10 @@ class Eddy(mrHARDIBaseApplication):
                     np.allclose(bvals, rev_bvals)
                 ):
                     if exists("{}.bvec".format(self.rev_image)):
-                        bvecs = np.loadtxt(
+                        bvecs = load_text(
                             "{}.bvec".format(self.image), ndmin=2
                         )
-                        rev_bvecs = np.loadtxt(
+                        rev_bvecs = load_text(
                             "{}.bvec".format(self.rev_image), ndmin=2
                         )
 
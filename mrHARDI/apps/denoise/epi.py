@@ -11,8 +11,9 @@ from mrHARDI.base.application import (mrHARDIBaseApplication,
                                            MultipleArguments,
                                            output_prefix_argument,
                                            required_arg, required_file)
-from mrHARDI.base.fsl import prepare_acqp_file, prepare_topup_index
+from mrHARDI.base.fsl import prepare_eddy_acquisition
 from mrHARDI.base.dwi import load_metadata, save_metadata
+from mrHARDI.base.io import load_text
 from mrHARDI.base.shell import launch_shell_process
 from mrHARDI.config.epi import (TopupConfiguration,
                                 BlockMatchingEPIConfiguration)
@@ -98,39 +99,20 @@ class BaseEpiCorrectionApplication(mrHARDIBaseApplication):
     flags = Dict(default_value=_flags)
 
     def _generate_index_acqp(self, metadata):
-        acqp = prepare_acqp_file(
-            metadata.readout, metadata.directions
-        )
-
         kwargs = dict(b0_comp=np.less) if self.configuration.strict else dict()
 
-        bvals = [np.loadtxt(bvs, ndmin=1) for bvs in self.bvals]
-        rev_bvals = [np.loadtxt(bvs, ndmin=1) for bvs in self.rev_bvals]
+        bvals = [load_text(bvs, ndmin=1) for bvs in self.bvals]
+        rev_bvals = [load_text(bvs, ndmin=1) for bvs in self.rev_bvals]
         if rev_bvals:
             bvals = [bv for bv in bvals + rev_bvals]
 
-        indexes = prepare_topup_index(
-            np.concatenate(bvals), 1, strategy=self.indexing_strategy,
+        acqp, indexes, _ = prepare_eddy_acquisition(
+            np.concatenate(bvals), metadata,
+            np.cumsum([0] + [len(bv) for bv in bvals[:-1]]),
+            strategy=self.indexing_strategy,
             ceil=self.configuration.ceil_value, **kwargs
         )
-
-        if indexes.max() > len(acqp.split("\n")):
-            if len(acqp.split("\n")) == 1:
-                indexes[:] = 1
-            elif not len(acqp.split("\n")) == len(bvals):
-                raise ConfigError(
-                    "No matching configuration found for index "
-                    "(maxing at {}) "
-                    "and acqp file (containing {} lines)\n{}".format(
-                        indexes.max(), len(acqp), acqp
-                    )
-                )
-            else:
-                indexes[:len(bvals[0])] = 1
-                used_indexes = len(bvals[0])
-                for i, bv in enumerate(bvals[1:]):
-                    indexes[used_indexes:used_indexes + len(bv)] = i + 2
-                    used_indexes += len(bv)
+        acqp = "\n".join(acqp)
 
         metadata.topup_indexes = np.unique(indexes).tolist()
 
@@ -382,7 +364,7 @@ class ApplyTopup(mrHARDIBaseApplication):
         for i, (dwi, bval, bvec) in enumerate(
             zip(self.dwi, self.bvals, self.bvecs)
         ):
-            bvalvec = np.loadtxt(bval)[:, None] * np.loadtxt(bvec).T
+            bvalvec = load_text(bval)[:, None] * load_text(bvec).T
             metadata = load_metadata(dwi)
             acq_types = metadata.acquisition_slices_to_list()
             new_group = True
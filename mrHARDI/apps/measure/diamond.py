@@ -5,17 +5,23 @@ from pathlib import Path
 
 import nibabel as nib
 import numpy as np
-from traitlets import Bool, Dict, Integer, Unicode
+from traitlets import Bool, Dict, Enum, Float, Instance, Integer, Unicode
 from traitlets.config import ArgumentError
 from traitlets.config.loader import ConfigError
 
 from mrHARDI.base.application import (ChoiceEnum,
                                            ChoiceList,
                                            mrHARDIBaseApplication,
+                                           nthreads_arg,
                                            output_prefix_argument,
                                            required_file,
                                            required_number)
 from mrHARDI.base.config import DiamondConfigLoader
+from mrHARDI.base.io import load_text
+from mrHARDI.traits.metrics.base import (AsyncImageWriter,
+                                              DependencyScheduler)
+from mrHARDI.traits.metrics.cache import MetricCache
+from mrHARDI.traits.metrics.manifest import MetricsManifest
 
 # fmd = fascicle md --check
 # fad = fascicle ad --check
@@ -23,7 +29,7 @@ from mrHARDI.base.config import DiamondConfigLoader
 # ffa = fascicle fa --check
 # ff = fascicle fractions --check
 # peaks = main eigenvectors of each fascicle
-from mrHARDI.base.dwi import load_metadata
+from mrHARDI.base.dwi import load_metadata, metadata_filename_from
 
 _DIAMOND_METRICS = [
     "fmd", "fad", "frd", "ffa", "ff", "peaks"
@@ -54,7 +60,7 @@ _OPTIONAL_METRICS = [
 # mkaniso = anisotropic mean kurtosis --check
 
 _MAGIC_DIAMOND_METRICS = [
-    "ufa", "op"
+    "ufa", "op", "mkiso", "mkaniso"
 ]
 
 
@@ -82,7 +88,12 @@ _aliases = {
     'in': 'DiamondMetrics.input_prefix',
     'out': 'DiamondMetrics.output_prefix',
     'n': 'DiamondMetrics.n_fascicles',
-    'xml-config': 'DiamondMetrics.from_xml'
+    'xml-config': 'DiamondMetrics.from_xml',
+    'solver': 'DiamondMetrics.eigen_solver',
+    'p': 'DiamondMetrics.n_threads',
+    'cache-memory': 'DiamondMetrics.cache_memory',
+    'cache-dir': 'DiamondMetrics.cache_dir',
+    'precision': 'DiamondMetrics.precision'
 }
 
 
@@ -110,6 +121,10 @@ _flags = dict(
     cache=(
         {'DiamondMetrics': {'save_cache': True}},
         "save metrics computing execution cache"
+    ),
+    force=(
+        {'DiamondMetrics': {'force': True}},
+        "compute all metrics, even those whose inputs did not change"
     )
 )
 
@@ -173,6 +188,24 @@ class DiamondMetrics(mrHARDIBaseApplication):
         help="Output iso, delta and eta decomposition of the diffusion tensor"
     ).tag(config=True)
 
+    eigen_solver = Enum(
+        ["eigh", "analytic"], "eigh",
+        help="Eigen decomposition of the tensors, either with numpy's eigh "
+             "or with the closed-form solution for 3x3 symmetric matrices"
+    ).tag(config=True)
+
+    precision = Enum(
+        ["float32", "float64"], "float64",
+        help="Floating point precision of the computations and outputs"
+    ).tag(config=True)
+
+    n_threads = nthreads_arg()
+
+    force = Bool(
+        False, help="Compute all metrics, even those already computed "
+                    "from the same inputs and parameters"
+    ).tag(config=True)
+
     save_cache = Bool(
         False, help="Save the final data cache of the metrics computing"
     ).tag(config=True)
@@ -192,7 +225,18 @@ class DiamondMetrics(mrHARDIBaseApplication):
              "load the metrics generation parameters"
     ).tag(config=True)
 
-    cache = Dict(default_value={})
+    cache_memory = Float(
+        None, allow_none=True,
+        help="Memory (in GB) the metrics cache can use before "
+             "spilling its arrays to disk"
+    ).tag(config=True)
+    cache_dir = Unicode(
+        None, allow_none=True,
+        help="Directory where the metrics cache spills its arrays "
+             "(defaults to a temporary directory)"
+    ).tag(config=True)
+
+    cache = Instance(MetricCache, args=())
 
     aliases = Dict(default_value=_aliases)
     flags = Dict(default_value=_flags)
@@ -216,7 +260,12 @@ class DiamondMetrics(mrHARDIBaseApplication):
                 )
 
     def execute(self):
+        if self.cache_memory is not None:
+            self.cache.memory_limit = int(self.cache_memory * 1024 ** 3)
+        self.cache.spill_dir = self.cache_dir
+
         import mrHARDI.traits.metrics.diamond as metrics_module
+        import mrHARDI.traits.metrics.magic_diamond as magic_module
 
         mask, affine = None, None
         if exists("{}_mask.nii.gz".format(self.input_prefix)):
@@ -257,19 +306,48 @@ class DiamondMetrics(mrHARDIBaseApplication):
             mask = mask.get_fdata().astype(bool)
 
 
-        for metric in self.metrics + self.mmetrics + self.opt_metrics:
-            klass = getattr(
-                metrics_module, "{}Metric".format(metric.capitalize())
-            )
-
-            klass(
-                self.n_fascicles, self.input_prefix,
-                self.output_prefix, self.cache, affine,
+        with AsyncImageWriter(self.n_threads) as writer:
+            kwargs = dict(
                 mask=mask, shape=mask.shape,
                 colors=self.output_colors, with_fw=self.free_water,
                 with_res=self.restricted, with_hind=self.hindered,
-                mosemap=self.model_selection
-            ).measure()
+                mosemap=self.model_selection,
+                eigen_solver=self.eigen_solver,
+                writer=writer,
+                dtype=self.precision
+            )
+
+            manifest = self._manifest()
+            metrics = {
+                metric: getattr(
+                    module, "{}Metric".format(metric.capitalize())
+                )(
+                    self.n_fascicles, self.input_prefix,
+                    self.output_prefix, self.cache, affine, **kwargs
+                ) for module, metric in [
+                    (metrics_module, m)
+                    for m in self.metrics + self.opt_metrics
+                ] + [(magic_module, m) for m in self.mmetrics]
+            }
+            metrics = {
+                name: metric for name, metric in metrics.items()
+                if not manifest.is_current(name, metric)
+            }
+
+            intermediates = metrics_module.HaeberlenConvention(
+                self.n_fascicles, self.input_prefix,
+                self.output_prefix, self.cache, affine, **kwargs
+            ).intermediates()
+
+            # Intermediates are only evicted when the cache is not saved
+            DependencyScheduler(self.n_threads).run(
+                list(metrics.values()), intermediates,
+                None if self.save_cache else self.cache
+            )
+
+        for name, metric in metrics.items():
+            manifest.record(name, metric)
+        manifest.save()
 
         if self.output_haeberlen:
             self._output_haeberlen(affine)
@@ -277,6 +355,28 @@ class DiamondMetrics(mrHARDIBaseApplication):
         if self.save_cache:
             self._save_cache()
 
+        self.cache.clear_spilled()
+
+    def _manifest(self):
+        # Maps and masks read by each metric are added by the metric itself
+        inputs = [self.mask, metadata_filename_from(self.input_prefix)]
+
+        return MetricsManifest(
+            "{}_diamond_manifest.json".format(self.output_prefix), inputs,
+            {
+                "n_fascicles": self.n_fascicles,
+                "colors": self.output_colors,
+                "free_water": self.free_water,
+                "restricted": self.restricted,
+                "hindered": self.hindered,
+                "model_selection": self.model_selection,
+                "mask": self.mask,
+                "eigen_solver": self.eigen_solver,
+                "precision": self.precision
+            },
+            self.force
+        )
+
     def _output_haeberlen(self, affine):
         from mrHARDI.traits.metrics.diamond import HaeberlenConvention
 
@@ -284,12 +384,14 @@ class DiamondMetrics(mrHARDIBaseApplication):
         if exists("{}_mask.nii.gz".format(self.input_prefix)):
             mask = nib.load("{}_mask.nii.gz".format(self.input_prefix))
 
-        affine = np.loadtxt(affine)
+        affine = load_text(affine)
 
         HaeberlenConvention(
             self.n_fascicles, self.input_prefix, self.output_prefix,
             self.cache, affine, mask.get_fdata().astype(bool), mask.shape,
-            self.output_colors, self.free_water, self.restricted, self.hindered
+            self.output_colors, self.free_water, self.restricted,
+            self.hindered, eigen_solver=self.eigen_solver,
+            dtype=self.precision
         ).measure()
 
     def _save_cache(self):
@@ -297,14 +399,14 @@ class DiamondMetrics(mrHARDIBaseApplication):
 
         try:
             Path(
-                "{}_{}.npy".format(self.output_prefix, fname)
-            ).touch(exist_ok=True)
+                "{}_{}".format(self.output_prefix, fname)
+            ).mkdir(parents=True, exist_ok=True)
         except OSError:
             for char in [" ", ":", ",", ".", "-", "\\", "/", ";"]:
                 fname = fname.replace(char, "_")
 
             Path(
-                "{}_{}.npy".format(self.output_prefix, fname)
-            ).touch(exist_ok=True)
+                "{}_{}".format(self.output_prefix, fname)
+            ).mkdir(parents=True, exist_ok=True)
 
-        np.save("{}_{}.npy".format(self.output_prefix, fname), self.cache)
+        self.cache.save("{}_{}".format(self.output_prefix, fname))
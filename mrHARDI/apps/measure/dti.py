@@ -1,17 +1,22 @@
+from concurrent.futures import ThreadPoolExecutor
 from copy import copy
 from os.path import exists
 
 import nibabel as nib
 
-from traitlets.config import Bool, Dict
+from traitlets import Bool, Dict, Enum, Float, Instance, Unicode
 from traitlets.config.loader import ConfigError
 
 from mrHARDI.base.application import (ChoiceEnum, ChoiceList,
                                            mrHARDIBaseApplication,
+                                           nthreads_arg,
                                            output_prefix_argument,
                                            required_file)
 
-from mrHARDI.base.dwi import load_metadata
+from mrHARDI.base.dwi import load_metadata, metadata_filename_from
+from mrHARDI.traits.metrics.base import AsyncImageWriter
+from mrHARDI.traits.metrics.cache import MetricCache
+from mrHARDI.traits.metrics.manifest import MetricsManifest
 
 _TENSOR_METRICS = ["fa", "md", "ad", "rd", "peaks"]
 
@@ -24,7 +29,12 @@ class TensorMetricsEnum(ChoiceEnum):
 _aliases = {
     'metrics': 'TensorMetrics.metrics',
     'in': 'TensorMetrics.input_prefix',
-    'out': 'TensorMetrics.output_prefix'
+    'out': 'TensorMetrics.output_prefix',
+    'solver': 'TensorMetrics.eigen_solver',
+    'p': 'TensorMetrics.n_threads',
+    'cache-memory': 'TensorMetrics.cache_memory',
+    'cache-dir': 'TensorMetrics.cache_dir',
+    'precision': 'TensorMetrics.precision'
 }
 
 
@@ -36,6 +46,10 @@ _flags = dict(
     eigs=(
         {'TensorMetrics': {'save_eigs': True}},
         "save eigenvalues and eigenvectors to output"
+    ),
+    force=(
+        {'TensorMetrics': {'force': True}},
+        "compute all metrics, even those whose inputs did not change"
     )
 )
 
@@ -63,12 +77,45 @@ class TensorMetrics(mrHARDIBaseApplication):
         False, help="Output color metrics if available"
     ).tag(config=True)
 
-    cache = Dict(default_value={})
+    eigen_solver = Enum(
+        ["eigh", "analytic"], "eigh",
+        help="Eigen decomposition of the tensors, either with numpy's eigh "
+             "or with the closed-form solution for 3x3 symmetric matrices"
+    ).tag(config=True)
+
+    precision = Enum(
+        ["float32", "float64"], "float64",
+        help="Floating point precision of the computations and outputs"
+    ).tag(config=True)
+
+    n_threads = nthreads_arg()
+
+    force = Bool(
+        False, help="Compute all metrics, even those already computed "
+                    "from the same inputs and parameters"
+    ).tag(config=True)
+
+    cache_memory = Float(
+        None, allow_none=True,
+        help="Memory (in GB) the metrics cache can use before "
+             "spilling its arrays to disk"
+    ).tag(config=True)
+    cache_dir = Unicode(
+        None, allow_none=True,
+        help="Directory where the metrics cache spills its arrays "
+             "(defaults to a temporary directory)"
+    ).tag(config=True)
+
+    cache = Instance(MetricCache, args=())
 
     aliases = Dict(default_value=_aliases)
     flags = Dict(default_value=_flags)
 
     def execute(self):
+        if self.cache_memory is not None:
+            self.cache.memory_limit = int(self.cache_memory * 1024 ** 3)
+        self.cache.spill_dir = self.cache_dir
+
         import mrHARDI.traits.metrics.dti as metrics_module
 
         mask = None
@@ -81,26 +128,67 @@ class TensorMetrics(mrHARDIBaseApplication):
                 "Need a metadata file for {}".format(self.input_prefix)
             )
 
-        for metric in self.metrics:
-            klass = getattr(
-                metrics_module, "{}Metric".format(metric.capitalize())
-            )
-
+        with AsyncImageWriter(self.n_threads) as writer:
             dti_image = nib.load("{}_dti.nii.gz".format(self.input_prefix))
             kwargs = {
                 "shape": dti_image.shape[:-1],
-                "colors": self.output_colors
+                "colors": self.output_colors,
+                "eigen_solver": self.eigen_solver,
+                "writer": writer,
+                "dtype": self.precision
             }
             if mask:
                 kwargs["mask"] = mask.get_fdata().astype(bool)
 
-            klass(
+            manifest = MetricsManifest(
+                "{}_dti_manifest.json".format(self.output_prefix), [
+                    metadata_filename_from(
+                        "{}.nii.gz".format(self.input_prefix)
+                    )
+                ], {
+                    "colors": self.output_colors,
+                    "eigen_solver": self.eigen_solver,
+                    "precision": self.precision
+                },
+                self.force
+            )
+            metrics = {
+                metric: getattr(
+                    metrics_module, "{}Metric".format(metric.capitalize())
+                )(
+                    self.input_prefix, self.output_prefix, self.cache,
+                    metadata.affine, **kwargs
+                ) for metric in self.metrics
+            }
+            metrics = {
+                name: metric for name, metric in metrics.items()
+                if not manifest.is_current(name, metric)
+            }
+
+            # Eigen decomposition and scalar maps are computed once, in a
+            # single pass, before metrics are written concurrently
+            scalars = metrics_module.DTIScalars(
                 self.input_prefix, self.output_prefix, self.cache,
-                metadata.affine, **kwargs
-            ).measure()
+                metadata.affine, metrics=[
+                    m for m in metrics if not m == "peaks"
+                ], **kwargs
+            )
+            scalars.measure()
+
+            with ThreadPoolExecutor(max(self.n_threads, 1)) as executor:
+                futures = [
+                    executor.submit(m.measure) for m in metrics.values()
+                ]
+
+                for future in futures:
+                    future.result()
+
+        for name, metric in metrics.items():
+            manifest.record(name, metric)
+        manifest.save()
 
         if self.save_eigs:
-            evals, evecs = self.cache["eigs"]
+            evals, evecs = scalars._get_eigs()
             nib.save(
                 nib.Nifti1Image(evals, metadata.affine),
                 "{}_evals.nii.gz".format(self.output_prefix)
@@ -109,3 +197,5 @@ class TensorMetrics(mrHARDIBaseApplication):
                 nib.Nifti1Image(evecs, metadata.affine),
                 "{}_evecs.nii.gz".format(self.output_prefix)
             )
+
+        self.cache.clear_spilled()
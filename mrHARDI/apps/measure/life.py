@@ -1,5 +1,4 @@
 import nibabel as nib
-import numpy as np
 from dipy.core.gradients import gradient_table
 from dipy.io.streamline import load_tractogram
 from dipy.tracking.life import FiberModel
@@ -7,6 +6,7 @@ from traitlets import Bool, Float, List
 
 from mrHARDI.base.application import (mrHARDIBaseApplication,
                                            required_file)
+from mrHARDI.base.io import load_text
 
 
 class Life(mrHARDIBaseApplication):
@@ -26,7 +26,7 @@ class Life(mrHARDIBaseApplication):
     cache_sphere = Bool(True)
 
     def execute(self):
-        bvals, bvecs = np.loadtxt(self.bvals), np.loadtxt(self.bvecs)
+        bvals, bvecs = load_text(self.bvals), load_text(self.bvecs)
         gtab = gradient_table(bvals, bvecs)
 
         data = nib.load(self.dwi)
@@ -12,6 +12,7 @@ from mrHARDI.base.application import (mrHARDIBaseApplication,
                                            output_prefix_argument,
                                            required_arg,
                                            required_file)
+from mrHARDI.base.io import load_text
 from mrHARDI.base.shell import launch_shell_process
 from mrHARDI.traits.csd import (CSDAlgorithm,
                                      TournierResponseAlgorithm)
@@ -138,7 +139,7 @@ class CSD(mrHARDIBaseApplication):
 
         if not self.configuration.shells:
             shells, counts = np.unique(
-                np.loadtxt(self.bvals),
+                load_text(self.bvals),
                 return_counts=True
             )
 
@@ -259,7 +260,7 @@ class FiberResponse(mrHARDIBaseApplication):
 
         if not self.configuration.shells:
             shells, counts = np.unique(
-                np.loadtxt(self.bvals),
+                load_text(self.bvals),
                 return_counts=True
             )
 
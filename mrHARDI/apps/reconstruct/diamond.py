@@ -1,7 +1,6 @@
 from os import getcwd
 from os.path import basename, join
 
-import numpy as np
 from traitlets import Bool, Dict, Instance, Unicode, Int
 from traitlets.config.loader import ArgumentError, ConfigError
 
@@ -9,6 +8,7 @@ from mrHARDI.base.application import (mrHARDIBaseApplication,
                                            mask_arg,
                                            output_file_argument,
                                            required_file, nthreads_arg)
+from mrHARDI.base.gradients import GradientScheme
 from mrHARDI.base.shell import launch_shell_process
 from mrHARDI.config.diamond import DiamondConfiguration
 
@@ -109,8 +109,9 @@ class Diamond(mrHARDIBaseApplication):
             self.configuration.traits()["initial_stick"].tag(required=True)
 
         data_name = self.image.split(".")[0]
-        bvals = np.loadtxt("{}.bval".format(data_name))
-        n_directions = np.sum(bvals > self.b0_threshold)
+        n_directions = GradientScheme.load(
+            "{}.bval".format(data_name), b0_threshold=self.b0_threshold
+        ).n_dwi
         n_params = self.configuration.get_model_n_params()
         if n_directions < n_params:
             if self.strict_params:
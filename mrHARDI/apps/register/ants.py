@@ -1,3 +1,5 @@
+from itertools import product
+from multiprocessing import cpu_count
 from os import getcwd, makedirs
 from os.path import basename, dirname, join, exists
 from shutil import copyfile, copytree, rmtree
@@ -5,6 +7,7 @@ from tempfile import TemporaryDirectory
 
 import nibabel as nib
 import numpy as np
+from scipy.spatial.transform import Rotation
 from traitlets import Dict, Instance, Unicode, Bool, Enum
 from traitlets.config.loader import ArgumentError
 
@@ -17,13 +20,27 @@ from mrHARDI.base.application import (mrHARDIBaseApplication,
                                       required_arg,
                                       required_file)
 from mrHARDI.base.dwi import load_metadata, save_metadata
+from mrHARDI.base.io import load_text
 from mrHARDI.base.shell import launch_shell_process
-from mrHARDI.base.utils import split_ext
+from mrHARDI.base.utils import search_ranked, split_ext, user_cache_dir
 from mrHARDI.compute.image import (align_by_center_of_mass,
                                    get_common_spacing,
+                                   image_similarity,
+                                   rewrite_affine,
                                    transform_images,
-                                   merge_transforms)
-from mrHARDI.compute.utils import load_transform
+                                   merge_transforms,
+                                   world_center_of_mass)
+from mrHARDI.compute.motion import (apply_motion_correction,
+                                    image_center,
+                                    load_moco_parameters,
+                                    moco_matrices,
+                                    rotate_bvecs)
+from mrHARDI.compute.pyramid import GaussianPyramid
+from mrHARDI.compute.transforms import (TransformChain,
+                                        load,
+                                        load_transform,
+                                        save_transform,
+                                        write_displacement_field)
 from mrHARDI.config.ants import (AntsConfiguration,
                                  AntsTransformConfiguration,
                                  AntsMotionCorrectionConfiguration,
@@ -102,6 +119,17 @@ class AntsRegistration(mrHARDIBaseApplication):
         ]
         super()._generate_config_file(filename)
 
+    def _pyramid(self, base_dir):
+        if self.configuration.pyramid_cache:
+            return GaussianPyramid(self.configuration.pyramid_cache)
+
+        # Levels are keyed by content, so they are kept across runs in the
+        # user cache, unless it cannot be written to
+        try:
+            return GaussianPyramid(user_cache_dir("pyramid"))
+        except OSError:
+            return GaussianPyramid(join(base_dir, "pyramid"))
+
     def _setup_ants_ai_input(
         self, image_fname, log_file,
         ref_fname=None, mask_fname=None,
@@ -154,19 +182,107 @@ class AntsRegistration(mrHARDIBaseApplication):
             ))
             image_fname = join(base_dir, "{}_hmatch.{}".format(name, ext))
 
-        cmd.append("ResampleImageBySpacing 3 {} {} {} {} {} 1".format(
-            image_fname,
-            join(base_dir, "{}_res.{}".format(name, ext)),
-            spacing, spacing, spacing
-        ))
-
         for c in cmd: 
             launch_shell_process(
                 c, log_file, additional_env=additional_env
             )
 
+        pyramid = self._pyramid(base_dir)
+        level = pyramid.level(image_fname, spacing / min(
+            nib.load(image_fname).header.get_zooms()[:3]
+        ))
+
+        if ext == "nii.gz":
+            copyfile(level, join(base_dir, "{}_res.{}".format(name, ext)))
+        else:
+            nib.save(
+                nib.load(level), join(base_dir, "{}_res.{}".format(name, ext))
+            )
+
         return join(base_dir, "{}_res.{}".format(name, ext))
 
+    def _search_ants_ai_sectors(
+        self, ants_config, ai_params, ai_config_dict, n_movings,
+        out_transform, angular_step=40, angular_range=60,
+        moving_mask=None, base_dir=None, log_file=None, additional_env=None
+    ):
+        splits = ants_config.ai_search_splits
+        n_workers = max(min(ants_config.ai_workers, splits ** 3), 1)
+
+        additional_env = dict(additional_env or {})
+        additional_env["ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS"] = str(
+            max(cpu_count() // n_workers, 1)
+        )
+
+        # Each sector covers a cube of the rotation grid. The moving images
+        # are rotated to the center of the sector, which antsAI then
+        # searches over a reduced angular range, reusing the same
+        # downsampled inputs.
+        half_width = angular_range / splits
+        centers = [
+            -angular_range + (2 * i + 1) * half_width for i in range(splits)
+        ]
+        pivot = world_center_of_mass(ai_config_dict["m0"])
+
+        candidates = []
+        for k, angles in enumerate(product(centers, repeat=3)):
+            rotation = np.eye(4)
+            rotation[:3, :3] = Rotation.from_euler(
+                "xyz", angles, degrees=True
+            ).as_matrix()
+            rotation[:3, 3] = pivot - rotation[:3, :3] @ pivot
+
+            config_dict = dict(ai_config_dict)
+            for i in range(n_movings):
+                name, ext = split_ext(
+                    basename(ai_config_dict["m{}".format(i)]),
+                    r"^(/?.*)\.(nii\.gz|nii)$"
+                )
+                config_dict["m{}".format(i)] = rewrite_affine(
+                    ai_config_dict["m{}".format(i)], rotation,
+                    join(base_dir, "{}_sector{}.{}".format(name, k, ext))
+                )
+
+            params = ai_params
+            if moving_mask is not None:
+                name, ext = split_ext(
+                    basename(moving_mask), r"^(/?.*)\.(nii\.gz|nii)$"
+                )
+                params = params.replace(moving_mask, rewrite_affine(
+                    moving_mask, rotation,
+                    join(base_dir, "{}_sector{}.{}".format(name, k, ext))
+                ))
+
+            transform = join(base_dir, "ants_ai_sector{}.mat".format(k))
+            params = params.format(**config_dict)
+            params += " -s [{},{}] --output {}".format(
+                angular_step, half_width / 180., transform
+            )
+
+            candidates.append((
+                image_similarity(config_dict["t0"], config_dict["m0"]),
+                (rotation, params, transform, config_dict)
+            ))
+
+        def _search(_candidate):
+            _rotation, _params, _transform, _dict = _candidate
+            launch_shell_process(
+                "antsAI {}".format(_params), log_file,
+                additional_env=additional_env
+            )
+
+            _t = load_transform(_transform)
+            return image_similarity(_dict["t0"], _dict["m0"], _t), \
+                _t @ _rotation
+
+        _, best_transform = search_ranked(
+            candidates, _search, n_workers, ants_config.ai_early_stop
+        )
+
+        save_transform(
+            best_transform, "AffineTransform_double_3_3", out_transform
+        )
+
     def _call_ants_ai(
         self, targets, movings, ants_config, transform_fname,
         resampling_factor=3.,
@@ -176,7 +292,8 @@ class AntsRegistration(mrHARDIBaseApplication):
         target_mask=None, moving_mask=None,
         initial_transform=None,
         base_dir=None, log_file=None,
-        additional_env=None, keep_files=False
+        additional_env=None, keep_files=False,
+        cache_dir=None, inputs_cache=None
     ):
         ai_config_dict = {}
         spacing = resampling_factor * get_common_spacing(
@@ -189,7 +306,15 @@ class AntsRegistration(mrHARDIBaseApplication):
         if log_file is None:
             log_file = join(base_dir, "ants_ai.log")
 
+        if inputs_cache is None:
+            inputs_cache = {}
+
         with TemporaryDirectory(dir=base_dir) as prep_dir:
+            if cache_dir is None:
+                cache_dir = prep_dir
+                inputs_cache = {}
+            else:
+                makedirs(cache_dir, exist_ok=True)
 
             if initial_transform is not None:
                 c = "antsApplyTransforms -e 0 -d 3"
@@ -236,13 +361,17 @@ class AntsRegistration(mrHARDIBaseApplication):
                     base_dir, "ants_ai_target{}.{}".format(i, ext)
                 )
 
-                targets[i] = self._setup_ants_ai_input(
-                    target, log_file,
-                    mask_fname=target_mask,
-                    spacing=spacing,
-                    additional_env=additional_env,
-                    base_dir=prep_dir
-                )
+                key = (target, target_mask, spacing)
+                if key not in inputs_cache:
+                    inputs_cache[key] = self._setup_ants_ai_input(
+                        target, log_file,
+                        mask_fname=target_mask,
+                        spacing=spacing,
+                        additional_env=additional_env,
+                        base_dir=cache_dir
+                    )
+
+                targets[i] = inputs_cache[key]
 
             for i, moving in enumerate(movings):
                 _, ext = split_ext(moving, r"^(/?.*)\.(nii\.gz|nii)$")
@@ -283,45 +412,59 @@ class AntsRegistration(mrHARDIBaseApplication):
                 ))
 
             ai_init_params = ants_config.get_ants_ai_parameters(spacing)
-            ai_init_params = ai_init_params.format(**ai_config_dict)
-            ai_init_params += " -s [{},{}] -p {} -g [{},{}]".format(
-                angular_step, angular_range / 180., int(align_axes),
-                translation_step, "x".join(str(t) for t in translation_range)
-            )
-            ai_init_params += " --output {}".format(
-                join(base_dir, "ants_ai_transform.mat")
+            ai_search_params = " -p {} -g [{},{}]".format(
+                int(align_axes), translation_step,
+                "x".join(str(t) for t in translation_range)
             )
-            ai_init_params += " --verbose {}".format(int(self.verbose))
+            ai_search_params += " --verbose {}".format(int(self.verbose))
 
             if target_mask:
                 if moving_mask is None:
-                    ai_init_params += "--masks {}".format(target_mask)
+                    ai_search_params += " --masks {}".format(target_mask)
                 else:
-                    ai_init_params += " --masks [{},{}]".format(
+                    ai_search_params += " --masks [{},{}]".format(
                         target_mask, moving_mask
                     )
 
-            cmd = []
-            cmd.append("antsAI {}".format(ai_init_params))
+            if ants_config.ai_search_splits > 1:
+                self._search_ants_ai_sectors(
+                    ants_config, ai_init_params + ai_search_params,
+                    ai_config_dict, len(movings),
+                    join(base_dir, "ants_ai_transform.mat"),
+                    angular_step=angular_step, angular_range=angular_range,
+                    moving_mask=moving_mask, base_dir=prep_dir,
+                    log_file=log_file, additional_env=additional_env
+                )
+            else:
+                ai_init_params = ai_init_params.format(**ai_config_dict)
+                ai_init_params += " -s [{},{}]".format(
+                    angular_step, angular_range / 180.
+                )
+                ai_init_params += " --output {}".format(
+                    join(base_dir, "ants_ai_transform.mat")
+                )
+                launch_shell_process(
+                    "antsAI {}".format(ai_init_params + ai_search_params),
+                    log_file, additional_env=additional_env
+                )
 
             if align_center_of_mass:
-                cmd.append("antsApplyTransforms -t {} -t {} -o {}".format(
+                cmd = "antsApplyTransforms -t {} -t {} -o {}".format(
                     join(base_dir, "ants_ai_transform.mat"),
                     join(prep_dir, "center_of_mass.mat"),
                     "Linear[{},0]".format(transform_fname)
-                ))
+                )
             else:
-                cmd.append("mv {} {}".format(
+                cmd = "mv {} {}".format(
                     join(base_dir, "ants_ai_transform.mat"),
                     transform_fname
-                ))
-
-            for c in cmd:
-                launch_shell_process(
-                    c, log_file,
-                    additional_env=additional_env
                 )
 
+            launch_shell_process(
+                cmd, log_file,
+                additional_env=additional_env
+            )
+
             if keep_files:
                 copytree(
                     prep_dir, join(base_dir, "prepare"), dirs_exist_ok=True
@@ -359,6 +502,8 @@ class AntsRegistration(mrHARDIBaseApplication):
             makedirs(coarse_subpath, exist_ok=True)
             fine_subpath = join(current_path, "fine_init")
             makedirs(fine_subpath, exist_ok=True)
+            ai_inputs_path = join(current_path, "ants_ai_inputs")
+            ai_inputs_cache = {}
 
             log_file = join(current_path, "{}_initialization.log".format(
                 basename(self.output_prefix)
@@ -388,7 +533,9 @@ class AntsRegistration(mrHARDIBaseApplication):
                 base_dir=coarse_subpath,
                 log_file=log_file,
                 additional_env=additional_env,
-                keep_files=True
+                keep_files=True,
+                cache_dir=ai_inputs_path,
+                inputs_cache=ai_inputs_cache
             )
 
             fine_angular_range = self.configuration.fine_angular_range / 2.
@@ -417,7 +564,9 @@ class AntsRegistration(mrHARDIBaseApplication):
                 base_dir=fine_subpath,
                 log_file=log_file,
                 additional_env=additional_env,
-                keep_files=True
+                keep_files=True,
+                cache_dir=ai_inputs_path,
+                inputs_cache=ai_inputs_cache
             )
 
             merge_transforms(
@@ -426,6 +575,9 @@ class AntsRegistration(mrHARDIBaseApplication):
                 additional_env=additional_env
             )
 
+            # The downsampled inputs are only shared between both stages
+            rmtree(ai_inputs_path, ignore_errors=True)
+
             self.configuration.set_initial_transform_from_ants_ai(
                 "init_transform.mat"
             )
@@ -766,7 +918,7 @@ class AntsTransform(mrHARDIBaseApplication):
         if self.bvecs:
             ref = nib.load(self.transformation_ref)
             ref_ornt = nib.io_orientation(ref.affine)
-            bvecs = np.loadtxt(self.bvecs)
+            bvecs = load_text(self.bvecs)
 
             for trans, inv in zip(self.transformations[::-1], invert[::-1]):
                 if trans.split(".")[-1] == "mat":
@@ -777,11 +929,7 @@ class AntsTransform(mrHARDIBaseApplication):
                             dirname(trans)
                         )
                     )
-                    rot = load_transform(trans, ref_ornt)[:3, :3]
-                    if inv:
-                        rot = np.linalg.inv(rot)
-
-                    bvecs = rot @ bvecs
+                    bvecs = load(trans, inv).rotation(ref_ornt) @ bvecs
 
             np.savetxt("{}.bvec".format(self.output), bvecs)
 
@@ -803,7 +951,9 @@ References :
 _mot_aliases = {
     'target': 'AntsMotionCorrection.target_images',
     'moving': 'AntsMotionCorrection.moving_images',
-    'out': 'AntsMotionCorrection.output_prefix'
+    'out': 'AntsMotionCorrection.output_prefix',
+    'companions': 'AntsMotionCorrection.companion_images',
+    'bvecs': 'AntsMotionCorrection.bvecs'
 }
 
 _mot_flags = dict(
@@ -838,6 +988,18 @@ class AntsMotionCorrection(mrHARDIBaseApplication):
 
     output_prefix = output_prefix_argument()
 
+    companion_images = MultipleArguments(
+        Unicode(), help="Other 4D images acquired along the moving "
+                        "timeseries, resampled on the target with the "
+                        "motion parameters of each volume. 3D images, "
+                        "like masks, are resampled with the mean motion"
+    ).tag(config=True)
+    bvecs = Unicode(
+        None, allow_none=True,
+        help="B-vectors of the moving timeseries, rotated with the motion "
+             "parameters of each volume"
+    ).tag(config=True)
+
     verbose = Bool(False).tag(config=True)
 
     aliases = Dict(default_value=_mot_aliases)
@@ -898,6 +1060,47 @@ class AntsMotionCorrection(mrHARDIBaseApplication):
         if metadata:
             save_metadata("{}_warped".format(self.output_prefix), metadata)
 
+        if self.companion_images or self.bvecs:
+            self._apply_motion_parameters()
+
+    def _apply_motion_parameters(self):
+        reference = nib.load(self.target_images[0])
+        matrices = moco_matrices(
+            load_moco_parameters(
+                "{}MOCOparams.csv".format(self.output_prefix)
+            ),
+            [p.name for p in self.configuration.passes],
+            image_center(reference)
+        )
+
+        for image in self.companion_images:
+            img = nib.load(image)
+            is_label = np.issubdtype(img.get_data_dtype(), np.integer) or \
+                img.get_data_dtype() == bool
+
+            name, _ = split_ext(basename(image), r"^(/?.*)\.(nii\.gz|nii)$")
+            out_name = "{}_{}_warped".format(self.output_prefix, name)
+            data = apply_motion_correction(
+                img, matrices, reference, order=0 if is_label else 1
+            )
+
+            header = img.header.copy()
+            header.set_data_dtype(data.dtype)
+            nib.save(
+                nib.Nifti1Image(data, reference.affine, header),
+                "{}.nii.gz".format(out_name)
+            )
+
+            metadata = load_metadata(image)
+            if metadata:
+                save_metadata(out_name, metadata)
+
+        if self.bvecs:
+            np.savetxt(
+                "{}_warped.bvec".format(self.output_prefix),
+                rotate_bvecs(load_text(self.bvecs), matrices, reference)
+            )
+
 
 _compose_aliases = {
     'in': 'ComposeANTsTransformations.fwd_transforms',
@@ -1022,14 +1225,32 @@ class ComposeANTsTransformations(mrHARDIBaseApplication):
         current_dir = getcwd()
         commands = []
 
+        def _is_affine(_f):
+            return _f.split(".")[-1] in ["mat", "txt"]
+
         def _transforms_fmt(_t, _it, _i):
-            def _is_affine(_f):
-                return _f.split(".")[-1] in ["mat", "txt"]
             return " ".join(["{}{}".format(
                 "-i " if _inv and _is_affine(_tr) else "",
                 _itr if _inv and not _is_affine(_tr) else _tr
             ) for _inv, _tr, _itr in zip(_i, _t, _it)])
 
+        def _compose(_out, _ref, _t, _it, _i):
+            # Purely linear chains are collapsed in memory and written
+            # directly as a displacement field over the reference
+            if self.extension == ".nii.gz":
+                chain = TransformChain([
+                    load(_tr, _inv) if _is_affine(_tr)
+                    else load(_itr if _inv else _tr)
+                    for _inv, _tr, _itr in zip(_i, _t, _it)
+                ])
+                if chain.linear:
+                    write_displacement_field(chain, _ref, _out)
+                    return
+
+            commands.append(composer_fmt.format(
+                out=_out, ref=_ref, transforms=_transforms_fmt(_t, _it, _i)
+            ))
+
         composer_fmt = "ComposeMultiTransform 3 {out} -R {ref} {transforms}"
 
         fwd_trans, inv_trans = self.fwd_transforms, self.inv_transforms
@@ -1048,51 +1269,33 @@ class ComposeANTsTransformations(mrHARDIBaseApplication):
             fwd_trans, inv_trans = _t, _it
 
         if self.produce_img_transforms:
-            commands.append(
-                composer_fmt.format(
-                    out="{}_image_transform_{}{}".format(
-                        self.output, self.fwd_suffix, self.extension
-                    ),
-                    ref=self.target_ref,
-                    transforms=_transforms_fmt(
-                        fwd_trans, inv_trans[::-1], fwd_inv
-                    )
-                )
+            _compose(
+                "{}_image_transform_{}{}".format(
+                    self.output, self.fwd_suffix, self.extension
+                ),
+                self.target_ref, fwd_trans, inv_trans[::-1], fwd_inv
             )
-            commands.append(
-                composer_fmt.format(
-                    out="{}_image_transform_{}{}".format(
-                        self.output, self.inv_suffix, self.extension
-                    ),
-                    ref=self.source_ref,
-                    transforms=_transforms_fmt(
-                        inv_trans, fwd_trans[::-1], inv_inv
-                    )
-                )
+            _compose(
+                "{}_image_transform_{}{}".format(
+                    self.output, self.inv_suffix, self.extension
+                ),
+                self.source_ref, inv_trans, fwd_trans[::-1], inv_inv
             )
 
         if self.produce_tract_transforms:
-            commands.append(
-                composer_fmt.format(
-                    out="{}_tractogram_transform_{}{}".format(
-                        self.output, self.fwd_suffix, self.extension
-                    ),
-                    ref=self.target_ref,
-                    transforms=_transforms_fmt(
-                        inv_trans, fwd_trans[::-1], [not i for i in inv_inv]
-                    )
-                )
+            _compose(
+                "{}_tractogram_transform_{}{}".format(
+                    self.output, self.fwd_suffix, self.extension
+                ),
+                self.target_ref, inv_trans, fwd_trans[::-1],
+                [not i for i in inv_inv]
             )
-            commands.append(
-                composer_fmt.format(
-                    out="{}_tractogram_transform_{}{}".format(
-                        self.output, self.inv_suffix, self.extension
-                    ),
-                    ref=self.source_ref,
-                    transforms=_transforms_fmt(
-                        fwd_trans, inv_trans[::-1], [not i for i in fwd_inv]
-                    )
-                )
+            _compose(
+                "{}_tractogram_transform_{}{}".format(
+                    self.output, self.inv_suffix, self.extension
+                ),
+                self.source_ref, fwd_trans, inv_trans[::-1],
+                [not i for i in fwd_inv]
             )
 
         if self.produce_transform_scripts:
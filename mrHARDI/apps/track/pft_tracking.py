@@ -17,6 +17,7 @@ from mrHARDI.base.application import (mrHARDIBaseApplication,
                                            output_prefix_argument,
                                            required_file,
                                            required_number)
+from mrHARDI.base.io import load_text
 from mrHARDI.config.pft_tracking import ParticleFilteringConfiguration
 
 
@@ -76,7 +77,7 @@ class PftTracking(mrHARDIBaseApplication):
 
     def execute(self):
         coeffs = nib.load(self.sh_coefficients).get_data()
-        affine = np.loadtxt(self.affine)
+        affine = load_text(self.affine)
 
         pve_img = nib.load(self.pve_maps)
         voxel_size = np.average(pve_img.header['pixdim'][1:4])
@@ -84,7 +85,7 @@ class PftTracking(mrHARDIBaseApplication):
 
         sphere = default_sphere
         if self.sphere_vertices:
-            sphere = np.loadtxt(self.sphere_vertices)
+            sphere = load_text(self.sphere_vertices)
 
         tracker = ProbabilisticDirectionGetter.from_shcoeff(
             coeffs, max_angle=self.configuration.max_angle, sphere=sphere
@@ -93,7 +94,7 @@ class PftTracking(mrHARDIBaseApplication):
         if self.compute_seeds:
             seeds = self._compute_seeds(pve_map, affine)
         else:
-            seeds = np.loadtxt(self.seed_list)
+            seeds = load_text(self.seed_list)
 
         cmc_crit = CmcStoppingCriterion.from_pve(
             *np.moveaxis(pve_map, -1, 0),
@@ -17,3 +17,4 @@ from .image import (ApplyMask,
                     ResamplingReference,
                     Segmentation2Mask,
                     SplitImage)
+from .store import ExportFromStore, ImportToStore
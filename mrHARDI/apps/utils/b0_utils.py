@@ -10,6 +10,7 @@ from mrHARDI.base.application import (mrHARDIBaseApplication,
                                            required_file,
                                            output_prefix_argument)
 from mrHARDI.base.dwi import load_metadata, save_metadata
+from mrHARDI.base.io import load_text
 from mrHARDI.compute.b0 import extract_b0, normalize_to_b0, squash_b0
 from mrHARDI.config.utils import B0UtilsConfiguration
 
@@ -95,42 +96,40 @@ class B0Utils(mrHARDIBaseApplication):
 
     def _normalize_b0(self):
         in_dwi = nib.load(self.image)
-        bvals = np.loadtxt(self.bvals)
+        bvals = load_text(self.bvals)
         kwargs = dict(b0_comp=np.less) if self.configuration.strict else dict()
         metadata = load_metadata(self.image)
 
+        out_dtype = in_dwi.get_data_dtype()
+        if self.configuration.dtype:
+            out_dtype = self.configuration.dtype
+
         data, ref_mean = normalize_to_b0(
-            in_dwi.get_fdata().astype(in_dwi.get_data_dtype()), bvals,
+            np.asanyarray(in_dwi.dataobj), bvals,
             self.configuration.get_mean_strategy_enum(),
             self.configuration.get_ref_strategy_enum(),
             ceil=self.configuration.ceil_value,
+            dtype=out_dtype,
             **kwargs
         )
 
         if metadata:
             save_metadata(self.output_prefix, metadata)
 
-        out_dtype = in_dwi.get_data_dtype()
-        if self.configuration.dtype:
-            out_dtype = self.configuration.dtype
-
-        img = nib.Nifti1Image(
-            data.astype(out_dtype),
-            in_dwi.affine, in_dwi.header
-        )
+        img = nib.Nifti1Image(data, in_dwi.affine, in_dwi.header)
         img.set_data_dtype(out_dtype)
 
         nib.save(img, "{}.nii.gz".format(self.output_prefix))
 
         if self.reverse:
             rev_dwi = nib.load(self.reverse)
-            rev_data = rev_dwi.get_fdata().astype(in_dwi.get_data_dtype())
+            rev_data = np.asanyarray(rev_dwi.dataobj)
 
             if len(rev_dwi.shape) == 3:
                 rev_data = rev_data[..., None]
 
             if self.rev_bvals:
-                bvals = np.loadtxt(self.rev_bvals)
+                bvals = load_text(self.rev_bvals)
             else:
                 bvals = np.zeros((rev_data.shape[-1],))
 
@@ -140,13 +139,11 @@ class B0Utils(mrHARDIBaseApplication):
                 self.configuration.get_ref_strategy_enum(),
                 ref_mean,
                 ceil=self.configuration.ceil_value,
+                dtype=out_dtype,
                 **kwargs
             )
 
-            img = nib.Nifti1Image(
-                data.astype(out_dtype),
-                rev_dwi.affine, rev_dwi.header
-            )
+            img = nib.Nifti1Image(data, rev_dwi.affine, rev_dwi.header)
             img.set_data_dtype(out_dtype)
 
             if not self.rev_output_prefix:
@@ -160,7 +157,7 @@ class B0Utils(mrHARDIBaseApplication):
 
     def _extract_b0(self):
         in_dwi = nib.load(self.image)
-        bvals = np.loadtxt(self.bvals)
+        bvals = load_text(self.bvals)
         kwargs = dict(b0_comp=np.less) if self.configuration.strict else dict()
         metadata = load_metadata(self.image)
         kwargs["metadata"] = metadata
@@ -191,13 +188,13 @@ class B0Utils(mrHARDIBaseApplication):
 
     def _squash_b0(self):
         in_dwi = nib.load(self.image)
-        bvals = np.loadtxt(self.bvals)
+        bvals = load_text(self.bvals)
         kwargs = dict(b0_comp=np.less) if self.configuration.strict else dict()
         metadata = load_metadata(self.image)
         kwargs["metadata"] = metadata
         kwargs["dtype"] = in_dwi.get_data_dtype()
 
-        bvecs = np.loadtxt(self.bvecs) if self.bvecs else None
+        bvecs = load_text(self.bvecs) if self.bvecs else None
 
         data, bvals, bvecs = squash_b0(
             in_dwi, bvals, bvecs,
@@ -1,3 +1,4 @@
+from concurrent.futures import ThreadPoolExecutor
 from os.path import exists, basename, join, dirname
 
 import nibabel as nib
@@ -15,7 +16,9 @@ from traitlets import (Instance,
 from traitlets.config import Config
 
 from mrHARDI.base.application import (mrHARDIBaseApplication,
-                                           MultipleArguments, output_file_argument,
+                                           MultipleArguments,
+                                           nthreads_arg,
+                                           output_file_argument,
                                            output_prefix_argument,
                                            required_arg,
                                            required_file)
@@ -26,7 +29,9 @@ from mrHARDI.base.dwi import (AcquisitionType,
                                    load_metadata_file,
                                    load_metadata,
                                    save_metadata)
-from mrHARDI.compute.dwi import identify_shells, sh_order_from
+from mrHARDI.base.gradients import GradientScheme
+from mrHARDI.base.io import load_text
+from mrHARDI.compute.dwi import group_duplicated_directions
 from mrHARDI.compute.utils import resampling_affine
 from mrHARDI.config.utils import DwiMetadataUtilsConfiguration
 
@@ -342,7 +347,7 @@ class AssertDwiDimensions(mrHARDIBaseApplication):
 
     def execute(self):
         img = nib.load(self.dwi)
-        bvals, bvecs = np.loadtxt(self.bvals), np.loadtxt(self.bvecs).T
+        bvals, bvecs = load_text(self.bvals), load_text(self.bvecs).T
 
         if self.strategy == "error":
             if img.shape[-1] != len(bvals) != len(bvecs):
@@ -410,13 +415,19 @@ _shells_aliases = {
     "keep": "ExtractShells.keep",
     "out": "ExtractShells.output",
     "ceil": "ExtractShells.b0_threshold",
-    "gap": "ExtractShells.shell_threshold"
+    "gap": "ExtractShells.shell_threshold",
+    "groups": "ExtractShells.shell_groups",
+    "p": "ExtractShells.n_threads"
 }
 
 _shells_flags = dict(
     with_b0=(
         {"ExtractShells": {"keep_b0": True}},
         'Keeps b0 volumes in the output'
+    ),
+    split=(
+        {"ExtractShells": {"split_shells": True}},
+        'Writes each selected shell to its own output'
     )
 )
 
@@ -456,87 +467,146 @@ class ExtractShells(mrHARDIBaseApplication):
         default_value=40, help="Threshold for gaps between shells"
     ).tag(config=True)
 
+    split_shells = Bool(
+        False, help="Write each selected shell to <output>_b<shell>"
+    ).tag(config=True)
+    shell_groups = MultipleArguments(
+        Unicode(), help="Groups of shells to extract from a single read of "
+                        "the dwi, with shells of a group separated by ':' "
+                        "(e.g. 1000:2000,3000). Each b-value selects the "
+                        "closest shell within the gap between shells. Each "
+                        "group is written to <output>_b<shell>_b<shell>..."
+    ).tag(config=True)
+
+    n_threads = nthreads_arg()
+
     output = output_prefix_argument()
 
     aliases = Dict(default_value=_shells_aliases)
     flags = Dict(default_value=_shells_flags)
 
+    def _selection_mask(self, centroids, shells):
+        mask = np.zeros_like(centroids, bool)
+        if self.keep == "leq":
+            mask |= centroids <= shells.max()
+        elif self.keep == "geq":
+            mask |= centroids >= shells.min()
+        elif self.keep == "bigset":
+            counts = np.array([(centroids == s).sum() for s in shells])
+            mask |= centroids == shells[counts.argmax()]
+        elif self.keep == "smallset":
+            counts = np.array([(centroids == s).sum() for s in shells])
+            mask |= centroids == shells[counts.argmin()]
+        elif self.keep == "all":
+            mask |= np.isin(centroids, shells)
+
+        return mask
+
+    def _match_shells(self, bvals, shells):
+        # Requested b-values select the closest shell within the gap
+        # allowed between shells, none being an error
+        bvals = np.asarray(bvals, dtype=float)
+        distances = np.abs(bvals[:, None] - np.asarray(shells)[None, :])
+        if distances.size == 0 or np.any(
+            distances.min(axis=1) > self.shell_threshold
+        ):
+            raise TraitError(
+                "No shell within {} of b-values {} among shells {}".format(
+                    self.shell_threshold, bvals.tolist(), list(shells)
+                )
+            )
+
+        return np.asarray(shells)[distances.argmin(axis=1)]
+
+    def _outputs(self, shells, available):
+        def _name(group):
+            return "{}_{}".format(self.output, "_".join(
+                "b{}".format(int(round(s))) for s in group
+            ))
+
+        if self.shell_groups:
+            groups = [
+                [float(s) for s in g.split(":")] for g in self.shell_groups
+            ]
+            return [
+                (_name(g), self._match_shells(g, available)) for g in groups
+            ]
+        if self.split_shells:
+            return [
+                (_name([s]), self._match_shells([s], available))
+                for s in shells
+            ]
+
+        return [(self.output, shells)]
+
     def execute(self):
-        bvals = np.loadtxt(self.bvals)
-        bvecs = np.loadtxt(self.bvecs)
+        bvals = load_text(self.bvals)
+        bvecs = load_text(self.bvecs)
         dwi = nib.load(self.dwi)
 
-        b0_mask = np.less_equal(bvals, self.b0_threshold)
-        shells, centroids = identify_shells(
-            bvals[~b0_mask], self.shell_threshold
+        scheme = GradientScheme.load(
+            self.bvals, self.bvecs, self.b0_threshold, self.shell_threshold
         )
-        centroids = shells[centroids]
-        _, cnt = np.unique(centroids, return_counts=True)
+        b0_mask = scheme.b0_mask
+        shells, centroids = scheme.shells, scheme.centroids
+        cnt = np.bincount(scheme.shell_indexes, minlength=len(shells))
 
-        cnt = np.array(cnt)
         cnt_mask = np.ones_like(centroids, bool)
         for shell, ct in zip(shells, cnt):
             if ct <= self.count:
                 cnt_mask[centroids == shell] = False
 
         centroids = centroids[cnt_mask]
-        shells = shells[cnt > self.count]
+        shells = available = shells[cnt > self.count]
 
         if self.shells:
             shells = np.array(self.shells)
 
-        mask = np.zeros_like(centroids, bool)
-        if self.keep == "leq":
-            mask |= centroids <= shells.max()
-        elif self.keep == "geq":
-            mask |= centroids >= shells.min()
-        elif self.keep == "bigset":
-            counts = [(centroids == s).sum() for s in shells]
-            mask |= centroids == shells[counts.argmax()]
-        elif self.keep == "smallset":
-            counts = [(centroids == s).sum() for s in shells]
-            mask |= centroids == shells[counts.argmin()]
-        elif self.keep == "all":
-            for shell in shells:
-                mask |= centroids == shell
+        extraction_masks = []
+        for prefix, group in self._outputs(shells, available):
+            extraction_mask = np.zeros_like(bvals, bool)
+            dwi_mask = cnt_mask.copy()
+            dwi_mask[cnt_mask] = self._selection_mask(centroids, group)
+            extraction_mask[~b0_mask] = dwi_mask
+            if self.keep_b0:
+                extraction_mask[b0_mask] = True
 
-        extraction_mask = np.zeros_like(bvals, bool)
-        cnt_mask[cnt_mask] = mask
-        extraction_mask[~b0_mask] = cnt_mask
-        if self.keep_b0:
-            extraction_mask[b0_mask] = True
+            extraction_masks.append((prefix, extraction_mask))
 
-        np.savetxt(
-            "{}.bval".format(self.output),
-            bvals[extraction_mask],
-            newline=" ",
-            fmt="%d"
-        )
-        np.savetxt(
-            "{}.bvec".format(self.output),
-            bvecs[:, extraction_mask],
-            fmt="%.8f"
-        )
-        nib.save(
-            nib.Nifti1Image(
-                dwi.get_fdata().astype(
-                    dwi.get_data_dtype()
-                )[..., extraction_mask],
-                dwi.affine, dwi.header
-            ),
-            "{}.nii.gz".format(self.output)
+        # The dwi is read once, all subsets are written concurrently
+        data = np.asanyarray(dwi.dataobj).astype(
+            dwi.get_data_dtype(), copy=False
         )
-
         metadata = load_metadata(self.dwi)
-        if metadata:
-            acq_types = np.array(
-                metadata.acquisition_slices_to_list()
-            )[extraction_mask]
-            directions = np.array(metadata.directions)[extraction_mask, :]
-            metadata.update_acquisition_from_list(acq_types.tolist())
-            metadata.directions = directions.tolist()
-            metadata.n = int(extraction_mask.sum())
-            save_metadata(self.output, metadata)
+
+        def _write(prefix, extraction_mask):
+            np.savetxt(
+                "{}.bval".format(prefix),
+                bvals[extraction_mask],
+                newline=" ",
+                fmt="%d"
+            )
+            np.savetxt(
+                "{}.bvec".format(prefix),
+                bvecs[:, extraction_mask],
+                fmt="%.8f"
+            )
+            nib.save(
+                nib.Nifti1Image(
+                    data[..., extraction_mask], dwi.affine, dwi.header
+                ),
+                "{}.nii.gz".format(prefix)
+            )
+
+            if metadata:
+                subset = metadata.copy()
+                subset.select(extraction_mask)
+                save_metadata(prefix, subset)
+
+        with ThreadPoolExecutor(
+            max(min(self.n_threads, len(extraction_masks)), 1)
+        ) as executor:
+            list(executor.map(lambda pm: _write(*pm), extraction_masks))
 
 
 _flip_aliases = {
@@ -557,7 +627,7 @@ class FlipGradientsOnReference(mrHARDIBaseApplication):
     def execute(self):
         affine = nib.load(self.dwi).affine[:3, :3]
         flips = np.sign(np.linalg.inv(affine) @ [1, 1, 1]) < 0
-        bvecs = np.loadtxt(self.bvecs)
+        bvecs = load_text(self.bvecs)
         bvecs[flips, :] *= -1.
 
         np.savetxt("{}.bvec".format(self.output), bvecs)
@@ -581,11 +651,13 @@ class CheckDuplicatedBvecsInShell(mrHARDIBaseApplication):
 
     merging = Enum(
         ["first", "mean", "median"], "median",
-        help="Merge strategy of duplicates"
+        help="Merge strategy of duplicates, first keeping the earliest "
+             "volume of each group"
     ).tag(config=True)
 
     abs_threshold = Float(
-        1E-5, help="Absolute threshold on distance between directions"
+        1E-5, help="Absolute threshold on the distance 1 - |u . v| between "
+                   "directions, antipodal directions being duplicates"
     ).tag(config=True)
 
     b0_threshold = Integer(
@@ -603,59 +675,52 @@ class CheckDuplicatedBvecsInShell(mrHARDIBaseApplication):
     }
 
     def execute(self):
-        bvals = np.loadtxt(self.bvals)
-        bvecs = np.loadtxt(self.bvecs).T
+        bvals = load_text(self.bvals)
+        bvecs = load_text(self.bvecs).T
         dwi = nib.load(self.dwi)
-        data = dwi.get_fdata().astype(dwi.get_data_dtype())
+        data = np.asanyarray(dwi.dataobj).astype(
+            dwi.get_data_dtype(), copy=False
+        )
 
-        merge_fn = self._mergers[self.merging]
+        groups = group_duplicated_directions(
+            bvals, bvecs, self.b0_threshold, self.abs_threshold
+        )
+        order = np.argsort(groups, kind="stable")
+        starts = np.flatnonzero(np.diff(groups[order], prepend=-1))
+        sizes = np.diff(np.append(starts, len(order)))
+        meta_mask = np.zeros((len(bvals),), dtype=bool)
+        meta_mask[order[starts]] = True
 
-        odwi = []
-        obvals = []
-        obvecs = []
-        processed_vols = np.array([False] * data.shape[-1])
-
-        b0_mask = np.less_equal(bvals, self.b0_threshold)
-        meta_mask = np.zeros((len(bvals),),  dtype=bool)
-
-        for i in range(data.shape[-1]):
-            if not processed_vols[i]:
-                processed_vols[i] = True
-                meta_mask[i] = True
-                obvals.append(bvals[i])
-                obvecs.append(bvecs[i])
-                if b0_mask[i]:
-                    odwi.append(data[..., i, None])
-                else:
-                    shell_mask = np.isclose(bvals, bvals[i])
-                    shell_mask[processed_vols] = False
-                    distances = 1. - bvecs[shell_mask] @ bvecs[i]
-                    close_idxs = np.where(shell_mask)[0][np.isclose(distances, 0.)]
-                    processed_vols[close_idxs] = True
-                    if len(close_idxs) == 1:
-                        odwi.append(data[..., i, None])
-                    else:
-                        close_idxs = np.concatenate((close_idxs, [i]))
-                        odwi.append(merge_fn(data[..., close_idxs])[..., None])
+        dtype = data.dtype
+        if self.merging != "first" and np.issubdtype(dtype, np.integer):
+            dtype = np.float64
+
+        # Groups of the same size are merged together, in a single pass
+        merge_fn = self._mergers[self.merging]
+        odwi = np.empty(data.shape[:-1] + (len(starts),), dtype=dtype)
+        for size in np.unique(sizes):
+            group_idxs = np.where(sizes == size)[0]
+            vols = order[starts[group_idxs, None] + np.arange(size)]
+            if size == 1:
+                odwi[..., group_idxs] = data[..., vols[:, 0]]
+            else:
+                odwi[..., group_idxs] = merge_fn(data[..., vols])
 
-        np.savetxt("{}.bval".format(self.output), obvals, fmt="%d", newline=" ")
         np.savetxt(
-            "{}.bvec".format(self.output), np.array(obvecs).T, fmt="%.6f"
+            "{}.bval".format(self.output), bvals[meta_mask],
+            fmt="%d", newline=" "
+        )
+        np.savetxt(
+            "{}.bvec".format(self.output), bvecs[meta_mask].T, fmt="%.6f"
         )
         nib.save(
-            nib.Nifti1Image(
-                np.concatenate(odwi, axis=-1), dwi.affine, dwi.header
-            ),
+            nib.Nifti1Image(odwi, dwi.affine, dwi.header),
             "{}.nii.gz".format(self.output)
         )
 
         metadata = load_metadata(self.dwi)
         if metadata:
-            acq_types = np.array(metadata.acquisition_slices_to_list())[meta_mask]
-            directions = np.array(metadata.directions)[meta_mask, :]
-            metadata.update_acquisition_from_list(acq_types.tolist())
-            metadata.directions = directions.tolist()
-            metadata.n = int(meta_mask.sum())
+            metadata.select(meta_mask)
             save_metadata(self.output, metadata)
 
 
@@ -709,26 +774,10 @@ class DetermineSHOrder(mrHARDIBaseApplication):
     flags = Dict(default_value=_sh_order_flags)
 
     def execute(self):
-        bvals = np.loadtxt(self.bvals)
-        bvecs = np.loadtxt(self.bvecs)
-
-        bvals_idxs = np.greater(bvals, self.b0_threshold)
-        bvals = bvals[bvals_idxs]
-        bvecs = bvecs[:, bvals_idxs]
-
-        if self.msmt:
-            num_ubvecs = []
-            shells, centroids = identify_shells(bvals, self.shell_threshold)
-            centroids = shells[centroids]
-            for shell in shells:
-                ubv = np.unique(bvecs[:, centroids == shell], axis=1)
-                num_ubvecs.append(ubv.shape[1])
-
-            num_ubvecs = min(num_ubvecs)
-        else:
-            num_ubvecs = np.unique(bvecs, axis=1).shape[1]
-
-        sh_order = sh_order_from(num_ubvecs, self.full_basis)
+        scheme = GradientScheme.load(
+            self.bvals, self.bvecs, self.b0_threshold, self.shell_threshold
+        )
+        sh_order = scheme.sh_order(self.msmt, self.full_basis)
 
         if self.strict and sh_order < self.sh_order:
             raise RuntimeError(
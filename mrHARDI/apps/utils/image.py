@@ -15,6 +15,7 @@ from mrHARDI.base.application import (mrHARDIBaseApplication,
                                            prefix_argument,
                                            required_number)
 from mrHARDI.base.dwi import load_metadata, save_metadata
+from mrHARDI.base.io import load_text
 from mrHARDI.compute.utils import (apply_mask_on_data,
                                    concatenate_dwi,
                                    resampling_affine,
@@ -134,11 +135,11 @@ class Concatenate(mrHARDIBaseApplication):
 
         bvals_list = [
             np.zeros((data[i].shape[-1],)) if bvals == "0" else
-            np.loadtxt(bvals, ndmin=1) for i, bvals in enumerate(self.bvals)
+            load_text(bvals, ndmin=1) for i, bvals in enumerate(self.bvals)
         ] if self.bvals else None
         bvecs_list = [
             np.zeros((3, data[i].shape[-1],)) if bvecs == "0" else
-            np.loadtxt(bvecs, ndmin=2) for i, bvecs in enumerate(self.bvecs)
+            load_text(bvecs, ndmin=2) for i, bvecs in enumerate(self.bvecs)
         ] if self.bvecs else None
 
         if len(data) == 1:
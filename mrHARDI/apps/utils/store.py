@@ -0,0 +1,84 @@
+from os.path import basename
+
+from traitlets import Dict, Integer, Unicode
+
+from mrHARDI.base.application import (mrHARDIBaseApplication,
+                                      MultipleArguments,
+                                      nthreads_arg,
+                                      output_prefix_argument,
+                                      required_arg)
+from mrHARDI.base.store import ChunkedStore, export_nifti, import_nifti
+
+
+_import_aliases = {
+    "in": "ImportToStore.images",
+    "store": "ImportToStore.store",
+    "names": "ImportToStore.names",
+    "level": "ImportToStore.level",
+    "p": "ImportToStore.n_threads"
+}
+
+
+class ImportToStore(mrHARDIBaseApplication):
+    name = u"Import to store"
+    description = "Writes images, with their gradients and metadata, " \
+                  "to a chunked store"
+
+    images = required_arg(
+        MultipleArguments, traits_args=(Unicode(),),
+        description="Input images to import"
+    )
+    store = required_arg(Unicode, description="Store directory")
+
+    names = MultipleArguments(
+        Unicode(), [], help="Names of the datasets in the store. "
+                            "Defaults to the images file names"
+    ).tag(config=True)
+
+    level = Integer(1, help="Compression level of the chunks").tag(
+        config=True
+    )
+
+    n_threads = nthreads_arg()
+
+    aliases = Dict(default_value=_import_aliases)
+
+    def execute(self):
+        names = self.names or [
+            basename(img).split(".")[0] for img in self.images
+        ]
+        store = ChunkedStore(self.store, self.level, self.n_threads)
+        for name, img in zip(names, self.images):
+            import_nifti(store, name, img)
+
+
+_export_aliases = {
+    "store": "ExportFromStore.store",
+    "names": "ExportFromStore.names",
+    "out": "ExportFromStore.output",
+    "p": "ExportFromStore.n_threads"
+}
+
+
+class ExportFromStore(mrHARDIBaseApplication):
+    name = u"Export from store"
+    description = "Writes datasets of a chunked store to nifti images, " \
+                  "with their gradients and metadata"
+
+    store = required_arg(Unicode, description="Store directory")
+    names = MultipleArguments(
+        Unicode(), [], help="Datasets to export. Defaults to all of them"
+    ).tag(config=True)
+
+    n_threads = nthreads_arg()
+
+    output = output_prefix_argument()
+
+    aliases = Dict(default_value=_export_aliases)
+
+    def execute(self):
+        store = ChunkedStore(self.store, n_threads=self.n_threads)
+        for name in self.names or store.datasets:
+            export_nifti(
+                store, name, "{}_{}".format(self.output, name)
+            )
@@ -1,10 +1,10 @@
 import nibabel as nib
-import numpy as np
 from traitlets import Bool, Dict, Integer
 
 from mrHARDI.base.application import (mrHARDIBaseApplication,
                                       output_prefix_argument,
                                       required_file)
+from mrHARDI.base.gradients import GradientScheme
 
 
 _aliases = {
@@ -38,20 +38,22 @@ class DWIValidation(mrHARDIBaseApplication):
 
     def execute(self):
         img = nib.load(self.dwi)
-        bvals = np.loadtxt(self.bvals)
-        bvecs = np.loadtxt(self.bvecs)
+        scheme = GradientScheme.load(
+            self.bvals, self.bvecs, b0_threshold=self.b0_threshold
+        )
 
+        n_rows, n_bvecs = scheme.bvecs_shape
         bvecs_is_row = True
-        if bvecs.shape[0] > bvecs.shape[1]:
+        if n_rows > n_bvecs:
             bvecs_is_row = False
-            bvecs = bvecs.T
+            n_bvecs = n_rows
 
         n_volumes = img.shape[-1]
 
-        valid_bvals = len(bvals) == n_volumes
-        valid_bvecs = bvecs.shape[1] == n_volumes
+        valid_bvals = scheme.n_volumes == n_volumes
+        valid_bvecs = n_bvecs == n_volumes
 
-        has_b0 = np.sum(bvals < self.b0_threshold) > 0
+        has_b0 = scheme.min_bval < self.b0_threshold
 
         if self.output_stdout:
             if not has_b0:
@@ -62,14 +64,14 @@ class DWIValidation(mrHARDIBaseApplication):
                 print(
                     "Mismatch between the number of b-values "
                     "({}) and DWI volumes ({})\n".format(
-                        len(bvals), n_volumes
+                        scheme.n_volumes, n_volumes
                     )
                 )
             if bvecs_is_row and not valid_bvecs:
                 print(
                     "Mismatch between the number of b-vectors "
                     "({}) and DWI volumes ({})\n".format(
-                        bvecs.shape[1], n_volumes
+                        n_bvecs, n_volumes
                     )
                 )
 
@@ -86,13 +88,13 @@ class DWIValidation(mrHARDIBaseApplication):
                         f.write(
                             "Mismatch between the number of b-values "
                             "({}) and DWI volumes ({})\n".format(
-                                len(bvals), n_volumes
+                                scheme.n_volumes, n_volumes
                             )
                         )
                     if bvecs_is_row and not valid_bvecs:
                         f.write(
                             "Mismatch between the number of b-vectors "
                             "({}) and DWI volumes ({})\n".format(
-                                bvecs.shape[1], n_volumes
+                                n_bvecs, n_volumes
                             )
                         )
@@ -9,6 +9,7 @@ from traitlets import Dict
 
 from mrHARDI.base.application import (mrHARDIBaseApplication,
                                            prefix_argument)
+from mrHARDI.base.io import load_text
 
 
 _aliases = {
@@ -84,10 +85,11 @@ class VisualizeEddyParameters(mrHARDIBaseApplication):
         return fig, ((1, 1),)
 
     def _load_parameters(self, param_type):
-        return np.loadtxt(
+        return load_text(
             "{}.eddy_{}_parameter_history".format(
                 self.input_prefix, param_type
-            )
-        ), np.loadtxt(
-            "{}.eddy_{}_mss_history".format(self.input_prefix, param_type)
+            ), cache=True
+        ), load_text(
+            "{}.eddy_{}_mss_history".format(self.input_prefix, param_type),
+            cache=True
         )
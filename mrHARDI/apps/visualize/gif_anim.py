@@ -26,6 +26,7 @@ from mrHARDI.base.application import (mrHARDIBaseApplication,
                                            output_prefix_argument,
                                            BoundingBox)
 
+from mrHARDI.base.io import load_text
 from mrHARDI.compute.math.tensor import compute_eigenvalues
 
 from fury import actor, window
@@ -364,9 +365,9 @@ class GifAnimator(mrHARDIBaseApplication):
                 coeffs.get_fdata(), affine, strides, back_stride
             )
             order = int((-3 + np.sqrt(9 + 8 * (1 + data.shape[-1] - 1))) / 2)
-            bvals, bvecs = np.loadtxt(self.bvals), np.loadtxt(self.bvecs)
+            bvals, bvecs = load_text(self.bvals), load_text(self.bvecs)
 
-            response = np.loadtxt(self.response)
+            response = load_text(self.response)
             model = ConstrainedSphericalDeconvModel(
                 gradient_table(bvals, bvecs),
                 (response[:3], response[3]),
@@ -12,6 +12,7 @@ from mrHARDI.base.application import (mrHARDIConfigurable,
                                            AnyInt)
 
 from mrHARDI.base.config import ConfigurationLoader
+from mrHARDI.base.io import load_text
 
 
 class Direction(Enum):
@@ -60,11 +61,166 @@ def save_metadata(prefix, metadata):
 
 
 def non_zero_bvecs(prefix):
-    bvecs = np.loadtxt("{}.bvec".format(prefix))
+    bvecs = load_text("{}.bvec".format(prefix))
     bvecs[:, np.linalg.norm(bvecs, axis=0) < 1E-6] += 1E-6
     np.savetxt("{}_non_zero.bvec".format(prefix), bvecs, fmt="%.6f")
 
 
+def _runs(codes):
+    codes = np.asarray(codes)
+    changes = np.ones((len(codes),), dtype=bool)
+    changes[1:] = codes[1:] != codes[:-1]
+    starts = np.flatnonzero(changes)
+    stops = np.append(starts[1:], len(codes))
+    return starts, stops, codes[starts]
+
+
+def _encode(values, vocabulary):
+    codes = []
+    for v in values:
+        if v not in vocabulary:
+            vocabulary.append(v)
+        codes.append(vocabulary.index(v))
+
+    return codes
+
+
+class VolumeTable:
+    """
+    Per-volume metadata of a dwi dataset, as columns of codes : the
+    acquisition type, the phase encoding direction and the dataset index
+    of every volume. Codes index the acquisition_types and directions
+    vocabularies, -1 marking volumes without a direction. The topup index
+    of the dataset of every volume is kept when the metadata gives one
+    per dataset, and is None otherwise.
+    """
+    def __init__(
+        self, acquisition, direction, dataset, acquisition_types, directions,
+        topup=None
+    ):
+        self.acquisition = np.asarray(acquisition, dtype=int)
+        self.direction = np.asarray(direction, dtype=int)
+        self.dataset = np.asarray(dataset, dtype=int)
+        self.acquisition_types = list(acquisition_types)
+        self.directions = list(directions)
+        self.topup = None if topup is None else np.asarray(topup, dtype=int)
+
+    @classmethod
+    def from_metadata(cls, metadata):
+        n = metadata.n
+        acquisition_types, directions = [], []
+
+        slices = metadata.acquisition_slices or []
+        acquisition = np.repeat(
+            _encode(metadata.acquisition_types, acquisition_types)[
+                :len(slices)
+            ],
+            [(s[1] if s[1] else n) - s[0] for s in slices]
+        )
+
+        direction = np.full((n,), -1, dtype=int)
+        ranges = metadata.directions or []
+        codes = _encode([d["dir"] for d in ranges], directions)
+        for d, code in zip(ranges, codes):
+            direction[d["range"][0]:d["range"][1]] = code
+
+        dataset = np.searchsorted(
+            np.asarray(metadata.dataset_indexes[1:], dtype=int),
+            np.arange(n), side="right"
+        )
+
+        if len(acquisition) != n:
+            raise ConfigError(
+                "Acquisition slices describe {} volumes, "
+                "expected {}".format(len(acquisition), n)
+            )
+        if any(d["range"][1] > n for d in ranges):
+            raise ConfigError(
+                "Directions describe volumes past the {} expected".format(n)
+            )
+
+        topup = None
+        if metadata.topup_indexes and \
+                len(metadata.topup_indexes) == len(metadata.dataset_indexes):
+            topup = np.asarray(metadata.topup_indexes, dtype=int)[dataset]
+
+        return cls(
+            acquisition, direction, dataset, acquisition_types, directions,
+            topup
+        )
+
+    def __len__(self):
+        return len(self.acquisition)
+
+    def _with(self, acquisition, direction, dataset, topup):
+        return VolumeTable(
+            acquisition, direction, dataset,
+            self.acquisition_types, self.directions, topup
+        )
+
+    def select(self, indexes):
+        return self._with(
+            self.acquisition[indexes],
+            self.direction[indexes],
+            self.dataset[indexes],
+            None if self.topup is None else self.topup[indexes]
+        )
+
+    def repeat(self, reps):
+        return self._with(
+            np.repeat(self.acquisition, reps),
+            np.repeat(self.direction, reps),
+            np.repeat(self.dataset, reps),
+            None if self.topup is None else np.repeat(self.topup, reps)
+        )
+
+    def concat(self, oth):
+        acquisition_types, directions = list(self.acquisition_types), \
+            list(self.directions)
+        acq_codes = np.array(
+            _encode(oth.acquisition_types, acquisition_types) + [-1]
+        )
+        dir_codes = np.array(_encode(oth.directions, directions) + [-1])
+        n_datasets = self.dataset.max() + 1 if len(self) > 0 else 0
+
+        topup = None
+        if self.topup is not None and oth.topup is not None:
+            topup = np.concatenate((self.topup, oth.topup))
+
+        return VolumeTable(
+            np.concatenate((self.acquisition, acq_codes[oth.acquisition])),
+            np.concatenate((self.direction, dir_codes[oth.direction])),
+            np.concatenate((self.dataset, n_datasets + oth.dataset)),
+            acquisition_types, directions, topup
+        )
+
+    def to_metadata(self, metadata):
+        metadata.n = len(self)
+
+        starts, stops, codes = _runs(self.acquisition)
+        metadata.acquisition_slices = [
+            [int(b), int(e)] for b, e in zip(starts, stops)
+        ]
+        metadata.acquisition_types = [
+            self.acquisition_types[c] for c in codes
+        ]
+
+        starts, stops, codes = _runs(self.direction)
+        metadata.directions = [
+            {"dir": self.directions[c], "range": (int(b), int(e))}
+            for b, e, c in zip(starts, stops, codes) if c >= 0
+        ]
+
+        starts, _, _ = _runs(self.dataset)
+        metadata.dataset_indexes = starts.tolist() if len(starts) else [0]
+
+        # Topup indexes of the datasets left, one per dataset
+        if self.topup is not None:
+            metadata.topup_indexes = self.topup[starts].tolist()
+
+        return metadata
+
+
 class DwiMetadata(mrHARDIConfigurable):
     n = Integer().tag(config=True)
     n_excitations = Integer().tag(config=True)
@@ -105,33 +261,25 @@ class DwiMetadata(mrHARDIConfigurable):
             np.linalg.eigvalsh(np.array(self.affine)[:3, :3])
         ).tolist()
 
-    def acquisition_slices_to_list(self):
-        slices = [
-            [s[0], s[1] if s[1] else self.n] for s in self.acquisition_slices
-        ]
+    def to_table(self):
+        return VolumeTable.from_metadata(self)
+
+    def update_from_table(self, table):
+        table.to_metadata(self)
 
-        return np.concatenate(tuple(
-            np.repeat(acq, sl[1] - sl[0])
-            for acq, sl in zip(self.acquisition_types, slices)
-        )).tolist()
+    def select(self, indexes):
+        self.update_from_table(self.to_table().select(indexes))
+
+    def acquisition_slices_to_list(self):
+        table = self.to_table()
+        return [table.acquisition_types[c] for c in table.acquisition]
 
     def update_acquisition_from_list(self, acqs):
-        grad = [
-            acqs[i] != acqs[i + 1] for i in np.indices((len(acqs),))[0, :-1]
+        starts, stops, types = _runs(np.asarray(acqs))
+        self.acquisition_slices = [
+            [int(b), int(e)] for b, e in zip(starts, stops)
         ]
-        grad.extend([True])
-        transitions = np.where(grad)[0]
-
-        acquisition_slices = [[0, transitions[0] + 1]]
-        acquisition_types = [acqs[transitions[0]]]
-        for idx in np.indices(transitions.shape)[0, 1:]:
-            acquisition_slices.append(
-                [transitions[idx - 1] + 1, transitions[idx] + 1]
-            )
-            acquisition_types.append(acqs[transitions[idx]])
-
-        self.acquisition_slices = acquisition_slices
-        self.acquisition_types = acquisition_types
+        self.acquisition_types = types.tolist()
 
     def becomes(self, oth):
         self.n = oth.n
@@ -156,39 +304,12 @@ class DwiMetadata(mrHARDIConfigurable):
         )
         assert is_same, "Affine transform for input images are not the same"
 
-        d1 = self.directions if self.directions is not None else []
-        d2 = oth.directions if oth.directions is not None else []
-
-        for d in d2:
-            d["range"] = (
-                d["range"][0] + d1[-1]["range"][1],
-                d["range"][1] + d1[-1]["range"][1]
-            )
-
-        self.directions = d1 + d2
-
-        directions = [self.directions[0]]
-        for d in self.directions[1:]:
-            if directions[-1]["dir"] == d["dir"]:
-                directions[-1]["range"] = (
-                    directions[-1]["range"][0],
-                    d["range"][1]
-                )
-            else:
-                directions.append(d)
-
-        self.directions = directions
-
-        acqs = (
-            list(self.acquisition_slices_to_list()) +
-            list(oth.acquisition_slices_to_list())
-        )
-        self.update_acquisition_from_list(acqs)
-
-        self.dataset_indexes += [self.n + idx for idx in oth.dataset_indexes]
-        self.n += oth.n
+        table = self.to_table().concat(oth.to_table())
+        self.update_from_table(table)
 
-        self.topup_indexes += oth.topup_indexes
+        if table.topup is None:
+            self.topup_indexes = \
+                (self.topup_indexes or []) + (oth.topup_indexes or [])
 
         # TODO: Add logic to check slice ordering
         if self.is_multiband or oth.is_multiband:
@@ -218,16 +339,7 @@ class DwiMetadata(mrHARDIConfigurable):
         if self.n < n:
             if n % self.n == 0:
                 reps = int(n / self.n)
-                acq = self.acquisition_slices_to_list()
-                self.update_acquisition_from_list(
-                    np.repeat(acq, reps).tolist()
-                )
-                self.directions = np.repeat(self.directions, reps).tolist()
-                if self.topup_indexes:
-                    self.topup_indexes = np.repeat(
-                        self.topup_indexes, reps
-                    ).tolist()
-                self.n = n
+                self.update_from_table(self.to_table().repeat(reps))
             else:
                 raise ConfigError(
                     "Could not adapt from {} to {} data points".format(
@@ -235,12 +347,7 @@ class DwiMetadata(mrHARDIConfigurable):
                     )
                 )
         elif self.n > n:
-            acq = self.acquisition_slices_to_list()
-            self.update_acquisition_from_list(acq[:n])
-            self.directions = self.directions[:n]
-            if self.topup_indexes:
-                self.topup_indexes = self.topup_indexes[:n]
-            self.n = n
+            self.select(slice(0, n))
 
     def _validate(self):
         pass
@@ -1,9 +1,17 @@
 from typing import Generator
 
-from numpy import less_equal, clip
-from numpy.ma import clump_masked, clump_unmasked, masked_array
-
-from mrHARDI.compute.utils import value_closest, value_first
+from numpy import (append,
+                   arange,
+                   asarray,
+                   clip,
+                   concatenate,
+                   diff,
+                   flatnonzero,
+                   less_equal,
+                   repeat,
+                   searchsorted,
+                   stack)
+from traitlets.config.loader import ConfigError
 
 
 def serialize_fsl_args(args_dict, separator="\n", bool_as_flags=False):
@@ -33,25 +41,96 @@ def serialize_fsl_args(args_dict, separator="\n", bool_as_flags=False):
     )
 
 
+def _clump_lengths(mask):
+    bounds = concatenate((
+        [0], flatnonzero(diff(mask.astype(int))) + 1, [len(mask)]
+    ))
+    lengths = diff(bounds)
+    values = mask[bounds[:-1][lengths > 0]]
+    lengths = lengths[lengths > 0]
+
+    return lengths[values], lengths[~values]
+
+
 def prepare_topup_index(
     bvals, dir0=1, strategy="closest", ceil=0.9, b0_comp=less_equal
 ):
-    strat = value_closest if strategy == "closest" else value_first
-    indexes = []
-    mask = masked_array(bvals, b0_comp(bvals, ceil))
-    b0_clumps = list(clump_masked(mask))
-    dw_clumps = list(clump_unmasked(mask))
-    j = dir0
-    for s1, s2 in zip(b0_clumps[:len(dw_clumps)], dw_clumps):
-        for i in range(s1.stop - s1.start):
-            indexes += [j]
-        indexes, j = strat(indexes, s2, j)
-
-    if len(b0_clumps) > len(dw_clumps):
-        for i in range(b0_clumps[-1].stop - b0_clumps[-1].start):
-            indexes += [j]
-
-    return clip(indexes, a_min=1, a_max=len(b0_clumps))
+    b0_lengths, dw_lengths = _clump_lengths(
+        asarray(b0_comp(bvals, ceil), dtype=bool)
+    )
+
+    # Each b0 clump is paired with the next diffusion clump. With the
+    # closest strategy, the second half of a diffusion clump is indexed
+    # with the following b0 clump
+    n = min(len(b0_lengths), len(dw_lengths))
+    j = dir0 + arange(n)
+    b0_lengths_n, dw_lengths_n = b0_lengths[:n], dw_lengths[:n]
+    if strategy == "closest":
+        values = stack((j, j + 1), axis=1).ravel()
+        counts = stack((
+            b0_lengths_n + dw_lengths_n // 2,
+            dw_lengths_n - dw_lengths_n // 2
+        ), axis=1).ravel()
+    else:
+        values, counts = j, b0_lengths_n + dw_lengths_n
+
+    if len(b0_lengths) > len(dw_lengths):
+        values = append(values, dir0 + n)
+        counts = append(counts, b0_lengths[-1])
+
+    return clip(
+        repeat(values, counts), a_min=1, a_max=len(b0_lengths)
+    )
+
+
+def prepare_dataset_index(n, dataset_starts):
+    return 1 + searchsorted(
+        asarray(dataset_starts)[1:], arange(n), side="right"
+    )
+
+
+def prepare_slspec(slice_order):
+    return "".join(
+        " ".join(["{:d}".format(mm) for mm in m]) + "\n"
+        for m in slice_order
+    )
+
+
+def prepare_eddy_acquisition(
+    bvals, metadata, dataset_starts, acqp=None, strategy="closest",
+    ceil=0.9, b0_comp=less_equal
+):
+    """
+    Acquisition parameters, index and slice specification of concatenated
+    datasets. When the index built from the b0 clumps points past the
+    acquisition parameters, each dataset is indexed by its own line.
+    """
+    if acqp is None:
+        acqp = prepare_acqp_file(
+            metadata.readout, metadata.directions
+        ).split("\n")
+
+    indexes = prepare_topup_index(bvals, 1, strategy, ceil, b0_comp)
+
+    if indexes.max() > len(acqp):
+        if len(acqp) == 1:
+            indexes[:] = 1
+        elif len(acqp) == len(dataset_starts):
+            indexes = prepare_dataset_index(len(indexes), dataset_starts)
+        else:
+            raise ConfigError(
+                "No matching configuration found for index "
+                "(maxing at {}) "
+                "and acqp file (containing {} lines)\n{}".format(
+                    indexes.max(), len(acqp), "\n".join(acqp)
+                )
+            )
+
+    slspec = None
+    if metadata.slice_order:
+        slspec = prepare_slspec(metadata.slice_order)
+
+    return acqp, indexes, slspec
 
 
 def prepare_acqp_file(readout, directions):
@@ -0,0 +1,186 @@
+import hashlib
+import json
+from os import makedirs, remove, replace
+from os.path import dirname, exists, join, realpath
+from tempfile import mkstemp
+
+import numpy as np
+
+from mrHARDI.base.io import load_text
+from mrHARDI.base.utils import hash_file, user_cache_dir
+from mrHARDI.compute.dwi import identify_shells, sh_order_from
+
+
+def scheme_filename_from(bvals, cache_dir=None):
+    if cache_dir is None:
+        cache_dir = user_cache_dir("gradients")
+
+    return join(cache_dir, "{}.json".format(
+        hashlib.sha1(realpath(bvals).encode()).hexdigest()
+    ))
+
+
+def _clusters(mask):
+    changes = np.diff(mask.astype(int), prepend=0, append=0)
+    return np.stack((
+        np.flatnonzero(changes == 1), np.flatnonzero(changes == -1)
+    ), axis=1)
+
+
+class GradientScheme:
+    """
+    Analysis of a gradient scheme : b0 clusters, shells, number of unique
+    directions overall and per shell. It is saved in a json file of the
+    cache directory, named after the resolved path of the b-values and
+    keyed by the hash of the gradient files and by the thresholds, so it
+    is only computed once per gradient files.
+    """
+    def __init__(
+        self, n_volumes, b0_clusters, shells, shell_indexes,
+        n_directions=None, shell_directions=None, min_bval=0.,
+        bvecs_shape=None, key=None
+    ):
+        self.n_volumes = n_volumes
+        self.b0_clusters = np.asarray(b0_clusters, dtype=int).reshape((-1, 2))
+        self.shells = np.asarray(shells, dtype=float)
+        self.shell_indexes = np.asarray(shell_indexes, dtype=int)
+        self.n_directions = n_directions
+        self.shell_directions = shell_directions
+        self.min_bval = min_bval
+        self.bvecs_shape = bvecs_shape
+        self.key = key
+
+    @classmethod
+    def from_gradients(
+        cls, bvals, bvecs=None, b0_threshold=20, shell_threshold=40, key=None
+    ):
+        bvals = np.asarray(bvals, dtype=float).flatten()
+        b0_mask = np.less_equal(bvals, b0_threshold)
+
+        shells, shell_indexes = np.array([]), np.array([], dtype=int)
+        if np.any(~b0_mask):
+            shells, shell_indexes = identify_shells(
+                bvals[~b0_mask], shell_threshold
+            )
+
+        n_directions, shell_directions, bvecs_shape = None, None, None
+        if bvecs is not None:
+            bvecs = np.asarray(bvecs)
+            bvecs_shape = list(bvecs.shape)
+            if bvecs.shape[0] != 3 and bvecs.shape[-1] == 3:
+                bvecs = bvecs.T
+
+            # Mismatched gradient files are only described by their shapes,
+            # they are reported by the validation
+            if bvecs.ndim == 2 and bvecs.shape[1] == len(bvals):
+                bvecs = bvecs[:, ~b0_mask]
+                n_directions = np.unique(bvecs, axis=1).shape[1]
+                shell_directions = [
+                    np.unique(bvecs[:, shell_indexes == i], axis=1).shape[1]
+                    for i in range(len(shells))
+                ]
+
+        return cls(
+            len(bvals), _clusters(b0_mask), shells, shell_indexes,
+            n_directions, shell_directions,
+            float(bvals.min()) if len(bvals) else 0., bvecs_shape, key
+        )
+
+    @classmethod
+    def load(
+        cls, bvals, bvecs=None, b0_threshold=20, shell_threshold=40,
+        cache_dir=None
+    ):
+        _hash = hashlib.sha1()
+        for fname in [bvals, bvecs]:
+            _hash.update(
+                (hash_file(fname) if fname else "").encode()
+            )
+        _hash.update("{}:{}".format(b0_threshold, shell_threshold).encode())
+        key = _hash.hexdigest()
+
+        # The sidecar holds an analysis per gradient files and thresholds
+        sidecar, schemes = scheme_filename_from(bvals, cache_dir), {}
+        if exists(sidecar):
+            try:
+                with open(sidecar) as f:
+                    schemes = json.load(f)
+                if key in schemes:
+                    return cls.from_dict(schemes[key])
+            except (OSError, ValueError, TypeError, KeyError):
+                schemes = {}
+
+        scheme = cls.from_gradients(
+            load_text(bvals, ndmin=1),
+            load_text(bvecs, ndmin=2) if bvecs else None,
+            b0_threshold, shell_threshold, key
+        )
+
+        schemes[key] = scheme.to_dict()
+        tmp_fname = None
+        try:
+            makedirs(dirname(sidecar), exist_ok=True)
+            fd, tmp_fname = mkstemp(suffix=".tmp", dir=dirname(sidecar))
+            with open(fd, "w+") as f:
+                json.dump(schemes, f, indent=4)
+
+            replace(tmp_fname, sidecar)
+        except OSError:
+            if tmp_fname is not None and exists(tmp_fname):
+                remove(tmp_fname)
+
+        return scheme
+
+    @property
+    def b0_mask(self):
+        mask = np.zeros((self.n_volumes,), dtype=bool)
+        for start, stop in self.b0_clusters:
+            mask[start:stop] = True
+
+        return mask
+
+    @property
+    def n_dwi(self):
+        return self.n_volumes - int(np.sum(np.diff(self.b0_clusters, axis=1)))
+
+    @property
+    def centroids(self):
+        return self.shells[self.shell_indexes]
+
+    def sh_order(self, msmt=False, full_basis=False):
+        if self.n_directions is None:
+            raise ValueError(
+                "SH order requires b-vectors matching the b-values"
+            )
+
+        if msmt:
+            if len(self.shell_directions) == 0:
+                raise ValueError("SH order per shell requires a dwi shell")
+
+            return sh_order_from(min(self.shell_directions), full_basis)
+
+        return sh_order_from(self.n_directions, full_basis)
+
+    @classmethod
+    def from_dict(cls, desc):
+        return cls(**{
+            k: v for k, v in desc.items() if k != "max_sh_order"
+        })
+
+    def to_dict(self):
+        desc = {
+            "key": self.key,
+            "n_volumes": self.n_volumes,
+            "b0_clusters": self.b0_clusters.tolist(),
+            "shells": self.shells.tolist(),
+            "shell_indexes": self.shell_indexes.tolist(),
+            "n_directions": self.n_directions,
+            "shell_directions": self.shell_directions,
+            "min_bval": self.min_bval,
+            "bvecs_shape": self.bvecs_shape
+        }
+
+        if self.n_directions is not None:
+            desc["max_sh_order"] = self.sh_order()
+
+        return desc
@@ -0,0 +1,52 @@
+from os import replace
+from os.path import exists, getmtime
+
+import numpy as np
+
+
+def _ensure_ndmin(table, ndmin):
+    # Same dimensions handling as np.loadtxt
+    if table.ndim > ndmin:
+        table = np.squeeze(table)
+    if table.ndim < ndmin:
+        if ndmin == 1:
+            table = np.atleast_1d(table)
+        elif ndmin == 2:
+            table = np.atleast_2d(table).T
+
+    return table
+
+
+def load_text(
+    fname, ndmin=0, dtype=float, delimiter=None, skiprows=0, cache=False
+):
+    """
+    Numeric table of a text file, read with np.loadtxt. With cache, the
+    table is saved to a .npy file next to the source, reused until the
+    source changes.
+    """
+    if not cache:
+        return np.loadtxt(
+            fname, dtype=dtype, delimiter=delimiter, skiprows=skiprows,
+            ndmin=ndmin
+        )
+
+    cache_fname = "{}{}.npy".format(
+        fname, ".skip{}".format(skiprows) if skiprows else ""
+    )
+
+    if exists(cache_fname) and getmtime(cache_fname) >= getmtime(fname):
+        table = np.load(cache_fname).astype(dtype, copy=False)
+    else:
+        table = np.loadtxt(
+            fname, dtype=dtype, delimiter=delimiter, skiprows=skiprows,
+            ndmin=2
+        )
+        try:
+            with open("{}.tmp".format(cache_fname), "wb") as f:
+                np.save(f, table)
+            replace("{}.tmp".format(cache_fname), cache_fname)
+        except OSError:
+            pass
+
+    return _ensure_ndmin(table, ndmin)
@@ -0,0 +1,293 @@
+import fcntl
+import json
+import zlib
+from base64 import b64decode, b64encode
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from itertools import product
+from os import makedirs, replace
+from os.path import exists, join
+from shutil import rmtree
+
+import nibabel as nib
+import numpy as np
+
+from mrHARDI.base.dwi import metadata_filename_from
+from mrHARDI.base.io import load_text
+
+
+_INDEX = "index.json"
+_DEFAULT_CHUNKS = (64, 64, 64)
+_DEFAULT_VOLUME_CHUNK = 8
+
+
+class ChunkedStore:
+    """
+    Directory of named datasets, each one split in chunks along the voxels
+    and the volumes, compressed with zlib. The shape, type, affine and
+    attributes of the datasets are kept in a json index, so datasets and
+    their metadata can be read back partially without decoding whole
+    images. The index is updated under a lock file, merging the changes
+    made by other processes writing to the same store.
+    """
+    def __init__(self, directory, level=1, n_threads=1):
+        self.directory = directory
+        self.level = level
+        self.n_threads = n_threads
+
+        makedirs(directory, exist_ok=True)
+        self._index = self._load_index()
+
+    def __contains__(self, name):
+        return name in self._index
+
+    @property
+    def datasets(self):
+        return list(self._index)
+
+    def _desc(self, name):
+        # Datasets written by other processes are found in the index file
+        if name not in self._index:
+            self._index = self._load_index()
+
+        return self._index[name]
+
+    def shape(self, name):
+        return tuple(self._desc(name)["shape"])
+
+    def affine(self, name):
+        affine = self._desc(name)["affine"]
+        return None if affine is None else np.array(affine)
+
+    def attrs(self, name):
+        return dict(self._desc(name)["attrs"])
+
+    def _load_index(self):
+        if not exists(join(self.directory, _INDEX)):
+            return {}
+
+        with open(join(self.directory, _INDEX)) as f:
+            return json.load(f)
+
+    @contextmanager
+    def _index_lock(self):
+        with open(join(self.directory, "{}.lock".format(_INDEX)), "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _save_index(self, name, desc=None):
+        # The index is read again, as other processes may have changed it
+        # since, and only the given dataset is updated or removed from it
+        with self._index_lock():
+            index = self._load_index()
+            if desc is None and name not in index:
+                self._index = index
+                return
+
+            if desc is None:
+                del index[name]
+            else:
+                index[name] = desc
+
+            tmp_fname = join(self.directory, "{}.tmp".format(_INDEX))
+            with open(tmp_fname, "w+") as f:
+                json.dump(index, f, indent=4)
+
+            replace(tmp_fname, join(self.directory, _INDEX))
+            self._index = index
+
+    def _chunk_fname(self, name, chunk):
+        return join(self.directory, name, ".".join(str(c) for c in chunk))
+
+    def _chunk_slices(self, desc, chunk):
+        return tuple(
+            slice(c * s, min((c + 1) * s, n))
+            for c, s, n in zip(chunk, desc["chunks"], desc["shape"])
+        )
+
+    def _map(self, fn, items):
+        if self.n_threads > 1:
+            with ThreadPoolExecutor(self.n_threads) as executor:
+                return list(executor.map(fn, items))
+
+        return [fn(item) for item in items]
+
+    def write(self, name, data, affine=None, attrs=None, chunks=None):
+        data = np.asanyarray(data)
+        if chunks is None:
+            chunks = _DEFAULT_CHUNKS[:data.ndim] + (
+                _DEFAULT_VOLUME_CHUNK,
+            ) * max(data.ndim - 3, 0)
+
+        desc = {
+            "shape": list(data.shape),
+            "dtype": data.dtype.str,
+            "chunks": [max(min(c, n), 1) for c, n in zip(chunks, data.shape)],
+            "affine": None if affine is None else np.asarray(affine).tolist(),
+            "attrs": attrs or {}
+        }
+
+        self.delete(name)
+        makedirs(join(self.directory, name))
+
+        def _write_chunk(chunk):
+            block = np.ascontiguousarray(
+                data[self._chunk_slices(desc, chunk)]
+            )
+            with open(self._chunk_fname(name, chunk), "wb") as f:
+                f.write(zlib.compress(block.tobytes(), self.level))
+
+        self._map(_write_chunk, list(product(*(
+            range(-(-n // c)) for n, c in zip(desc["shape"], desc["chunks"])
+        ))))
+
+        self._save_index(name, desc)
+
+    def delete(self, name):
+        if exists(join(self.directory, name)):
+            rmtree(join(self.directory, name))
+
+        self._save_index(name)
+
+    def read(self, name, selection=()):
+        """
+        Read a dataset, or the region of it given by a tuple of integers
+        and slices over its leading axes. Only the chunks intersecting the
+        region are decoded.
+        """
+        desc = self._desc(name)
+        shape, chunks = desc["shape"], desc["chunks"]
+        if not isinstance(selection, tuple):
+            selection = (selection,)
+
+        bounds, steps, squeeze = [], [], []
+        for axis, n in enumerate(shape):
+            sel = selection[axis] if axis < len(selection) else slice(None)
+            if isinstance(sel, slice):
+                start, stop, step = sel.indices(n)
+                if step < 1:
+                    raise ValueError("Only positive steps can be read")
+            else:
+                start = int(sel) + n if int(sel) < 0 else int(sel)
+                if not 0 <= start < n:
+                    raise IndexError(
+                        "Index {} out of bounds for axis {} of size {}".format(
+                            sel, axis, n
+                        )
+                    )
+                stop, step = start + 1, 1
+                squeeze.append(axis)
+
+            bounds.append((start, max(stop, start)))
+            steps.append(step)
+
+        region = np.zeros(
+            [stop - start for start, stop in bounds], dtype=desc["dtype"]
+        )
+
+        def _read_chunk(chunk):
+            slices = self._chunk_slices(desc, chunk)
+            with open(self._chunk_fname(name, chunk), "rb") as f:
+                block = np.frombuffer(
+                    zlib.decompress(f.read()), dtype=desc["dtype"]
+                ).reshape([s.stop - s.start for s in slices])
+
+            src, dst = [], []
+            for s, (start, stop) in zip(slices, bounds):
+                lo, hi = max(s.start, start), min(s.stop, stop)
+                src.append(slice(lo - s.start, hi - s.start))
+                dst.append(slice(lo - start, hi - start))
+
+            region[tuple(dst)] = block[tuple(src)]
+
+        if region.size > 0:
+            self._map(_read_chunk, list(product(*(
+                range(start // c, -(-stop // c))
+                for (start, stop), c in zip(bounds, chunks)
+            ))))
+
+        region = region[tuple(slice(None, None, s) for s in steps)]
+        return np.squeeze(region, axis=tuple(squeeze)) if squeeze else region
+
+    def read_volume(self, name, index):
+        return self.read(name, (slice(None),) * 3 + (index,))
+
+    def read_masked(self, name, mask):
+        """
+        Values of the voxels inside the mask, decoding only the chunks
+        intersecting its bounding box.
+        """
+        mask = np.asarray(mask, dtype=bool)
+        if not mask.any():
+            return np.zeros(
+                (0,) + self.shape(name)[mask.ndim:],
+                dtype=self._desc(name)["dtype"]
+            )
+
+        box = tuple(
+            slice(idx.min(), idx.max() + 1) for idx in np.nonzero(mask)
+        )
+        return self.read(name, box)[mask[box]]
+
+
+def import_nifti(store, name, fname, chunks=None):
+    """
+    Write an image to the store, with its b-values, b-vectors and dwi
+    metadata when they are found next to it.
+    """
+    img = nib.load(fname)
+    prefix = fname.split(".")[0]
+
+    attrs = {}
+    if isinstance(img.header, nib.Nifti1Header):
+        attrs["header"] = b64encode(img.header.binaryblock).decode()
+    if exists("{}.bval".format(prefix)):
+        attrs["bvals"] = load_text(
+            "{}.bval".format(prefix), ndmin=1
+        ).tolist()
+    if exists("{}.bvec".format(prefix)):
+        attrs["bvecs"] = load_text(
+            "{}.bvec".format(prefix), ndmin=2
+        ).tolist()
+    if exists(metadata_filename_from(fname)):
+        with open(metadata_filename_from(fname)) as f:
+            attrs["metadata"] = f.read()
+
+    store.write(name, np.asanyarray(img.dataobj), img.affine, attrs, chunks)
+
+
+def export_nifti(store, name, prefix):
+    """
+    Write a dataset to a nifti image, restoring the header it was imported
+    with, along with its b-values, b-vectors and dwi metadata.
+    """
+    attrs = store.attrs(name)
+
+    img_class, header = nib.Nifti1Image, None
+    if "header" in attrs:
+        block = b64decode(attrs["header"])
+        if len(block) == nib.Nifti2Header.template_dtype.itemsize:
+            img_class, header = nib.Nifti2Image, nib.Nifti2Header(block)
+        else:
+            header = nib.Nifti1Header(block)
+
+    nib.save(
+        img_class(store.read(name), store.affine(name), header),
+        "{}.nii.gz".format(prefix)
+    )
+
+    if "bvals" in attrs:
+        np.savetxt(
+            "{}.bval".format(prefix), np.array(attrs["bvals"])[None, :],
+            fmt="%d"
+        )
+    if "bvecs" in attrs:
+        np.savetxt(
+            "{}.bvec".format(prefix), np.array(attrs["bvecs"]), fmt="%.8f"
+        )
+    if "metadata" in attrs:
+        with open("{}_metadata.py".format(prefix), "w+") as f:
+            f.write(attrs["metadata"])
@@ -1,4 +1,8 @@
+import hashlib
 import re
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from os import environ
+from os.path import expanduser, join
 
 
 def if_join_str(lst, char):
@@ -15,3 +19,60 @@ def split_ext(fname, re_name_splitter=None):
     else:
         _lst = fname.split(".")
         return _lst[0], ".".join(_lst[1:])
+
+
+def hash_file(fname, chunk_size=1 << 24, opener=open):
+    _hash = hashlib.sha1()
+    with opener(fname, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            _hash.update(chunk)
+
+    return _hash.hexdigest()
+
+
+def user_cache_dir(name):
+    """
+    Directory of the user cache (XDG_CACHE_HOME, ~/.cache by default)
+    where data reused across runs is kept.
+    """
+    return join(
+        environ.get("XDG_CACHE_HOME", expanduser(join("~", ".cache"))),
+        "mrHARDI", name
+    )
+
+
+def search_ranked(candidates, search, n_workers=1, early_stop=0.):
+    """
+    Best (score, result) returned by search over candidates, given as
+    (initial score, item) pairs and searched from the best initial score
+    down, at most n_workers at a time. A candidate is expected to reach
+    at most its initial score plus the largest gain a completed search
+    made over its own initial score. Once that falls below the best score
+    by more than early_stop times its magnitude, the remaining candidates
+    are dropped. An early_stop of 0 searches every candidate.
+    """
+    pending = sorted(candidates, key=lambda c: c[0], reverse=True)
+    best, gain, running = (None, None), None, {}
+
+    with ThreadPoolExecutor(max(n_workers, 1)) as executor:
+        while len(pending) > 0 or len(running) > 0:
+            while len(pending) > 0 and len(running) < max(n_workers, 1):
+                initial, item = pending.pop(0)
+                if early_stop > 0 and best[0] is not None and \
+                        initial + gain < best[0] - early_stop * abs(best[0]):
+                    # Candidates are ranked, the next ones are worse
+                    pending = []
+                    break
+
+                running[executor.submit(search, item)] = initial
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                initial = running.pop(future)
+                score, result = future.result()
+                if gain is None or score - initial > gain:
+                    gain = score - initial
+                if best[0] is None or score > best[0]:
+                    best = (score, result)
+
+    return best
@@ -1,4 +1,3 @@
-from copy import deepcopy
 from enum import Enum
 
 import numpy as np
@@ -28,122 +27,73 @@ def pick_b0(b0_mask, b0_strides):
     return b0_mask
 
 
+def _clusters_bounds(mask):
+    changes = np.diff(mask.astype(int), prepend=0, append=0)
+    return np.flatnonzero(changes == 1), np.flatnonzero(changes == -1)
+
+
+def read_volumes(dwi_img, indexes):
+    """
+    Volumes at the given indexes, in order, decoded in a single read of
+    the range of volumes spanning them.
+    """
+    indexes = np.asarray(indexes, dtype=int)
+    if len(indexes) == 0:
+        return np.empty(
+            dwi_img.shape[:-1] + (0,), dtype=dwi_img.get_data_dtype()
+        )
+
+    start, stop = indexes.min(), indexes.max() + 1
+    return np.asanyarray(dwi_img.dataobj[..., start:stop])[
+        ..., indexes - start
+    ]
+
+
+def _cluster_means(volumes, lengths):
+    offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    return np.add.reduceat(
+        volumes, offsets, axis=-1, dtype=np.float64
+    ) / lengths
+
+
 def mean_b0_clusters(dwi_img, b0_mask, output_shape):
-    b0_clusters = np.ma.notmasked_contiguous(b0_mask, axis=0)
-    output_vol = np.zeros(output_shape + (len(b0_clusters),))
-    for i, cluster in enumerate(b0_clusters):
-        output_vol[..., i] = np.mean(dwi_img.dataobj[..., cluster], axis=-1)
+    b0_mask = np.ma.filled(b0_mask, False).astype(bool)
+    starts, stops = _clusters_bounds(b0_mask)
+    if len(starts) == 0:
+        return np.zeros(output_shape + (0,))
 
-    return output_vol
+    return _cluster_means(
+        read_volumes(dwi_img, np.flatnonzero(b0_mask)), stops - starts
+    ).reshape(output_shape + (len(starts),))
 
 
 def extract_b0(
     dwi_img, bvals, b0_strides=None, mean=B0PostProcess.none, ceil=0.9,
     b0_comp=np.less_equal, metadata=None, dtype=None
 ):
-    b0_mask = b0_comp(bvals, ceil)
-    mask = np.ma.masked_array(b0_mask)
-    mask[~b0_mask] = np.ma.masked
+    b0_mask = np.array(b0_comp(bvals, ceil))[:dwi_img.shape[-1]]
 
     dtype = dtype if dtype else dwi_img.get_data_dtype()
 
     if b0_strides:
-        b0_mask[:dwi_img.shape[-1]] = pick_b0(
-            b0_mask[:dwi_img.shape[-1]], b0_strides
-        )
+        b0_mask = pick_b0(b0_mask, b0_strides)
 
     if mean is B0PostProcess.batch:
-        mask = np.ma.masked_array(b0_mask)
-        mask[~b0_mask] = np.ma.masked
-        b0_vols = mean_b0_clusters(dwi_img, mask, dwi_img.shape[:-1])
+        b0_vols = mean_b0_clusters(dwi_img, b0_mask, dwi_img.shape[:-1])
 
         if metadata:
-            clusters = np.ma.notmasked_contiguous(mask, axis=0)
-
-            acquisition = metadata.acquisition_slices_to_list()
-            metadata.update_acquisition_from_list([
-                acquisition[cluster.start] for cluster in clusters
-            ])
-
-            metadata.n = b0_vols.shape[-1]
-
-            directions = []
-            for i, cl in enumerate(clusters):
-                for d in metadata.directions:
-                    if d["range"][1] > cl.start >= d["range"][0]:
-                        directions.append({
-                            "dir": d["dir"],
-                            "range": (i, i + 1)
-                        })
-
-            dd = [directions[0]]
-            for d in directions[1:]:
-                if dd[-1]["dir"] == d["dir"]:
-                    dd[-1]["range"] = (
-                        dd[-1]["range"][0],
-                        d["range"][1]
-                    )
-                else:
-                    dd.append(d)
-
-            metadata.directions = dd
+            metadata.select(_clusters_bounds(b0_mask)[0])
     else:
-        b0_clusters = np.ma.notmasked_contiguous(mask, axis=0)
-        idx, b0_vols = 0, np.zeros(dwi_img.shape[:-1] + (np.sum(mask),))
-        for cluster in b0_clusters:
-            len_cluster = cluster.stop - cluster.start
-            b0_vols[..., idx:idx + len_cluster] = dwi_img.dataobj[..., cluster]
-            idx += len_cluster
+        b0_vols = read_volumes(dwi_img, np.flatnonzero(b0_mask))
 
         if metadata:
-            acquisition = (np.array(
-                metadata.acquisition_slices_to_list()
-            )[b0_mask[:dwi_img.shape[-1]]]).tolist()
-            metadata.update_acquisition_from_list(acquisition)
-
-            directions = []
-            start = 0
-            for cl in b0_clusters:
-                curr_cl = deepcopy(cl)
-                for i, d in enumerate(metadata.directions):
-                    if d["range"][1] > curr_cl.start >= d["range"][0]:
-                        n = min(curr_cl.stop, d["range"][1]) - curr_cl.start
-                        lg = curr_cl.stop > d["range"][1]
-                        directions.append({
-                            "dir": d["dir"],
-                            "range": (start, start + n)
-                        })
-                        start += n
-                        if lg:
-                            curr_cl = slice(d["range"][1], curr_cl.stop)
-                        else:
-                            break
-
-            dd = [directions[0]]
-            for d in directions[1:]:
-                if dd[-1]["dir"] == d["dir"]:
-                    dd[-1]["range"] = (
-                        dd[-1]["range"][0],
-                        d["range"][1]
-                    )
-                else:
-                    dd.append(d)
-
-            metadata.directions = dd
-
-            metadata.n = b0_vols.shape[-1]
+            metadata.select(b0_mask)
 
         if mean is B0PostProcess.whole:
-            b0_vols = np.mean(b0_vols, axis=-1)[..., None]
+            b0_vols = np.mean(b0_vols, axis=-1, dtype=np.float64)[..., None]
 
             if metadata:
-                metadata.n = 1
-                metadata.acquisition_types = [metadata.acquisition_types[0]]
-                metadata.acquisition_slices = [[0, None]]
-                metadata.directions = [{
-                    "dir": metadata.directions[0]["dir"],
-                    "range": (0, 1)
-                }]
+                metadata.select([0])
 
     return b0_vols.astype(dtype)
 
@@ -152,209 +102,166 @@ def squash_b0(
     dwi_img, bvals, bvecs, mean=B0PostProcess.batch,
     ceil=0.9, b0_comp=np.less_equal, metadata=None, dtype=None
 ):
-    b0_mask = b0_comp(bvals, ceil)
-    mask = np.ma.masked_array(b0_mask)
-    mask[~b0_mask] = np.ma.masked
-
-    b0_clusters = list(np.ma.notmasked_contiguous(mask, axis=0))
-    dwi_clusters = list(np.ma.clump_masked(mask))
+    b0_mask = np.asarray(b0_comp(bvals, ceil))
+    starts, stops = _clusters_bounds(b0_mask)
 
     dtype = dtype if dtype else dwi_img.get_data_dtype()
 
     if mean is B0PostProcess.whole:
         if np.sum(b0_mask) == 1:
             return (dwi_img.get_fdata().astype(dtype), bvals, bvecs)
-        else:
-            meta_b0 = metadata.copy() if metadata else None
-            output = np.zeros(dwi_img.shape[:3] + (1 + np.sum(~b0_mask),))
-            output[..., 0] = extract_b0(
-                dwi_img, bvals, mean=mean, ceil=ceil,
-                b0_comp=b0_comp, metadata=meta_b0, dtype=dtype
-            )
 
-            if metadata:
-                for cl in b0_clusters:
-                    curr_cl = deepcopy(cl)
-                    for i, d in enumerate(metadata.directions):
-                        if d["range"][1] > curr_cl.start >= d["range"][0]:
-                            n = min(curr_cl.stop, d["range"][1]) - curr_cl.start
-                            lg = curr_cl.stop > d["range"][1]
-                            d["range"] = (d["range"][0], d["range"][1] - n)
-                            if lg:
-                                curr_cl = slice(d["range"][1], curr_cl.stop)
-                            else:
-                                break
-
-                acquisition = metadata.acquisition_slices_to_list()
-                metadata.update_acquisition_from_list(
-                    (np.array(acquisition)[~b0_mask]).tolist()
-                )
-
-                metadata.n = int(np.sum(~b0_mask))
-
-                meta_b0.extend(metadata)
-                metadata.becomes(meta_b0)
-
-            idx = 1
-            for cluster in dwi_clusters:
-                len_cluster = cluster.stop - cluster.start
-                output[..., idx:idx + len_cluster] = dwi_img.dataobj[..., cluster]
-                idx += len_cluster
-
-            ret_tuple = (
-                output.astype(dtype), np.hstack(([0], bvals[~b0_mask]))[None, :]
-            )
-
-            if bvecs is not None:
-                ret_tuple += (np.hstack(([[0], [0], [0]], bvecs[:, ~b0_mask])),)
-            else:
-                ret_tuple += (None,)
-
-            return ret_tuple
-    elif all(cl.stop - cl.start == 1 for cl in b0_clusters):
-        return (dwi_img.get_fdata().astype(dtype), bvals, bvecs)
-
-    if metadata:
-        for cl in b0_clusters:
-            curr_cl = deepcopy(cl)
-            lg = False
-            for i, d in enumerate(metadata.directions):
-                if d["range"][1] > curr_cl.start >= d["range"][0]:
-                    n = min(curr_cl.stop, d["range"][1]) - curr_cl.start
-                    if not lg:
-                        n -= 1
-                    lg = curr_cl.stop > d["range"][1]
-                    d["range"] = (d["range"][0], d["range"][1] - n)
-                    if lg:
-                        curr_cl = slice(d["range"][1], curr_cl.stop)
-                    else:
-                        break
-
-        mb_mask = b0_mask[:dwi_img.shape[-1]].copy()
-        for cluster in b0_clusters:
-            mb_mask[cluster.start] = False
-
-        acquisition = metadata.acquisition_slices_to_list()
-        metadata.update_acquisition_from_list(
-            (np.array(acquisition)[~mb_mask]).tolist()
+        data = np.asanyarray(dwi_img.dataobj)
+        output = np.empty(
+            dwi_img.shape[:3] + (1 + np.sum(~b0_mask),), dtype=dtype
         )
+        output[..., 0] = np.mean(
+            data[..., b0_mask], axis=-1, dtype=np.float64
+        )
+        output[..., 1:] = data[..., ~b0_mask]
 
-        metadata.n = int(np.sum(~b0_mask) + len(b0_clusters))
-
-    output_shape = dwi_img.shape[:-1] + (
-        dwi_img.shape[-1] + len(b0_clusters) - np.sum(b0_mask),
-    )
+        if metadata:
+            meta_b0 = metadata.copy()
+            meta_b0.select(starts[:1])
+            metadata.select(~b0_mask)
 
-    data = np.zeros(output_shape)
-    out_bvals = []
-    out_bvecs = []
+            meta_b0.extend(metadata, dwi_img.shape)
+            metadata.becomes(meta_b0)
 
-    if mean is B0PostProcess.none:
-        b0_extractor = lambda cluster: cluster[..., 0]
-    else:
-        b0_extractor = lambda cluster: np.mean(cluster, axis=-1)
+        ret_tuple = (
+            output, np.hstack(([0], bvals[~b0_mask]))[None, :]
+        )
 
-    if len(dwi_clusters) > len(b0_clusters):
-        data[..., dwi_clusters[0]] = dwi_img.dataobj[..., dwi_clusters[0]]
-        out_bvals += bvals[dwi_clusters[0]].tolist()
         if bvecs is not None:
-            out_bvecs += bvecs[:, dwi_clusters[0]].T.tolist()
-        dwi_clusters = dwi_clusters[1:]
+            ret_tuple += (np.hstack(([[0], [0], [0]], bvecs[:, ~b0_mask])),)
+        else:
+            ret_tuple += (None,)
 
-    shape_reduce = 0
-    for i in range(len(dwi_clusters)):
-        data[..., b0_clusters[i].start - shape_reduce] = b0_extractor(
-            dwi_img.dataobj[..., b0_clusters[i]]
-        )
-        out_bvals.append(0)
-        if bvecs is not None:
-            out_bvecs.append([0, 0, 0])
-        shape_reduce += b0_clusters[i].stop - b0_clusters[i].start - 1
-        data_slice = slice(
-            dwi_clusters[i].start - shape_reduce,
-            dwi_clusters[i].stop - shape_reduce
+        return ret_tuple
+    elif np.all(stops - starts == 1):
+        return (dwi_img.get_fdata().astype(dtype), bvals, bvecs)
+
+    # Each b0 cluster is squashed to the position of its first volume
+    keep = ~b0_mask
+    keep[starts] = True
+    keep_idxs = np.flatnonzero(keep)
+    b0_positions = np.searchsorted(keep_idxs, starts)
+
+    if metadata:
+        metadata.select(keep)
+
+    data = np.asanyarray(dwi_img.dataobj)
+    output = data[..., keep_idxs].astype(dtype)
+    if mean is not B0PostProcess.none:
+        output[..., b0_positions] = _cluster_means(
+            data[..., b0_mask], stops - starts
         )
-        data[..., data_slice] = dwi_img.dataobj[..., dwi_clusters[i]]
-        out_bvals += bvals[dwi_clusters[i]].tolist()
-        if bvecs is not None:
-            out_bvecs += bvecs[:, dwi_clusters[i]].T.tolist()
 
-    if len(b0_clusters) > len(dwi_clusters):
-        data[..., -1] = b0_extractor(dwi_img.dataobj[..., b0_clusters[-1]])
-        out_bvals.append(0)
-        if bvecs is not None:
-            out_bvecs.append([0, 0, 0])
+    out_bvals = np.array(bvals, dtype=float)[keep_idxs]
+    out_bvals[b0_positions] = 0
 
-    return (
-        data.astype(dtype),
-        np.array(out_bvals)[None, ...],
-        np.array(out_bvecs).T if bvecs is not None else None
-    )
+    out_bvecs = None
+    if bvecs is not None:
+        out_bvecs = np.array(bvecs, dtype=float)[:, keep_idxs]
+        out_bvecs[:, b0_positions] = 0
 
+    return output, out_bvals[None, ...], out_bvecs
 
-def normalize_to_b0(
-    data, bvals, mean=B0PostProcess.batch,
+
+def b0_normalization_scales(
+    volume_means, bvals, mean=B0PostProcess.batch,
     ref_strategy=B0Reference.linear, ref_mean=None,
     ceil=0.9, b0_comp=np.less_equal
 ):
-    reference_last = ref_strategy == B0Reference.last
-
-    if reference_last:
-        data = data[..., ::-1]
-        bvals = bvals[::-1]
-        ref_strategy = B0Reference.first
+    """
+    Per-volume scaling bringing every b0 cluster, and the dwi volumes
+    they surround, to the mean of the reference b0 cluster.
+    """
+    volume_means = np.asarray(volume_means, dtype=float)
+    bvals = np.asarray(bvals)
+
+    if ref_strategy == B0Reference.last:
+        scales, ref_mean = b0_normalization_scales(
+            volume_means[::-1], bvals[::-1], mean, B0Reference.first,
+            ref_mean, ceil, b0_comp
+        )
+        return scales[::-1], ref_mean
 
     b0_mask = b0_comp(bvals, ceil)
-    mask = np.ma.masked_array(b0_mask)
-    mask[~b0_mask] = np.ma.masked
+    b0_starts, b0_stops = _clusters_bounds(b0_mask)
+    dwi_starts, dwi_stops = _clusters_bounds(~b0_mask)
 
-    b0_clusters = list(np.ma.notmasked_contiguous(mask, axis=0))
-    dwi_clusters = list(np.ma.clump_masked(mask))
+    cumsum = np.concatenate(([0.], np.cumsum(volume_means)))
+    cluster_means = (cumsum[b0_stops] - cumsum[b0_starts]) / \
+        (b0_stops - b0_starts)
 
     if ref_mean is None:
-        ref_mean = np.mean(data[..., b0_clusters[0]])
+        ref_mean = cluster_means[0]
 
-    if not b0_comp(bvals[0], ceil):
-        dwi_clusters = dwi_clusters[1:]
-    if not b0_comp(bvals[-1], ceil):
-        if mean == B0PostProcess.batch:
-            mean_val = np.mean(data[..., b0_clusters[-1]])
-        else:
-            mean_val = np.mean(data[..., b0_clusters[-1].start])
+    def _ratio(means):
+        means = np.asarray(means, dtype=float)
+        return np.where(
+            np.isclose(means, 0.), 1., ref_mean / np.where(means, means, 1.)
+        )
 
-        if not np.isclose(mean_val, 0):
-            data[..., dwi_clusters[-1]] *= ref_mean / mean_val
+    if mean == B0PostProcess.batch:
+        mean_before, mean_after = cluster_means, cluster_means
+        mean_last = cluster_means[-1]
+    else:
+        mean_before, mean_after = volume_means[b0_stops - 1], \
+            volume_means[b0_starts]
+        mean_last = volume_means[b0_starts[-1]]
+
+    idxs = np.arange(len(bvals))
+    scales = np.ones((len(bvals),))
+
+    # Diffusion volumes, between the b0 clusters surrounding them. Those
+    # before the first b0 cluster are left untouched
+    before = np.searchsorted(b0_stops, idxs, side="right") - 1
+    cluster = np.clip(
+        np.searchsorted(dwi_starts, idxs, side="right") - 1, 0, None
+    )
+    interior = ~b0_mask & (before >= 0) & (before < len(b0_starts) - 1)
 
-        dwi_clusters = dwi_clusters[:-1]
+    _before = np.clip(before, 0, len(b0_starts) - 1)
+    modif = mean_before[_before]
+    if ref_strategy == B0Reference.linear and len(dwi_starts) > 0:
+        length = dwi_stops[cluster] - dwi_starts[cluster]
+        weight = (idxs - dwi_starts[cluster]) / np.maximum(length - 1., 1.)
+        modif = weight * mean_after[np.clip(
+            _before + 1, 0, len(b0_starts) - 1
+        )] + (1. - weight) * modif
 
-    for i in range(len(dwi_clusters)):
-        len_cl = dwi_clusters[i].stop - dwi_clusters[i].start
+    scales[interior] = _ratio(modif[interior])
+    scales[~b0_mask & (before == len(b0_starts) - 1)] = _ratio(mean_last)
+
+    b0_cluster = np.searchsorted(b0_starts, idxs[b0_mask], side="right") - 1
+    scales[b0_mask] = _ratio(cluster_means[b0_cluster])
+
+    return scales, ref_mean
 
-        if mean == B0PostProcess.batch:
-            mean_val = np.mean(data[..., b0_clusters[i]])
-        else:
-            mean_val = np.mean(data[..., b0_clusters[i].stop - 1])
-
-        if ref_strategy == B0Reference.linear:
-            weight = np.arange(len_cl).astype(float) / (len_cl - 1.)
-            if mean == B0PostProcess.batch:
-                mean_val_p1 = np.mean(data[..., b0_clusters[i + 1]])
-            else:
-                mean_val_p1 = np.mean(data[..., b0_clusters[i + 1].start])
-            modif = weight * mean_val_p1 + (1. - weight) * mean_val
-        else:
-            modif = mean_val
 
-        for mod, cl in zip(modif, dwi_clusters[i]):
-            if not np.isclose(mod, 0.):
-                data[..., cl] *= ref_mean / mod
+def normalize_to_b0(
+    data, bvals, mean=B0PostProcess.batch,
+    ref_strategy=B0Reference.linear, ref_mean=None,
+    ceil=0.9, b0_comp=np.less_equal, dtype=None, block_size=16
+):
+    # First pass, means of every volume at the data native type
+    volume_means = np.mean(
+        data, axis=tuple(range(data.ndim - 1)), dtype=np.float64
+    )
+    scales, ref_mean = b0_normalization_scales(
+        volume_means, bvals, mean, ref_strategy, ref_mean, ceil, b0_comp
+    )
 
-    for i in range(len(b0_clusters)):
-        mean_cluster = np.mean(data[..., b0_clusters[i]])
-        if not np.isclose(mean_cluster, 0.):
-            data[..., b0_clusters[i]] *= ref_mean / mean_cluster
+    if dtype is None:
+        dtype = data.dtype if np.issubdtype(data.dtype, np.floating) \
+            else np.float64
 
-    if reference_last:
-        data = data[..., ::-1]
+    # Second pass, volumes are scaled by blocks into the output
+    output = np.empty(data.shape, dtype=dtype)
+    for start in range(0, data.shape[-1], block_size):
+        block = slice(start, start + block_size)
+        output[..., block] = data[..., block] * scales[block]
 
-    return data, ref_mean
+    return output, ref_mean
@@ -1,4 +1,9 @@
+from bisect import bisect_left, insort
+
 import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
 
 
 # FROM SCILPY
@@ -31,36 +36,53 @@ def identify_shells(bvals, threshold=40.0, roundCentroids=False, sort=False):
     shell_indices: array (N,)
         For each bval, the associated centroid K.
     """
+    bvals = np.asarray(bvals)
     if len(bvals) == 0:
         raise ValueError('Empty b-values.')
 
-    # Finding centroids
-    bval_centroids = [bvals[0]]
-    for bval in bvals[1:]:
-        diffs = np.abs(np.asarray(bval_centroids, dtype=float) - bval)
-        if not len(np.where(diffs < threshold)[0]):
+    # Finding centroids. Repeated b-values never open a new shell, so only
+    # the distinct values are visited, in order of first occurrence
+    if threshold > 0:
+        values, first = np.unique(bvals, return_index=True)
+        candidates = values[np.argsort(first)]
+    else:
+        candidates = bvals
+
+    bval_centroids, sorted_centroids = [], []
+    for bval in candidates:
+        pos = bisect_left(sorted_centroids, bval)
+        if not any(
+            abs(float(sorted_centroids[k]) - bval) < threshold
+            for k in (pos - 1, pos) if 0 <= k < len(sorted_centroids)
+        ):
             # Found no bval in bval centroids close enough to the current one.
             # Create new centroid (i.e. new shell)
             bval_centroids.append(bval)
+            insort(sorted_centroids, bval)
     centroids = np.array(bval_centroids)
 
-    # Identifying shells
-    bvals_for_diffs = np.tile(bvals.reshape(bvals.shape[0], 1),
-                              (1, centroids.shape[0]))
+    # Identifying shells, from the two closest centroids of each b-value.
+    # Ties go to the first centroid found, as with an argmin over centroids
+    order = np.argsort(centroids, kind="stable")
+    ordered = centroids[order]
+    right = np.clip(np.searchsorted(ordered, bvals), 0, len(ordered) - 1)
+    left = np.searchsorted(ordered, ordered[np.maximum(right - 1, 0)])
 
-    shell_indices = np.argmin(np.abs(bvals_for_diffs - centroids), axis=1)
+    d_left = np.abs(bvals - ordered[left].astype(float))
+    d_right = np.abs(bvals - ordered[right].astype(float))
+    shell_indices = np.where(
+        (d_left < d_right) |
+        ((d_left == d_right) & (order[left] < order[right])),
+        order[left], order[right]
+    )
 
     if roundCentroids:
         centroids = np.round(centroids, decimals=-1)
 
     if sort:
         sort_index = np.argsort(centroids)
-        sorted_centroids = np.zeros(centroids.shape)
-        sorted_indices = np.zeros(shell_indices.shape)
-        for i in range(len(centroids)):
-            sorted_centroids[i] = centroids[sort_index[i]]
-            sorted_indices[shell_indices == i] = sort_index[i]
-        return sorted_centroids, sorted_indices
+        return centroids[sort_index].astype(float), \
+            sort_index[shell_indices].astype(float)
 
     return centroids, shell_indices
 
@@ -70,3 +92,43 @@ def sh_order_from(n, full_basis=False):
         return max(int(np.floor(np.sqrt(n) - 1)), 0)
 
     return 2 * int(int(-3 + 0.5 * np.sqrt(1 + 8 * n)) / 2)
+
+
+def group_duplicated_directions(bvals, bvecs, b0_threshold, threshold=1E-5):
+    """
+    Groups of volumes sharing a b-value and a direction, up to its sign,
+    with 1 - |u . v| under the threshold. Returns, for each volume, the
+    index of its group, groups being numbered by their first volume.
+    """
+    bvals, bvecs = np.asarray(bvals), np.asarray(bvecs, dtype=float)
+    norms = np.linalg.norm(bvecs, axis=1, keepdims=True)
+    bvecs = np.divide(bvecs, norms, out=np.zeros_like(bvecs), where=norms > 0)
+
+    # Between unit vectors, |u - v| ** 2 = 2 (1 - u . v)
+    radius = np.sqrt(2. * threshold)
+    rows, cols = [], []
+    dwi_mask = bvals > b0_threshold
+    for bval in np.unique(bvals[dwi_mask]):
+        idxs = np.where(dwi_mask & (bvals == bval))[0]
+        if len(idxs) < 2:
+            continue
+
+        # Antipodal directions are matched by indexing both signs
+        tree = cKDTree(np.vstack((bvecs[idxs], -bvecs[idxs])))
+        pairs = tree.query_pairs(radius, output_type="ndarray") % len(idxs)
+        pairs = pairs[pairs[:, 0] != pairs[:, 1]]
+        rows.append(idxs[pairs[:, 0]])
+        cols.append(idxs[pairs[:, 1]])
+
+    n = len(bvals)
+    rows = np.concatenate(rows + [np.zeros((0,), dtype=int)])
+    cols = np.concatenate(cols + [np.zeros((0,), dtype=int)])
+    _, labels = connected_components(
+        coo_matrix((np.ones(len(rows)), (rows, cols)), shape=(n, n)),
+        directed=False
+    )
+
+    _, first, inverse = np.unique(
+        labels, return_index=True, return_inverse=True
+    )
+    return np.argsort(np.argsort(first))[inverse]
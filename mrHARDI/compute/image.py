@@ -1,15 +1,21 @@
-from os import getcwd
+from os import getcwd, replace
 from os.path import basename, join
+from shutil import copyfile, copyfileobj
+
 import nibabel as nib
+from nibabel.openers import Opener
 import numpy as np
+from scipy.ndimage import affine_transform, center_of_mass
 
 from mrHARDI.base.shell import launch_shell_process
 from mrHARDI.base.utils import if_join_str, split_ext
-from mrHARDI.compute.math.stats import center_of_mass_difference
+from mrHARDI.compute.math.linalg import homo_vec
+from mrHARDI.compute.math.stats import mutual_information
+from mrHARDI.compute.transforms import (TransformChain,
+                                        load_transform,
+                                        save_transform)
 from mrHARDI.compute.utils import (compute_reorientation_to_frame,
-                                   compute_reorientation_to_image,
-                                   load_transform,
-                                   save_transform)
+                                   compute_reorientation_to_image)
 
 
 def get_common_spacing(img_list, vote=min):
@@ -21,6 +27,69 @@ def get_common_spacing(img_list, vote=min):
     return vote(spacing)
 
 
+def rewrite_affine(fname, matrix, out_fname=None):
+    if out_fname is None:
+        out_fname = fname
+
+    img = nib.load(fname)
+    header = img.header.copy()
+    header.set_data_offset(img.dataobj.offset)
+
+    sform, sform_code = header.get_sform(coded=True)
+    qform, qform_code = header.get_qform(coded=True)
+    if sform_code == 0 and qform_code == 0:
+        header.set_sform(matrix @ header.get_best_affine(), code=2)
+    else:
+        if sform_code > 0:
+            header.set_sform(matrix @ sform, code=int(sform_code))
+        if qform_code > 0:
+            header.set_qform(matrix @ qform, code=int(qform_code))
+
+    # Only the header block changes, voxel data is either left in place
+    # or streamed through without being decoded
+    block = header.binaryblock
+    if not (fname.endswith(".gz") or out_fname.endswith(".gz")):
+        if out_fname != fname:
+            copyfile(fname, out_fname)
+        with open(out_fname, "r+b") as f:
+            f.write(block)
+        return out_fname
+
+    tmp_fname = "{}.tmp{}".format(out_fname, ".gz" if out_fname.endswith(
+        ".gz"
+    ) else "")
+    with Opener(fname, "rb") as src, Opener(tmp_fname, "wb") as dst:
+        src.read(len(block))
+        dst.write(block)
+        copyfileobj(src, dst, 1 << 24)
+
+    replace(tmp_fname, out_fname)
+    return out_fname
+
+
+def world_center_of_mass(fname):
+    img = nib.load(fname)
+    return (img.affine @ homo_vec(center_of_mass(img.get_fdata())))[:3]
+
+
+def image_similarity(
+    ref_fname, moving_fname, moving_to_ref=np.eye(4), bins=32
+):
+    ref_img, moving_img = nib.load(ref_fname), nib.load(moving_fname)
+    ref_data = ref_img.get_fdata()
+
+    vox_to_vox = np.linalg.inv(moving_to_ref @ moving_img.affine) @ \
+        ref_img.affine
+    moved_data = affine_transform(
+        moving_img.get_fdata(), vox_to_vox[:3, :3], vox_to_vox[:3, 3],
+        output_shape=ref_data.shape, order=1
+    )
+
+    return mutual_information(
+        ref_data, moved_data, bins, (ref_data > 0) | (moved_data > 0)
+    )
+
+
 def transform_images(
     images, transform_fname, suffix=None, base_dir=None, mask=None
 ):
@@ -34,16 +103,11 @@ def transform_images(
             if_join_str([basename(name), suffix], "_"), ext
         )))
 
-        img = nib.load(image)
-        img_ornt = nib.io_orientation(img.affine)
-        transform = load_transform(transform_fname, img_ornt)
-
-        img = nib.Nifti1Image(
-            img.get_fdata(), transform @ img.affine, img.header
+        img_ornt = nib.io_orientation(nib.load(image).affine)
+        rewrite_affine(
+            image, load_transform(transform_fname, img_ornt), names[-1]
         )
 
-        nib.save(img, names[-1])
-
     out_mask = None
     if mask is not None:
         name, ext = split_ext(mask, r"^(/?.*)\.(nii\.gz|nii)$")
@@ -51,57 +115,65 @@ def transform_images(
             if_join_str([basename(name), suffix], "_"), ext
         ))
 
-        img = nib.load(mask)
-        img_ornt = nib.io_orientation(img.affine)
-        transform = load_transform(transform_fname, img_ornt)
-
-        img = nib.Nifti1Image(
-            img.get_fdata(), transform @ img.affine, img.header
+        img_ornt = nib.io_orientation(nib.load(mask).affine)
+        rewrite_affine(
+            mask, load_transform(transform_fname, img_ornt), out_mask
         )
 
-        nib.save(img, out_mask)
-
     return names, out_mask
 
 
+def _cropped_center_of_mass(img, mask_img=None, step=2):
+    if mask_img is not None:
+        mask = np.asanyarray(mask_img.dataobj).astype(bool)
+        mask = mask.reshape(mask.shape[:3] + (-1,)).any(-1)
+    else:
+        mask = np.ones(img.shape[:3], dtype=bool)
+
+    if not mask.any():
+        return (np.array(mask.shape) - 1.) / 2.
+
+    lower, upper = [], []
+    for axis in range(3):
+        _nz = np.flatnonzero(mask.any(tuple(a for a in range(3) if a != axis)))
+        lower.append(_nz[0])
+        upper.append(_nz[-1] + 1)
+
+    view = tuple(slice(lo, up, step) for lo, up in zip(lower, upper))
+    data = np.asanyarray(
+        img.dataobj[view + (0,) * (len(img.shape) - 3)]
+    ).astype(float)
+    data[~mask[view]] = 0.
+
+    return np.array(lower) + step * np.array(center_of_mass(data))
+
+
 def align_by_center_of_mass(
     ref_fname, moving_fnames, out_mat_fname,
     ref_mask_fname=None, moving_mask_fname=None,
-    align_mask_fnames=None, suffix=None, base_dir=None
+    align_mask_fnames=None, suffix=None, base_dir=None, step=2
 ):
     if base_dir is None:
         base_dir = getcwd()
 
     ref_img, main_img = nib.load(ref_fname), nib.load(moving_fnames[0])
-    if ref_mask_fname:
-        ref_mask = nib.load(ref_mask_fname).get_fdata().astype(bool)
-    else:
-        ref_mask = np.ones(ref_img.shape, dtype=bool)
-
-    if moving_mask_fname:
-        mov_mask = nib.load(moving_mask_fname).get_fdata().astype(bool)
-    else:
-        mov_mask = np.ones(main_img.shape, dtype=bool)
+    ref_mask = nib.load(ref_mask_fname) if ref_mask_fname else None
+    mov_mask = nib.load(moving_mask_fname) if moving_mask_fname else None
 
     main_to_ref = np.linalg.inv(ref_img.affine) @ \
         compute_reorientation_to_image(main_img, ref_img) @ main_img.affine
 
-    ref_data = ref_img.get_fdata().astype(ref_img.get_data_dtype())
-    main_data = main_img.get_fdata().astype(main_img.get_data_dtype())
-    ref_data[~ref_mask] = 0
-    main_data[~mov_mask] = 0
-
-    trans = center_of_mass_difference(
-        ref_data, main_data, main_to_ref, ref_img.header.get_zooms()[:3]
-    )
+    ref_cm = _cropped_center_of_mass(ref_img, ref_mask, step)
+    main_cm = _cropped_center_of_mass(main_img, mov_mask, step)
+    trans = (ref_cm - (main_to_ref @ homo_vec(main_cm))[:3]) * \
+        np.array(ref_img.header.get_zooms()[:3])
 
     out_files = []
-    for fname in moving_fnames:
+    for fname in moving_fnames + (align_mask_fnames or []):
         img = nib.load(fname)
-        _t = compute_reorientation_to_image(ref_img, img)
-
-        affine = img.affine
-        affine[:3, 3] += _t[:3, :3] @ trans
+        _m = np.eye(4)
+        _m[:3, 3] = compute_reorientation_to_image(ref_img, img)[:3, :3] @ \
+            trans
 
         # Get extension, which can either be .nii or .nii.gz
         name, ext = split_ext(fname, r"^(/?.*)\.(nii\.gz|nii)$")
@@ -109,28 +181,7 @@ def align_by_center_of_mass(
             if_join_str([basename(name), suffix], "_"), ext
         )))
 
-        nib.save(
-            nib.Nifti1Image(img.get_fdata(), affine, img.header),
-            out_files[-1]
-        )
-
-    if align_mask_fnames is not None:
-        for fname in align_mask_fnames:
-            img = nib.load(fname)
-            _t = compute_reorientation_to_image(ref_img, img)
-
-            affine = img.affine
-            affine[:-1, 3] += _t[:3, :3] @ trans
-
-            name, ext = split_ext(fname, r"^(/?.*)\.(nii\.gz|nii)$")
-            out_files.append(join(base_dir, "{}.{}".format(
-                if_join_str([basename(name), suffix], "_"), ext
-            )))
-
-            nib.save(
-                nib.Nifti1Image(img.get_fdata(), affine, img.header),
-                out_files[-1]
-            )
+        rewrite_affine(fname, _m, out_files[-1])
 
     _m = np.eye(4)
     _m[:3, 3] = trans
@@ -144,6 +195,14 @@ def align_by_center_of_mass(
 def merge_transforms(
     out_transform, log_file, *transforms, additional_env=None
 ):
+    if len(transforms) == 0:
+        raise ValueError("No transform given to merge")
+
+    chain = TransformChain.from_files(transforms[::-1])
+    if chain.linear:
+        chain.collapse().transforms[0].save(out_transform)
+        return
+
     cmd = "antsApplyTransforms {} -o Linear[{},0]".format(
         " ".join("-t {}".format(t) for t in transforms[::-1]),
         out_transform
@@ -1,6 +1,5 @@
-from numpy import (allclose,
+from numpy import (all as npall,
                    append,
-                   apply_along_axis,
                    isclose,
                    mean,
                    moveaxis,
@@ -11,8 +10,8 @@ from numpy import (allclose,
 
 
 def _fa(evals, axis=0):
-    fa_mask = apply_along_axis(lambda e: not allclose(e, 0), axis, evals)
-    fa = zeros(evals.shape[:-1])
+    fa_mask = ~npall(isclose(evals, 0.), axis)
+    fa = zeros(evals.shape[:-1], dtype=evals.dtype)
 
     var = std(evals[fa_mask], axis) ** 2.
     mn2 = mean(evals[fa_mask], axis) ** 2.
@@ -38,46 +37,50 @@ def homo_vec(_v, _d=4):
     return append(_v, [1.]) if len(_v) < _d else _v
 
 
-def compute_fa(eigs, mask):
-    evals, _ = eigs
-
-    fa_map = zeros(mask.shape)
-    fa_map[mask] = _fa(evals[mask], 1)
-
-    return fa_map
+_DTI_SCALARS = {
+    "fa": lambda evals: _fa(evals, 1),
+    "md": lambda evals: mean(evals, 1),
+    "ad": lambda evals: evals[..., 0],
+    "rd": lambda evals: mean(evals[..., 1:], axis=1)
+}
 
 
-def compute_md(eigs, mask):
+def compute_dti_scalars(eigs, mask, metrics=tuple(_DTI_SCALARS)):
+    """
+    Scalar maps of the eigenvalues, computed for all requested metrics
+    from a single extraction of the masked eigenvalues.
+    """
     evals, _ = eigs
+    masked_evals = evals[mask]
 
-    md_map = zeros(mask.shape)
-    md_map[mask] = mean(evals[mask], 1)
+    maps = {}
+    for metric in metrics:
+        maps[metric] = zeros(mask.shape, dtype=evals.dtype)
+        maps[metric][mask] = _DTI_SCALARS[metric](masked_evals)
 
-    return md_map
+    return maps
 
 
-def compute_ad(eigs, mask):
-    evals, _ = eigs
+def compute_fa(eigs, mask):
+    return compute_dti_scalars(eigs, mask, ("fa",))["fa"]
 
-    ad_map = zeros(mask.shape)
-    ad_map[mask] = evals[mask][..., 0]
 
-    return ad_map
+def compute_md(eigs, mask):
+    return compute_dti_scalars(eigs, mask, ("md",))["md"]
 
 
-def compute_rd(eigs, mask):
-    evals, _ = eigs
+def compute_ad(eigs, mask):
+    return compute_dti_scalars(eigs, mask, ("ad",))["ad"]
 
-    rd_map = zeros(mask.shape)
-    rd_map[mask] = mean(evals[mask][..., 1:], axis=1)
 
-    return rd_map
+def compute_rd(eigs, mask):
+    return compute_dti_scalars(eigs, mask, ("rd",))["rd"]
 
 
 def compute_peaks(eigs, mask):
     _, evecs = eigs
 
-    peaks = zeros((5,) + mask.shape + (3,))
+    peaks = zeros((5,) + mask.shape + (3,), dtype=evecs.dtype)
     peaks[0, mask] = evecs[mask, 0, :]
 
     return moveaxis(peaks, 0, -2).reshape(mask.shape + (15,))
@@ -86,6 +89,6 @@ def compute_peaks(eigs, mask):
 def color(metric, evecs, mask=None):
     if mask is None:
         mask = ones(metric.shape[:3]).astype(bool)
-    cmetric = zeros(metric.shape[:3] + (3,))
+    cmetric = zeros(metric.shape[:3] + (3,), dtype=metric.dtype)
     cmetric[mask] = absolute(metric[mask, None] * evecs[mask, 0, :])
     return cmetric
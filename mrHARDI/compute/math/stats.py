@@ -12,3 +12,39 @@ def center_of_mass_difference(
     _cm2in1 = (_aff2to1 @ homo_vec(center_of_mass(_arr2)))[:3]
 
     return (_cm1 - _cm2in1) * _spacing
+
+
+def mutual_information(_arr1, _arr2, bins=32, _mask=None):
+    if _mask is not None:
+        _arr1, _arr2 = _arr1[_mask], _arr2[_mask]
+
+    _joint, _, _ = np.histogram2d(_arr1.ravel(), _arr2.ravel(), bins=bins)
+    _joint /= max(_joint.sum(), 1.)
+    _marginals = np.outer(_joint.sum(1), _joint.sum(0))
+
+    _nz = _joint > 0
+    return np.sum(_joint[_nz] * np.log(_joint[_nz] / _marginals[_nz]))
+
+
+def weighted_moments(values, weights, moments=("mean", "second", "variance")):
+    """
+    Moments of values weighted along their first axis (fractions are not
+    normalized). Weights broadcast over the trailing dimensions of values
+    and products are accumulated one row at a time, so no copy of the
+    weights is made. The variance is the second moment minus the squared
+    mean.
+    """
+    weights = weights.reshape(
+        weights.shape + (1,) * (values.ndim - weights.ndim)
+    )
+
+    dtype = np.result_type(values.dtype, weights.dtype)
+    mean = np.zeros(values.shape[1:], dtype=dtype)
+    second = np.zeros(values.shape[1:], dtype=dtype)
+    for _w, _v in zip(weights, values):
+        _wv = _w * _v
+        mean += _wv
+        second += _wv * _v
+
+    results = {"mean": mean, "second": second, "variance": second - mean ** 2.}
+    return [results[m] for m in moments]
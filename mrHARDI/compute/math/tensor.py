@@ -1,15 +1,25 @@
-from functools import partial
-
-from numpy import (apply_along_axis,
-                   diag,
+from numpy import (arccos,
+                   array,
+                   clip,
+                   cos,
+                   cross,
+                   empty,
                    eye,
+                   finfo,
                    flip,
                    isclose,
-                   trace,
-                   zeros,
-                   moveaxis)
+                   maximum,
+                   moveaxis,
+                   pi,
+                   sqrt,
+                   stack,
+                   take_along_axis,
+                   where,
+                   zeros)
+from numpy.linalg import eigh, norm
+
 
-from numpy.linalg import eigh
+_TENSOR_INDEXES = ((0, 1, 3), (1, 2, 4), (3, 4, 5))
 
 
 def vec_to_tens(dt, convention=(0, 1, 2, 3, 4, 5)):
@@ -21,51 +31,137 @@ def vec_to_tens(dt, convention=(0, 1, 2, 3, 4, 5)):
     ]
 
 
-def compute_eigenvalues(
-    tensors, mask, convention=(0, 1, 2, 3, 4, 5), reorder=True
-):
-    vtt = partial(vec_to_tens, convention=convention)
-    evals, evecs = zeros(mask.shape + (3,)), zeros(mask.shape + (3, 3))
-    evals[mask], evecs[mask] = eigh(
-        apply_along_axis(vtt, 1, tensors[mask])
+def vec_to_tens_field(tensors, convention=(0, 1, 2, 3, 4, 5)):
+    return tensors[..., array(convention)[array(_TENSOR_INDEXES)]]
+
+
+def _eigenvector(tensors, evals):
+    rows = tensors - evals[..., None, None] * eye(3, dtype=tensors.dtype)
+    candidates = stack([
+        cross(rows[..., 0, :], rows[..., 1, :]),
+        cross(rows[..., 0, :], rows[..., 2, :]),
+        cross(rows[..., 1, :], rows[..., 2, :])
+    ], axis=-2)
+
+    norms = norm(candidates, axis=-1)
+    best = norms.argmax(-1)[..., None]
+    vec = take_along_axis(candidates, best[..., None], -2)[..., 0, :]
+    vec_norm = take_along_axis(norms, best, -1)
+
+    return vec / maximum(vec_norm, 1E-30), vec_norm[..., 0]
+
+
+def analytic_eigh(tensors, tol=None):
+    """
+    Closed-form eigen decomposition of symmetric 3x3 matrices, ordered as
+    numpy.linalg.eigh (ascending eigenvalues, eigenvectors in columns).
+    Eigenvalues are obtained from the trigonometric solution of the
+    characteristic polynomial (Smith, 1961), the eigenvectors of the two
+    extremal eigenvalues from cross products of the rows of the shifted
+    matrices. Matrices with nearly degenerate spectra fall back on eigh,
+    the default tolerance being the cubic root of the precision epsilon.
+    """
+    if tol is None:
+        tol = finfo(tensors.dtype).eps ** (1. / 3.)
+
+    a00, a11, a22 = tensors[..., 0, 0], tensors[..., 1, 1], tensors[..., 2, 2]
+    a01, a02, a12 = tensors[..., 0, 1], tensors[..., 0, 2], tensors[..., 1, 2]
+
+    q = (a00 + a11 + a22) / 3.
+    b00, b11, b22 = a00 - q, a11 - q, a22 - q
+    p = sqrt(
+        (b00 ** 2. + b11 ** 2. + b22 ** 2. +
+         2. * (a01 ** 2. + a02 ** 2. + a12 ** 2.)) / 6.
     )
 
-    neg_evals = evals < 0
-    evals[neg_evals] = 0.
+    det = b00 * (b11 * b22 - a12 ** 2.) - \
+        a01 * (a01 * b22 - a12 * a02) + \
+        a02 * (a01 * a12 - b11 * a02)
+    safe_p = where(p > 0., p, 1.)
+    phi = arccos(clip(det / (2. * safe_p ** 3.), -1., 1.)) / 3.
 
-    if reorder:
-        evals, evecs = flip(evals, -1), moveaxis(flip(evecs, -1), -2, -1)
+    e1 = q + 2. * p * cos(phi)
+    e3 = q + 2. * p * cos(phi + 2. * pi / 3.)
+    e2 = 3. * q - e1 - e3
+
+    v1, n1 = _eigenvector(tensors, e1)
+    v3, n3 = _eigenvector(tensors, e3)
+    v2 = cross(v3, v1)
+
+    evals = stack((e3, e2, e1), axis=-1)
+    evecs = stack((v3, v2, v1), axis=-1)
+
+    scale = maximum(abs(evals).max(-1), 1E-30)
+    degenerate = (
+        ((e1 - e2) < tol * scale) | ((e2 - e3) < tol * scale) |
+        (n1 < tol * scale ** 2.) | (n3 < tol * scale ** 2.)
+    )
+    if degenerate.any():
+        evals[degenerate], evecs[degenerate] = eigh(tensors[degenerate])
 
     return evals, evecs
 
 
-def compute_haeberlen(tensors, mask):
-    diso, daniso = zeros(mask.shape), zeros(mask.shape)
-    ddelta, deta = zeros(mask.shape), zeros(mask.shape)
+def compute_eigenvalues(
+    tensors, mask, convention=(0, 1, 2, 3, 4, 5), reorder=True,
+    solver="eigh", dtype=float, block_size=1 << 18
+):
+    decompose = analytic_eigh if solver == "analytic" else eigh
+
+    evals, evecs = zeros(mask.shape + (3,), dtype=dtype), \
+        zeros(mask.shape + (3, 3), dtype=dtype)
+
+    masked_tensors = tensors[mask]
+    masked_evals = empty((len(masked_tensors), 3), dtype=dtype)
+    masked_evecs = empty((len(masked_tensors), 3, 3), dtype=dtype)
+
+    for start in range(0, len(masked_tensors), block_size):
+        block = slice(start, start + block_size)
+        masked_evals[block], masked_evecs[block] = decompose(
+            vec_to_tens_field(masked_tensors[block].astype(dtype), convention)
+        )
 
-    tensors = apply_along_axis(
-        vec_to_tens, 1, tensors.reshape((-1, 6))
-    ).reshape(mask.shape + (3, 3))
+    masked_evals[masked_evals < 0] = 0.
 
-    diso[mask] = trace(tensors[mask], axis1=-2, axis2=-1) / 3.
-    daniso[mask] = trace(
-        (tensors - diso[..., None, None])[mask] @ diag([-1., -1., 0.5]),
-        axis1=-2, axis2=-1
-    ) / 3.
+    if reorder:
+        masked_evals = flip(masked_evals, -1)
+        masked_evecs = moveaxis(flip(masked_evecs, -1), -2, -1)
 
-    mask &= ~isclose(diso, 0.)
+    evals[mask], evecs[mask] = masked_evals, masked_evecs
 
-    ddelta[mask] = daniso[mask] / diso[mask]
+    return evals, evecs
 
-    mask &= ~isclose(ddelta, 0.)
 
-    deta[mask] = trace(
-        (
-            (
-                tensors[mask] / diso[mask, None, None] - eye(3)
-            ) / ddelta[mask, None, None] - diag([-1, -1, 2])
-        )[..., :-1, :-1] @ diag([-1, 1]),
-        axis1=-2, axis2=-1
-    ) / 2.
+def compute_haeberlen(
+    tensors, mask, convention=(0, 1, 2, 3, 4, 5), dtype=float
+):
+    """
+    Haeberlen decomposition (diso, daniso, ddelta, deta) of tensor fields,
+    computed in closed form from the diagonal components of the masked
+    voxels. Leading dimensions of tensors and mask are free, so fascicles
+    can be stacked and decomposed in a single call. The mask is not
+    modified, voxels with null diso or ddelta get null ddelta and deta.
+    """
+    diso, daniso = zeros(mask.shape, dtype), zeros(mask.shape, dtype)
+    ddelta, deta = zeros(mask.shape, dtype), zeros(mask.shape, dtype)
+
+    masked_tensors = tensors[mask].astype(dtype)
+    t00 = masked_tensors[..., convention[0]]
+    t11 = masked_tensors[..., convention[2]]
+    t22 = masked_tensors[..., convention[5]]
+
+    m_diso = (t00 + t11 + t22) / 3.
+    m_daniso = (0.5 * t22 - t00 - t11 + 1.5 * m_diso) / 3.
+    diso[mask], daniso[mask] = m_diso, m_daniso
+
+    valid = ~isclose(m_diso, 0.)
+    m_ddelta = zeros(m_diso.shape, dtype)
+    m_ddelta[valid] = m_daniso[valid] / m_diso[valid]
+    ddelta[mask] = m_ddelta
+
+    valid &= ~isclose(m_ddelta, 0.)
+    m_deta = zeros(m_diso.shape, dtype)
+    m_deta[valid] = (t11[valid] - t00[valid]) / (2. * m_daniso[valid])
+    deta[mask] = m_deta
 
     return diso, daniso, ddelta, deta
@@ -0,0 +1,124 @@
+import nibabel as nib
+import numpy as np
+from scipy.ndimage import affine_transform
+
+from mrHARDI.base.io import load_text
+from mrHARDI.compute.transforms import (LinearTransform,
+                                        affine_matrices,
+                                        euler_matrices)
+
+
+_LPS = np.diag([-1., -1., 1., 1.])
+
+_STAGE_PARAMETERS = {
+    "AntsRigid": (6, euler_matrices),
+    "AntsAffine": (12, affine_matrices)
+}
+
+
+def load_moco_parameters(fname):
+    # Columns are MetricPre, MetricPost, then the transform parameters
+    return load_text(fname, delimiter=",", skiprows=1, ndmin=2)[:, 2:]
+
+
+def image_center(img):
+    center = img.affine @ np.append((np.array(img.shape[:3]) - 1.) / 2., 1.)
+    return (_LPS @ center)[:3]
+
+
+def moco_matrices(parameters, stages, center=np.zeros((3,))):
+    """
+    Per-volume matrices mapping fixed to moving points (LPS), from the
+    parameters of every stage written by antsMotionCorr. Stages are
+    composed as in the ITK composite transform, the last one being the
+    first applied.
+    """
+    matrices = np.tile(np.eye(4), (len(parameters), 1, 1))
+    offset = 0
+    for stage in stages:
+        if stage not in _STAGE_PARAMETERS:
+            raise ValueError(
+                "Motion parameters can only be applied for rigid "
+                "and affine stages, got {}".format(stage)
+            )
+
+        n_params, builder = _STAGE_PARAMETERS[stage]
+        matrices = matrices @ builder(
+            parameters[:, offset:offset + n_params], center
+        )
+        offset += n_params
+
+    if offset != parameters.shape[1]:
+        raise ValueError(
+            "Motion parameters ({}) do not match the "
+            "registration stages {}".format(parameters.shape[1], stages)
+        )
+
+    return matrices
+
+
+def _closest_rotations(linear):
+    # Polar decomposition, keeping proper rotations
+    u, _, vt = np.linalg.svd(linear)
+    u[..., -1] *= np.sign(np.linalg.det(u @ vt))[..., None]
+
+    return u @ vt
+
+
+def mean_motion_matrix(matrices):
+    """
+    Rigid mean of the motion matrices, the mean linear part being
+    projected back on the closest rotation.
+    """
+    _m = np.mean(matrices, axis=0)
+    _m[:3, :3] = _closest_rotations(_m[:3, :3])
+
+    return _m
+
+
+def apply_motion_correction(img, matrices, reference, order=1, dtype=None):
+    """
+    Resample a 4D image acquired along the moving timeseries on the
+    reference, each volume with its own motion matrix. 3D images, like
+    masks, are resampled with the rigid mean of the motion matrices.
+    """
+    if len(img.shape) == 4 and img.shape[3] != len(matrices):
+        raise ValueError(
+            "Image has {} volumes, but {} motion matrices were "
+            "given".format(img.shape[3], len(matrices))
+        )
+    if len(img.shape) not in (3, 4):
+        raise ValueError(
+            "Motion correction can only be applied to 3D or 4D images, "
+            "got shape {}".format(img.shape)
+        )
+
+    data = np.asanyarray(img.dataobj)
+    if dtype is None:
+        dtype = data.dtype if order == 0 else np.float32
+
+    if data.ndim == 3:
+        data, matrices = data[..., None], mean_motion_matrix(matrices)[None]
+
+    vox_to_vox = np.linalg.inv(img.affine) @ _LPS @ matrices @ _LPS @ \
+        reference.affine
+
+    out = np.empty(reference.shape[:3] + (len(matrices),), dtype=dtype)
+    for i, _m in enumerate(vox_to_vox):
+        out[..., i] = affine_transform(
+            data[..., i], _m[:3, :3], _m[:3, 3],
+            output_shape=out.shape[:3], order=order
+        )
+
+    return out.reshape(reference.shape[:3] + img.shape[3:])
+
+
+def rotate_bvecs(bvecs, matrices, reference):
+    # The rotational part of each moving to fixed mapping, expressed in
+    # the voxel axes of the reference, as the b-vectors are
+    ornt = nib.io_orientation(reference.affine)
+    linear = np.array([
+        LinearTransform(_m).rotation(ornt) for _m in matrices
+    ])
+
+    return np.einsum("vij,jv->iv", _closest_rotations(linear), bvecs)
@@ -0,0 +1,98 @@
+from os import getpid, makedirs, replace
+from os.path import basename, exists, getmtime, getsize, join
+
+import nibabel as nib
+from nibabel.openers import Opener
+import numpy as np
+from scipy.ndimage import affine_transform, gaussian_filter
+
+from mrHARDI.base.utils import hash_file
+from mrHARDI.compute.utils import resampling_affine
+
+
+class GaussianPyramid:
+    """
+    Gaussian pyramid levels of images, cached on disk in a directory shared
+    by every stage processing the same subject. Levels are keyed by the
+    content of the image, the shrink factor and the smoothing sigma.
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self._hashes = {}
+        makedirs(cache_dir, exist_ok=True)
+
+    def _hash(self, fname):
+        key = (fname, getmtime(fname), getsize(fname))
+        if key not in self._hashes:
+            # Hashing the decompressed stream keeps the key independent of
+            # the gzip header, which changes each time a file is written
+            self._hashes[key] = hash_file(fname, opener=Opener)
+
+        return self._hashes[key]
+
+    def level_name(self, fname, shrink, sigma):
+        return join(self.cache_dir, "{}_shrink{:g}_sigma{:g}.nii.gz".format(
+            self._hash(fname), shrink, sigma
+        ))
+
+    def level(self, fname, shrink, sigma=None):
+        if sigma is None:
+            sigma = shrink / 2. if shrink > 1. else 0.
+
+        out_name = self.level_name(fname, shrink, sigma)
+        if exists(out_name):
+            return out_name
+
+        img = nib.load(fname)
+        zooms = np.array(img.header.get_zooms()[:3])
+        data = img.get_fdata(dtype=np.float32)
+
+        # Sigma is given in voxels of the finest spacing of the image
+        if sigma > 0.:
+            sigmas = sigma * np.min(zooms) / zooms
+            data = gaussian_filter(
+                data, tuple(sigmas) + (0.,) * (data.ndim - 3)
+            )
+
+        new_zooms = np.repeat(shrink * np.min(zooms), 3)
+        affine = resampling_affine(
+            img.affine, np.array(img.shape[:3]), zooms, new_zooms
+        )
+        shape = tuple(
+            max(int(np.round(s * z / nz - 1E-4)), 1)
+            for s, z, nz in zip(img.shape[:3], zooms, new_zooms)
+        )
+
+        vox_to_vox = np.linalg.inv(img.affine) @ affine
+        if data.ndim == 3:
+            data = affine_transform(
+                data, vox_to_vox[:3, :3], vox_to_vox[:3, 3],
+                output_shape=shape, order=1
+            )
+        else:
+            data = np.stack([
+                affine_transform(
+                    data[..., i], vox_to_vox[:3, :3], vox_to_vox[:3, 3],
+                    output_shape=shape, order=1
+                ) for i in range(data.shape[-1])
+            ], axis=-1)
+
+        header = img.header.copy()
+        header.set_data_dtype(np.float32)
+        header.set_zooms(tuple(new_zooms) + header.get_zooms()[3:])
+
+        # Written under a temporary name so concurrent stages never pick
+        # up a partial level
+        tmp_name = join(self.cache_dir, "tmp{}_{}".format(
+            getpid(), basename(out_name)
+        ))
+        nib.save(nib.Nifti1Image(data, affine, header), tmp_name)
+        replace(tmp_name, out_name)
+
+        return out_name
+
+    def levels(self, fname, shrinks, sigmas=None):
+        if sigmas is None:
+            sigmas = [None] * len(shrinks)
+
+        return [self.level(fname, f, s) for f, s in zip(shrinks, sigmas)]
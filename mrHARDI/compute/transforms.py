@@ -0,0 +1,334 @@
+from abc import ABCMeta, abstractmethod
+from functools import lru_cache
+from os.path import abspath, getmtime
+
+import nibabel as nib
+import numpy as np
+from scipy.io import loadmat
+try:
+    from scipy.io.matlab._mio4 import MatFile4Writer
+except ImportError:
+    from scipy.io.matlab.mio4 import MatFile4Writer
+from scipy.spatial.transform import Rotation
+
+from mrHARDI.compute.utils import compute_reorientation
+
+
+_RAS = nib.orientations.axcodes2ornt(('R', 'A', 'S'))
+_LPS = nib.orientations.axcodes2ornt(('L', 'P', 'S'))
+
+
+class Transform(metaclass=ABCMeta):
+    linear = False
+
+    def __init__(self, inverse=False):
+        self.inverse = inverse
+
+    @abstractmethod
+    def inverted(self):
+        pass
+
+
+class LinearTransform(Transform):
+    """
+    Linear transform stored as ITK does, as the homogeneous mapping of
+    points from the fixed to the moving physical space (LPS).
+    """
+    linear = True
+
+    def __init__(self, matrix, inverse=False):
+        super().__init__(inverse)
+        self._matrix = np.asarray(matrix, dtype=float)
+
+    @classmethod
+    def from_world(cls, matrix, source_ornt=_RAS, target_ornt=_LPS):
+        ornt_trans = compute_reorientation(source_ornt, target_ornt)
+
+        _m = np.linalg.inv(matrix)
+        _m[:3, :3] = ornt_trans[:3, :3] @ _m[:3, :3] @ ornt_trans[:3, :3]
+        _m[:3, 3] = ornt_trans[:3, :3] @ _m[:3, 3]
+
+        return cls(_m)
+
+    @property
+    def matrix(self):
+        if self.inverse:
+            return np.linalg.inv(self._matrix)
+
+        return self._matrix.copy()
+
+    def inverted(self):
+        return LinearTransform(self._matrix, not self.inverse)
+
+    def world_matrix(self, target_ornt=_RAS):
+        ornt_trans = compute_reorientation(target_ornt, _LPS)
+
+        _t = self.matrix
+        _t[:3, :3] = ornt_trans[:3, :3] @ _t[:3, :3] @ ornt_trans[:3, :3]
+        _t[:3, 3] = ornt_trans[:3, :3] @ _t[:3, 3]
+
+        return np.linalg.inv(_t)
+
+    def rotation(self, target_ornt=_RAS):
+        return self.world_matrix(target_ornt)[:3, :3]
+
+    def parameters(self, center=np.zeros((3,))):
+        _m = self.matrix
+        _t = _m[:3, 3] - center + _m[:3, :3] @ center
+        return np.concatenate((_m[:3, :3].flatten(), _t))
+
+    def save(self, filename, center=np.zeros((3,))):
+        mat = {
+            "AffineTransform_double_3_3": self.parameters(center)[:, None],
+            "fixed": np.asarray(center, dtype=float)[:, None]
+        }
+
+        with open(filename, 'wb') as file_stream:
+            fw = MatFile4Writer(file_stream, oned_as='row')
+            fw.put_variables(mat)
+
+
+def _offset_matrices(linear, translation, center):
+    _m = np.tile(np.eye(4), (len(linear), 1, 1))
+    _m[:, :3, :3] = linear
+    _m[:, :3, 3] = translation + center - linear @ center
+
+    return _m
+
+
+def affine_matrices(parameters, center=np.zeros((3,))):
+    parameters = np.atleast_2d(np.asarray(parameters, dtype=float))
+    center = np.asarray(center, dtype=float).flatten()[:3]
+
+    return _offset_matrices(
+        parameters[:, :9].reshape((-1, 3, 3)), parameters[:, 9:12], center
+    )
+
+
+def euler_matrices(parameters, center=np.zeros((3,)), compute_zyx=False):
+    parameters = np.atleast_2d(np.asarray(parameters, dtype=float))
+    center = np.asarray(center, dtype=float).flatten()[:3]
+    ax, ay, az = parameters[:, 0], parameters[:, 1], parameters[:, 2]
+
+    # Same rotation order as ITK's Euler3DTransform
+    if compute_zyx:
+        _r = Rotation.from_euler('ZYX', np.stack((az, ay, ax), axis=1))
+    else:
+        _r = Rotation.from_euler('ZXY', np.stack((az, ax, ay), axis=1))
+
+    return _offset_matrices(_r.as_matrix(), parameters[:, 3:6], center)
+
+
+class AffineTransform(LinearTransform):
+    @classmethod
+    def from_parameters(cls, parameters, center=np.zeros((3,)), inverse=False):
+        return cls(affine_matrices(parameters, center)[0], inverse)
+
+
+class EulerTransform(LinearTransform):
+    @classmethod
+    def from_parameters(
+        cls, parameters, center=np.zeros((3,)), compute_zyx=False,
+        inverse=False
+    ):
+        return cls(euler_matrices(parameters, center, compute_zyx)[0], inverse)
+
+    def parameters(self, center=np.zeros((3,))):
+        _m = self.matrix
+        az, ax, ay = Rotation.from_matrix(_m[:3, :3]).as_euler('ZXY')
+        _t = _m[:3, 3] - center + _m[:3, :3] @ center
+        return np.concatenate(([ax, ay, az], _t))
+
+
+class DisplacementField(Transform):
+    def __init__(self, filename, inverse=False):
+        super().__init__(inverse)
+        self.filename = filename
+
+    def inverted(self):
+        return DisplacementField(self.filename, not self.inverse)
+
+
+class TransformChain:
+    """
+    Chain of transforms in the order given to antsApplyTransforms, the last
+    one being the first applied to points of the fixed space.
+    """
+    def __init__(self, transforms):
+        self.transforms = list(transforms)
+
+    @classmethod
+    def from_files(cls, filenames, inverts=None):
+        if inverts is None:
+            inverts = [False] * len(filenames)
+
+        return cls(load(f, i) for f, i in zip(filenames, inverts))
+
+    @property
+    def linear(self):
+        return all(t.linear for t in self.transforms)
+
+    @property
+    def matrix(self):
+        if not self.linear:
+            raise ValueError(
+                "Chain contains non-linear transforms, it cannot be "
+                "collapsed to a single matrix"
+            )
+
+        _m = np.eye(4)
+        for t in self.transforms:
+            _m = _m @ t.matrix
+
+        return _m
+
+    def collapse(self):
+        transforms, run = [], []
+        for t in self.transforms + [None]:
+            if t is not None and t.linear:
+                run.append(t)
+                continue
+
+            if len(run) == 1:
+                transforms.append(run[0])
+            elif len(run) > 1:
+                transforms.append(LinearTransform(TransformChain(run).matrix))
+
+            if t is not None:
+                transforms.append(t)
+            run = []
+
+        return TransformChain(transforms)
+
+
+def _parse_itk_text(filename):
+    transforms, current = [], {}
+    with open(filename) as f:
+        for line in f:
+            key, _, value = line.partition(":")
+            key = key.strip()
+            if key == "Transform":
+                current = {"type": value.strip()}
+                transforms.append(current)
+            elif key in ["Parameters", "FixedParameters"]:
+                current[key] = np.array(value.split(), dtype=float)
+
+    return [
+        (t["type"], t.get("Parameters"), t.get("FixedParameters"))
+        for t in transforms if "CompositeTransform" not in t["type"]
+    ]
+
+
+def _parse_itk_mat(filename):
+    mat = loadmat(filename)
+    fixed = mat["fixed"].flatten() if "fixed" in mat else np.zeros((3,))
+
+    return [
+        (key, mat[key].flatten(), fixed) for key in mat
+        if not key.startswith("__") and key != "fixed"
+    ]
+
+
+def _from_itk(transform_type, parameters, fixed):
+    if fixed is None:
+        fixed = np.zeros((3,))
+
+    if transform_type.startswith("Euler3DTransform"):
+        return EulerTransform.from_parameters(
+            parameters, fixed[:3],
+            compute_zyx=len(fixed) > 3 and bool(fixed[3])
+        )
+
+    if any(transform_type.startswith(t) for t in [
+        "AffineTransform",
+        "MatrixOffsetTransformBase",
+        "Rigid3DTransform"
+    ]):
+        return AffineTransform.from_parameters(parameters, fixed)
+
+    raise ValueError("Unsupported transform type : {}".format(transform_type))
+
+
+@lru_cache(maxsize=64)
+def _load(filename, mtime):
+    if not (filename.endswith(".mat") or filename.endswith(".txt")):
+        return DisplacementField(filename)
+
+    if filename.endswith(".txt"):
+        itk_transforms = _parse_itk_text(filename)
+    else:
+        itk_transforms = _parse_itk_mat(filename)
+
+    if len(itk_transforms) == 0:
+        raise ValueError("No transform found in : {}".format(filename))
+
+    transforms = [_from_itk(*t) for t in itk_transforms]
+    if len(transforms) == 1:
+        return transforms[0]
+
+    return LinearTransform(TransformChain(transforms).matrix)
+
+
+def load(filename, inverse=False):
+    transform = _load(abspath(filename), getmtime(filename))
+    return transform.inverted() if inverse else transform
+
+
+def load_transform(filename, target_ornt=_RAS):
+    transform = load(filename)
+    if not transform.linear:
+        raise ValueError(
+            "Could not load a linear transform from : {}".format(filename)
+        )
+
+    return transform.world_matrix(target_ornt)
+
+
+def save_transform(
+    matrix, out_type, out_name,
+    center=np.array([0, 0, 0]),
+    target_ornt=_LPS
+):
+    center = np.asarray(center, dtype=float)
+    transform = LinearTransform.from_world(matrix, target_ornt=target_ornt)
+
+    mat = {}
+    if "AffineTransform" in out_type:
+        mat[out_type] = transform.parameters(center)
+        mat["fixed"] = center
+    elif "MatrixOffsetTransformBase" in out_type:
+        mat[out_type] = np.concatenate((
+            np.eye(3).flatten(), transform.parameters(center)[9:]
+        ))
+        mat["fixed"] = center
+    elif "Euler3DTransform" in out_type:
+        mat[out_type] = EulerTransform(transform.matrix).parameters(center)
+        mat["fixed"] = np.append(center, [0.])
+
+    mat[out_type] = mat[out_type].reshape((-1, 1))
+    mat["fixed"] = mat["fixed"].reshape((-1, 1))
+    with open(out_name, 'wb') as file_stream:
+        fw = MatFile4Writer(file_stream, oned_as='row')
+        fw.put_variables(mat)
+
+
+def write_displacement_field(chain, reference, out_name, dtype=np.float32):
+    if not isinstance(chain, TransformChain):
+        chain = TransformChain([chain])
+
+    ref = nib.load(reference)
+    lps = np.diag([-1., -1., 1., 1.])
+
+    # Displacements are expressed in LPS, as ITK reads them. The chain maps
+    # affinely, so every component is linear in the voxel indexes.
+    _d = ((chain.matrix - np.eye(4)) @ lps @ ref.affine)[:3]
+    i, j, k = np.ogrid[tuple(slice(0, s) for s in ref.shape[:3])]
+
+    field = np.empty(ref.shape[:3] + (1, 3), dtype=dtype)
+    for c in range(3):
+        field[..., 0, c] = _d[c, 0] * i + _d[c, 1] * j + _d[c, 2] * k + \
+            _d[c, 3]
+
+    img = nib.Nifti1Image(field, ref.affine)
+    img.header.set_intent("vector")
+    nib.save(img, out_name)
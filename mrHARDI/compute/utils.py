@@ -7,9 +7,6 @@ from numpy import (concatenate,
                    array,
                    dtype as datatype,
                    r_ as row)
-from scipy.io import loadmat
-from scipy.io.matlab.mio4 import MatFile4Writer
-from scipy.spatial.transform import Rotation
 
 from mrHARDI.compute.math.linalg import homo_mat
 
@@ -146,81 +143,3 @@ def compute_reorientation_to_image(_img1, _img2):
     return compute_reorientation(
         nib.io_orientation(_img1.affine), nib.io_orientation(_img2.affine)
     )
-
-
-def load_transform(
-    filename, target_ornt=nib.orientations.axcodes2ornt(('R', 'A', 'S'))
-):
-    mat = loadmat(filename)
-
-    def _affine(_type):
-        _m = np.vstack((mat[_type].reshape((4, 3)).T, [0, 0, 0, 1])).T
-        _m[[0, 1, 2, -1, -1, -1], [-1, -1, -1, 0, 1, 2]] = \
-            _m[[-1, -1, -1, 0, 1, 2], [0, 1, 2, -1, -1, -1]]
-        offset = mat['fixed'].flatten()[:3]
-        _m[:3, -1] += offset - np.dot(_m[:3, :3], offset)
-        return _m
-
-    def _euler(_type):
-        offset = mat['fixed'].flatten()[:3]
-        _m = homo_mat(
-            Rotation.from_euler('zyx', mat[_type][:3].flatten()).as_matrix()
-        )
-        _m[:3, 3] = mat[_type][3:] + offset - np.dot(_m[:3, :3], offset)
-        return _m
-
-    if "AffineTransform_double_3_3" in mat:
-        _t = _affine("AffineTransform_double_3_3")
-    elif "AffineTransform_float_3_3" in mat:
-        _t = _affine("AffineTransform_float_3_3")
-    elif "MatrixOffsetTransformBase_double_3_3" in mat:
-        _t = _affine("MatrixOffsetTransformBase_double_3_3")
-    elif "MatrixOffsetTransformBase_float_3_3" in mat:
-        _t = _affine("MatrixOffsetTransformBase_float_3_3")
-    elif "Euler3DTransform_double_3_3" in mat:
-        _t = _euler("Euler3DTransform_double_3_3")
-    elif "Euler3DTransform_float_3_3" in mat:
-        _t = _euler("Euler3DTransform_float_3_3")
-    else:
-        print("Could not load rotation matrix from : {}".format(filename))
-        _t = np.eye(4)
-
-    ornt_trans = compute_reorientation(
-        target_ornt, nib.orientations.axcodes2ornt(("L", "P", "S"))
-    )
-
-    _t[:3, :3] = ornt_trans[:3, :3] @ _t[:3, :3] @ ornt_trans[:3, :3]
-    _t[:3, 3] = ornt_trans[:3, :3] @ _t[:3, 3]
-
-    return np.linalg.inv(_t)
-
-
-def save_transform(
-    matrix, out_type, out_name,
-    center = np.array([0, 0, 0]),
-    target_ornt=nib.orientations.axcodes2ornt(('L', 'P', 'S'))
-):
-    trans_ornt = nib.io_orientation(matrix)
-    ornt_trans = compute_reorientation(trans_ornt, target_ornt)
-
-    _r = ornt_trans[:3, :3] @ matrix[:3, :3] @ ornt_trans[:3, :3]
-    _o = ornt_trans[:3, :3] @ matrix[:3, 3]
-    _t = -_o + center - _r @ center
-
-    mat = {}
-    if "AffineTransform" in out_type:
-        mat[out_type] = np.concatenate((_r.flatten(), _t))
-        mat["fixed"] = center
-    elif "MatrixOffsetTransformBase" in out_type:
-        mat[out_type] = np.concatenate((np.eye(3).flatten(), _t))
-        mat["fixed"] = center
-    elif "Euler3DTransform" in out_type:
-        angles = Rotation.from_matrix(_r).as_euler('zyx')
-        mat[out_type] = np.concatenate((angles, _t))
-        mat["fixed"] = np.append(center, [1.])
-
-    mat[out_type] = mat[out_type].reshape((-1, 1))
-    mat["fixed"] = mat["fixed"].reshape((-1, 1))
-    with open(out_name, 'wb') as file_stream:
-        fw = MatFile4Writer(file_stream, oned_as='row')
-        fw.put_variables(mat)
@@ -1,5 +1,5 @@
 from enum import Enum as PyEnum
-from traitlets import Float, Integer, default
+from traitlets import Float, Integer, Unicode, default
 from traitlets.config import Bool, Enum, List
 from traitlets.config.loader import ConfigError
 
@@ -13,7 +13,11 @@ _a_aliases = {
     "ca-split": "AntsConfiguration.coarse_angular_split",
     "cl-split": "AntsConfiguration.coarse_linear_split",
     "fa-split": "AntsConfiguration.fine_angular_split",
-    "fl-split": "AntsConfiguration.fine_linear_split"
+    "fl-split": "AntsConfiguration.fine_linear_split",
+    "ai-split": "AntsConfiguration.ai_search_splits",
+    "ai-workers": "AntsConfiguration.ai_workers",
+    "ai-stop": "AntsConfiguration.ai_early_stop",
+    "pyramid-cache": "AntsConfiguration.pyramid_cache"
 }
 
 _a_flags = {
@@ -91,6 +95,31 @@ class AntsConfiguration(mrHARDIConfigurable):
     coarse_linear_range = Float(16.0).tag(config=True)
     fine_linear_range = Float(4.0).tag(config=True)
 
+    ai_search_splits = Integer(
+        1, help="Number of sectors along each rotation axis in which the "
+                "antsAI search grid is partitioned. Each sector is searched "
+                "by an independent antsAI run, in parallel"
+    ).tag(config=True)
+    ai_workers = Integer(
+        2, help="Maximum number of antsAI sector searches running "
+                "concurrently. Sectors are started from the most similar "
+                "one, so fewer workers let the early stop skip more of them"
+    ).tag(config=True)
+    ai_early_stop = Float(
+        0.25, help="Sectors whose initial similarity, raised by the "
+                   "largest gain of the searches done so far, falls below "
+                   "the best similarity found by more than this fraction "
+                   "of it are not searched. 0 searches every sector"
+    ).tag(config=True)
+    pyramid_cache = Unicode(
+        None, allow_none=True,
+        help="Directory where downsampled and smoothed images are cached, "
+             "the mrHARDI/pyramid directory of the user cache "
+             "(XDG_CACHE_HOME, ~/.cache by default) if not given. Levels "
+             "are keyed by the content of images, so runs over identical "
+             "images reuse them"
+    ).tag(config=True)
+
     def _config_section(self):
         return super()._config_section()
 
@@ -108,6 +137,11 @@ class AntsConfiguration(mrHARDIConfigurable):
                 "Dimension of input images must be between 2 and 4"
             )
 
+        if self.ai_search_splits < 1:
+            raise ConfigError(
+                "Number of antsAI search sectors must be at least 1"
+            )
+
     def set_initial_transform_from_ants_ai(self, transform_mat):
         self.init_moving_transform = transform_mat
 
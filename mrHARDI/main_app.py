@@ -172,6 +172,14 @@ class mrHARDIApplication(mrHARDIBaseApplication):
             "mrHARDI.apps.utils.SplitImage",
             'Split an image given an axis'
         ),
+        store_export=(
+            "mrHARDI.apps.utils.ExportFromStore",
+            'Export datasets of a chunked store to nifti images'
+        ),
+        store_import=(
+            "mrHARDI.apps.utils.ImportToStore",
+            'Import images and their metadata to a chunked store'
+        ),
         validate=(
             "mrHARDI.apps.validate.Validate", 'Data validation'
         )
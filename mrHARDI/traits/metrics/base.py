@@ -1,10 +1,14 @@
 from abc import abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import cpu_count
+from threading import BoundedSemaphore, Lock
 from typing import Generator
 
 import nibabel as nib
-from numpy import loadtxt, ones, ubyte, sign, array
+from numpy import ones, ubyte, sign, array, dtype
 from numpy.linalg import eigh
 
+from mrHARDI.base.io import load_text
 from mrHARDI.compute.math.linalg import color
 from mrHARDI.compute.math.tensor import compute_eigenvalues
 
@@ -41,15 +45,19 @@ def _load_mask(path, shape):
         return ones(shape)
 
 
-def eigs_with_strides(strides, *args):
-    evals, evecs = compute_eigenvalues(*args)
+def eigs_with_strides(strides, *args, **kwargs):
+    evals, evecs = compute_eigenvalues(*args, **kwargs)
     return evals, evecs * strides
 
 
 class BaseMetric:
+    requires = ()
+    serial = False
+
     def __init__(
         self, prefix, output, cache, affine, mask=None,
-        shape=None, colors=False, **kwargs
+        shape=None, colors=False, eigen_solver="eigh", writer=None,
+        dtype="float64", **kwargs
     ):
         self.prefix = prefix
         self.output = output
@@ -59,10 +67,23 @@ class BaseMetric:
         self.shape = shape
         self.strides = self._strides_from_affine(self.affine)
         self.colors = colors
+        self.eigen_solver = eigen_solver
+        self.writer = writer
+        self.dtype = dtype
+        self.outputs = []
 
     def load_from_cache(self, key, alternative=None):
         return load_from_cache(self.cache, key, alternative)
 
+    def dependencies(self):
+        return tuple(self.requires)
+
+    def intermediates(self):
+        return {}
+
+    def inputs(self):
+        return ["{}_mask.nii.gz".format(self.prefix)]
+
     def _strides_from_affine(self, affine):
         evals, evecs = eigh(array(affine)[:3, :3])
         return [sign(ev) for ev in evals]
@@ -85,20 +106,31 @@ class BaseMetric:
         return load_from_cache(
             self.cache,
             add_keys + ("bvec",),
-            lambda f: loadtxt("{}.bvec".format(self.prefix))
+            lambda f: load_text("{}.bvec".format(self.prefix))
         )
 
     def _get_bvals(self, add_keys=()):
         return load_from_cache(
             self.cache,
             add_keys + ("bval",),
-            lambda f: loadtxt("{}.bval".format(self.prefix))
+            lambda f: load_text("{}.bval".format(self.prefix))
         )
 
     def _load_image(self, name):
         img = nib.load(name)
         return img.get_fdata().astype(img.get_data_dtype())
 
+    def _save_image(self, data, fname):
+        self.outputs.append(fname)
+        if data.dtype.kind == "f" and \
+                data.dtype.itemsize > dtype(self.dtype).itemsize:
+            data = data.astype(self.dtype)
+
+        if self.writer is None:
+            nib.save(nib.Nifti1Image(data, self.affine), fname)
+        else:
+            self.writer.write(data, self.affine, fname)
+
     def _color(self, name, evecs, add_keys=()):
         if self.colors:
             self._color_metric(name, evecs, add_keys)
@@ -115,14 +147,165 @@ class BaseMetric:
         cmetric = color(metric, evecs, mask)
         self.cache[cname] = cmetric
 
-        nib.save(
-            nib.Nifti1Image(
-                (cmetric * 255.).astype(ubyte),
-                self.affine
-            ),
+        self._save_image(
+            (cmetric * 255.).astype(ubyte),
             "{}_{}.nii.gz".format(self.output, cname)
         )
 
     @abstractmethod
     def measure(self):
         pass
+
+
+class AsyncImageWriter:
+    """
+    Writes images on a thread pool so compression overlaps the computation
+    of the next metrics. The number of images held in memory while waiting
+    to be written is bounded, writing blocks until a slot is available.
+    Errors are raised on flush, which is called when leaving the context.
+    """
+    def __init__(self, n_threads=cpu_count(), max_pending=None):
+        n_threads = max(n_threads, 1)
+        self._executor = ThreadPoolExecutor(n_threads)
+        self._slots = BoundedSemaphore(max_pending or 2 * n_threads)
+        self._futures = []
+        self._lock = Lock()
+
+    def _write(self, data, affine, fname):
+        try:
+            nib.save(nib.Nifti1Image(data, affine), fname)
+        finally:
+            self._slots.release()
+
+    def write(self, data, affine, fname):
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(self._write, data, affine, fname)
+        except Exception:
+            self._slots.release()
+            raise
+
+        with self._lock:
+            self._futures.append(future)
+
+    def flush(self):
+        with self._lock:
+            futures, self._futures = self._futures, []
+
+        errors = [f.exception() for f in futures]
+        errors = [e for e in errors if e is not None]
+        if len(errors) > 0:
+            raise errors[0]
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self._executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._executor.shutdown()
+
+
+class DependencyScheduler:
+    """
+    Runs metrics concurrently once the intermediates they depend on are in
+    the cache. Intermediates are given as a mapping of their name to the
+    names they require, the function filling the cache with them and the
+    cache keys they occupy. Each one is computed exactly once, independent
+    ones concurrently, and a metric starts as soon as its dependencies are
+    available, so outputs are written while the remaining intermediates are
+    computed. Metrics flagged as serial run one after the other once
+    everything else is done. When a cache supporting retain and release is
+    given, intermediates are dropped from it once their last consumer is
+    done.
+    """
+    def __init__(self, n_threads=cpu_count()):
+        self.n_threads = max(n_threads, 1)
+
+    def _closure(self, metrics, intermediates):
+        needed, stack = set(), [d for m in metrics for d in m.dependencies()]
+        while len(stack) > 0:
+            name = stack.pop()
+            if name in needed:
+                continue
+            if name not in intermediates:
+                raise ValueError(
+                    "No way to compute metric dependency : {}".format(name)
+                )
+
+            needed.add(name)
+            stack.extend(intermediates[name][0])
+
+        return needed
+
+    def run(self, metrics, intermediates, cache=None):
+        pending = [m for m in metrics if not m.serial]
+        needed = self._closure(pending, intermediates)
+        done, futures = set(), []
+
+        def _keys(names):
+            return [k for n in names for k in (
+                intermediates[n][2] if len(intermediates[n]) > 2 else ()
+            )]
+
+        def _release(names):
+            if cache is not None:
+                for key in _keys(names):
+                    cache.release(key)
+
+        if cache is not None:
+            consumers = [m.dependencies() for m in pending] + [
+                intermediates[name][0] for name in needed
+            ]
+            for names in consumers:
+                for key in _keys(names):
+                    cache.retain(key)
+
+        def _measure(metric):
+            metric.measure()
+            _release(metric.dependencies())
+
+        def _compute(name):
+            intermediates[name][1]()
+            _release(intermediates[name][0])
+
+        with ThreadPoolExecutor(self.n_threads) as executor:
+            def _submit_ready():
+                ready = [m for m in pending if set(m.dependencies()) <= done]
+                for metric in ready:
+                    pending.remove(metric)
+                    futures.append(executor.submit(_measure, metric))
+
+            _submit_ready()
+            while len(needed - done) > 0:
+                level = [
+                    name for name in needed - done
+                    if set(intermediates[name][0]) <= done
+                ]
+                if len(level) == 0:
+                    raise ValueError(
+                        "Circular dependencies between : {}".format(
+                            ", ".join(sorted(needed - done))
+                        )
+                    )
+
+                for future in [
+                    executor.submit(_compute, name) for name in level
+                ]:
+                    future.result()
+
+                done.update(level)
+                _submit_ready()
+
+            for future in futures:
+                future.result()
+
+        for metric in filter(lambda m: m.serial, metrics):
+            metric.measure()
@@ -0,0 +1,245 @@
+import json
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from os import makedirs, remove
+from os.path import exists, join
+from tempfile import mkdtemp
+from threading import RLock
+
+import numpy as np
+
+
+_INDEX = "index.json"
+
+
+def _nbytes(value):
+    if isinstance(value, np.memmap):
+        return 0
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, tuple):
+        return sum(_nbytes(v) for v in value)
+
+    return 0
+
+
+def _spillable(value):
+    if isinstance(value, tuple):
+        return len(value) > 0 and all(_spillable(v) for v in value)
+
+    return isinstance(value, np.ndarray) and not isinstance(value, np.memmap)
+
+
+class MetricCache(MutableMapping):
+    """
+    Cache of the metrics computing. Entries can be retained by pending
+    consumers and are dropped when the last one releases them. When a
+    memory limit (in bytes) is given, the least recently used arrays are
+    spilled to memory mapped .npy files. The cache is saved as a directory
+    of .npy files with a json index and loaded back lazily.
+    """
+    def __init__(self, memory_limit=None, spill_dir=None):
+        self.memory_limit = memory_limit
+        self.spill_dir = spill_dir
+        self._entries = OrderedDict()
+        self._lazy = {}
+        self._refs = {}
+        self._spilled = {}
+        self._lock = RLock()
+
+    def __getitem__(self, key):
+        with self._lock:
+            if key in self._lazy:
+                self._entries[key] = self._lazy.pop(key)()
+
+            value = self._entries[key]
+            self._entries.move_to_end(key)
+            return value
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._lazy.pop(key, None)
+            self._drop_spilled(key)
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            self._enforce_limit()
+
+    def __delitem__(self, key):
+        with self._lock:
+            if key in self._lazy:
+                del self._lazy[key]
+            else:
+                del self._entries[key]
+            self._drop_spilled(key)
+            self._refs.pop(key, None)
+
+    def __contains__(self, key):
+        return key in self._entries or key in self._lazy
+
+    def __iter__(self):
+        return iter(list(self._entries) + list(self._lazy))
+
+    def __len__(self):
+        return len(self._entries) + len(self._lazy)
+
+    @property
+    def nbytes(self):
+        return sum(_nbytes(v) for v in self._entries.values())
+
+    def retain(self, key, count=1):
+        with self._lock:
+            self._refs[key] = self._refs.get(key, 0) + count
+
+    def release(self, key):
+        with self._lock:
+            if key not in self._refs:
+                return
+
+            self._refs[key] -= 1
+            if self._refs[key] <= 0:
+                self._refs.pop(key)
+                if key in self:
+                    del self[key]
+
+    def _spill_path(self, key, i=None):
+        if self.spill_dir is None:
+            self.spill_dir = mkdtemp(prefix="mrhardi_cache_")
+        makedirs(self.spill_dir, exist_ok=True)
+
+        name = key if i is None else "{}_{}".format(key, i)
+        return join(self.spill_dir, "{}.npy".format(name))
+
+    def _spill(self, key):
+        value = self._entries[key]
+        is_tuple = isinstance(value, tuple)
+        if is_tuple:
+            paths = [self._spill_path(key, i) for i in range(len(value))]
+        else:
+            paths, value = [self._spill_path(key)], (value,)
+
+        mapped = []
+        for path, array in zip(paths, value):
+            np.save(path, array)
+            mapped.append(np.load(path, mmap_mode="c"))
+
+        self._spilled[key] = paths
+        self._entries[key] = tuple(mapped) if is_tuple else mapped[0]
+
+    def _drop_spilled(self, key):
+        for path in self._spilled.pop(key, []):
+            if exists(path):
+                remove(path)
+
+    def _enforce_limit(self):
+        if self.memory_limit is None:
+            return
+
+        for key in list(self._entries):
+            if self.nbytes <= self.memory_limit:
+                break
+            # Spilled entries are already mapped to their .npy files
+            if key not in self._spilled and _spillable(self._entries[key]):
+                self._spill(key)
+
+    def clear_spilled(self):
+        with self._lock:
+            for key in list(self._spilled):
+                self._drop_spilled(key)
+
+    def save(self, directory):
+        makedirs(directory, exist_ok=True)
+        index = {}
+        for key in self:
+            value = self[key]
+            if isinstance(value, MutableMapping):
+                sub_cache = value if isinstance(value, MetricCache) \
+                    else MetricCache()
+                if not isinstance(value, MetricCache):
+                    sub_cache.update(value)
+                sub_cache.save(join(directory, key))
+                index[key] = {"type": "cache"}
+            elif value is None:
+                index[key] = {"type": "none"}
+            elif isinstance(value, tuple):
+                for i, v in enumerate(value):
+                    np.save(join(directory, "{}_{}.npy".format(key, i)), v)
+                index[key] = {"type": "tuple", "length": len(value)}
+            else:
+                np.save(join(directory, "{}.npy".format(key)), value)
+                index[key] = {"type": "array"}
+
+        with open(join(directory, _INDEX), "w+") as f:
+            json.dump(index, f, indent=4)
+
+    @classmethod
+    def load(cls, directory, **kwargs):
+        cache = cls(**kwargs)
+        with open(join(directory, _INDEX)) as f:
+            index = json.load(f)
+
+        def _loader(key, desc):
+            if desc["type"] == "cache":
+                return lambda: cls.load(join(directory, key), **kwargs)
+            if desc["type"] == "none":
+                return lambda: None
+            if desc["type"] == "tuple":
+                return lambda: tuple(np.load(
+                    join(directory, "{}_{}.npy".format(key, i)),
+                    mmap_mode="c"
+                ) for i in range(desc["length"]))
+
+            return lambda: np.load(
+                join(directory, "{}.npy".format(key)), mmap_mode="c"
+            )
+
+        for key, desc in index.items():
+            cache._lazy[key] = _loader(key, desc)
+
+        return cache
+
+
+class CacheScope(MutableMapping):
+    """
+    View over the entries of a cache whose keys start with a given prefix.
+    Entries are stored in the underlying cache, so they count toward its
+    memory limit and get spilled and released like any other.
+    """
+    def __init__(self, cache, prefix):
+        self.cache = cache
+        self.prefix = "{}.".format(prefix)
+
+    def _key(self, key):
+        return "{}{}".format(self.prefix, key)
+
+    def __getitem__(self, key):
+        # Missing keys are reported without the prefix, as they were asked
+        if self._key(key) not in self.cache:
+            raise KeyError(key)
+
+        return self.cache[self._key(key)]
+
+    def __setitem__(self, key, value):
+        self.cache[self._key(key)] = value
+
+    def __delitem__(self, key):
+        del self.cache[self._key(key)]
+
+    def __contains__(self, key):
+        return self._key(key) in self.cache
+
+    def __iter__(self):
+        return iter([
+            k[len(self.prefix):] for k in list(self.cache)
+            if k.startswith(self.prefix)
+        ])
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+    def retain(self, key, count=1):
+        if isinstance(self.cache, (MetricCache, CacheScope)):
+            self.cache.retain(self._key(key), count)
+
+    def release(self, key):
+        if isinstance(self.cache, (MetricCache, CacheScope)):
+            self.cache.release(self._key(key))
@@ -1,7 +1,5 @@
 from abc import ABCMeta
-from shutil import copyfile
 
-import nibabel as nib
 from numpy import (absolute,
                    array,
                    cbrt,
@@ -11,7 +9,6 @@ from numpy import (absolute,
                    isclose,
                    moveaxis,
                    prod,
-                   repeat,
                    roll,
                    sqrt,
                    sum,
@@ -19,8 +16,6 @@ from numpy import (absolute,
                    zeros,
                    any as npany)
 
-from numpy.ma import array as masked
-
 from mrHARDI.traits.metrics.base import (BaseMetric,
                                               get_from_metric_cache,
                                               load_from_cache)
@@ -28,6 +23,7 @@ from mrHARDI.compute.math.linalg import (compute_ad,
                                               compute_fa,
                                               compute_md,
                                               compute_rd)
+from mrHARDI.compute.math.stats import weighted_moments
 from mrHARDI.compute.math.tensor import (compute_eigenvalues,
                                               compute_haeberlen)
 
@@ -39,7 +35,8 @@ class DiamondMetric(BaseMetric, metaclass=ABCMeta):
         with_res=False, with_hind=False, mosemap=None, **kwargs
     ):
         super().__init__(
-            in_prefix, out_prefix, cache, affine, mask, shape, colors
+            in_prefix, out_prefix, cache, affine, mask, shape, colors,
+            **kwargs
         )
         self.mose = mosemap
         self.n = min(self._max_n_from_model_selection(), n)
@@ -47,6 +44,57 @@ class DiamondMetric(BaseMetric, metaclass=ABCMeta):
         self.res = with_res
         self.hin = with_hind
 
+    def dependencies(self):
+        deps = []
+        for name in self.requires:
+            if name in ["tensors", "eigs"]:
+                deps.extend("{}_t{}".format(name, i) for i in range(self.n))
+            else:
+                deps.append(name)
+
+        return tuple(deps)
+
+    def inputs(self):
+        mosemap = self.mose if self.mose else "{}_mosemap.nii.gz".format(
+            self.prefix
+        )
+        return super().inputs() + [
+            "{}_t{}.nii.gz".format(self.prefix, i) for i in range(self.n)
+        ] + ["{}_fractions.nii.gz".format(self.prefix), mosemap]
+
+    def intermediates(self):
+        fascicles = range(self.n)
+        intermediates = {
+            "masks": (
+                (), self._get_fascicles_mask,
+                ["t{}_f_mask".format(i) for i in fascicles]
+            ),
+            "fractions": ((), self._get_fractions, ["fractions"]),
+            "haeberlen": (
+                tuple("tensors_t{}".format(i) for i in fascicles) +
+                ("masks",),
+                self._compute_haeberlen,
+                ["t{}_{}".format(i, m) for i in fascicles for m in [
+                    "diso", "daniso", "ddelta", "deta"
+                ]]
+            ),
+            "mdiso": (
+                ("haeberlen", "masks", "fractions"), self._get_mdiso,
+                ["mdiso"]
+            )
+        }
+        for i in fascicles:
+            intermediates["tensors_t{}".format(i)] = (
+                (), lambda i=i: self._get_tensor(i), ["t{}".format(i)]
+            )
+            intermediates["eigs_t{}".format(i)] = (
+                ("tensors_t{}".format(i), "masks"),
+                lambda i=i: self._get_fascicle_eigs(i),
+                ["eigs_t{}".format(i)]
+            )
+
+        return intermediates
+
     def _fascicles_fraction_chunk(self):
         back_idx = 1 if self.fw else 0
         return slice(0, -back_idx)
@@ -62,65 +110,76 @@ class DiamondMetric(BaseMetric, metaclass=ABCMeta):
             lambda f: self._load_image(
                 "{}_{}.nii.gz".format(self.prefix, f)
             ).squeeze(),
-            add_keys
+            add_keys,
+            self.eigen_solver,
+            self.dtype
         )
 
-    def _get_tensors(self, add_keys=()):
-        return [load_from_cache(
+    def _get_fascicle_eigs(self, i, add_keys=()):
+        return get_eigs(
+            ["t{}".format(i)],
+            [self._get_fascicle_mask(i, add_keys)],
+            self.cache,
+            lambda f: self._load_image(
+                "{}_{}.nii.gz".format(self.prefix, f)
+            ).squeeze(),
+            add_keys,
+            self.eigen_solver,
+            self.dtype
+        )[0]
+
+    def _get_tensor(self, i, add_keys=()):
+        return load_from_cache(
             self.cache,
             add_keys + ("t{}".format(i),),
             lambda f: self._load_image(
                 "{}_{}.nii.gz".format(self.prefix, f)
             ).squeeze()
-        ) for i in range(self.n)]
+        )
 
-    def _weighted(self, volumes, alt_w=None, add_keys=(), mask=None, axis=0):
-        if alt_w is None:
-            alt_w = self._get_fascicle_fractions(add_keys)
+    def _get_tensors(self, add_keys=()):
+        return [self._get_tensor(i, add_keys) for i in range(self.n)]
 
-        if axis == 0:
-            idx = 'l...'
-        elif axis == -1 or axis == len(volumes.shape) - 1:
-            idx = '...l'
-        else:
-            raise RuntimeError(
-                "Weighted means must be done on first or last axis for now"
-            )
+    def _compute_haeberlen(self):
+        missing = [
+            i for i in range(self.n) if "t{}_diso".format(i) not in self.cache
+        ]
+        if len(missing) == 0:
+            return
 
-        if mask is not None:
-            mask = moveaxis(mask, axis, -1)
-            alt_w *= mask
+        tensors = self._get_tensors()
+        decomposition = compute_haeberlen(
+            array([tensors[i] for i in missing]),
+            array([self._get_fascicle_mask(i) for i in missing]),
+            dtype=self.dtype
+        )
 
-        if not len(alt_w.shape) == len(volumes.shape):
-            rep_axis = 0 if axis else -1
-            alt_w = alt_w[..., None, :] if rep_axis else alt_w[None, ...]
-            alt_w = repeat(
-                alt_w, volumes.shape[rep_axis], -2 if rep_axis else 0
-            )
-        elif any(
-            not ash == vsh for ash, vsh in zip(
-                roll(alt_w.shape, 1), volumes.shape
-            )
-        ):
-            rep_axis = -1 if not alt_w.shape[0] == volumes.shape[-1] else 0
-            alt_w = repeat(alt_w, volumes.shape[rep_axis], rep_axis)
+        for j, i in enumerate(missing):
+            for name, values in zip(
+                ["diso", "daniso", "ddelta", "deta"], decomposition
+            ):
+                self.cache["t{}_{}".format(i, name)] = values[j]
 
-        return einsum('...l,{}'.format(idx), alt_w, volumes)
+    def _get_mdiso(self):
+        return self.load_from_cache(
+            "mdiso", lambda _: self._masked_fascicle_mean_metric(
+                haeberlen_loader(self, "diso")
+            )
+        )
 
     def _weight_over_tensors(self, metric, prepare=lambda wm: wm):
         if self.n == 1:
-            copyfile(
-                "{}_t0_{}.nii.gz".format(self.output, metric),
+            self._save_image(
+                prepare(self.cache["t0_{}".format(metric)]),
                 "{}_{}.nii.gz".format(self.output, metric)
             )
 
         elif self.n > 0:
-            w_metric = self._weighted(array([
+            w_metric = self._masked_fascicle_mean_metric(array([
                 self.cache["t{}_{}".format(i, metric)] for i in range(self.n)
             ]))
-            nib.save(
-                nib.Nifti1Image(prepare(w_metric), self.affine),
-                "{}_{}.nii.gz".format(self.output, metric)
+            self._save_image(
+                prepare(w_metric), "{}_{}.nii.gz".format(self.output, metric)
             )
 
     def _max_n_from_model_selection(self):
@@ -158,21 +217,23 @@ class DiamondMetric(BaseMetric, metaclass=ABCMeta):
     def _get_fascicles_mask(self):
         return array([self._get_fascicle_mask(i) for i in range(self.n)])
 
-    def _masked_fascicle_mean_metric(self, metrics, last_dims=(), axis=0):
-        mask = self.get_mask()
-        f_mask = self._get_fascicles_mask()
-        if not axis == 0:
-            f_mask = moveaxis(f_mask, 0, axis)
-        metric = zeros(self._get_shape() + last_dims)
-        metric[mask] = self._weighted(metrics, mask=f_mask, axis=axis)[mask]
-        return metric
-
-    def _masked_fascicle_mean_functional(self, metrics, fn, last_dims=()):
+    def _fascicle_moments(self, metrics, moments=("mean",), axis=0):
         mask = self.get_mask()
-        f_mask = self._get_fascicles_mask()
-        metric = zeros(self._get_shape() + last_dims)
-        metric[mask] = fn(masked(metrics, mask=~f_mask), mask)
-        return metric
+        weights = moveaxis(self._get_fascicle_fractions(), -1, 0)[:, mask] * \
+            self._get_fascicles_mask()[:, mask]
+
+        maps = []
+        for moment in weighted_moments(
+            moveaxis(metrics, axis, 0)[:, mask], weights, moments
+        ):
+            _map = zeros(mask.shape + moment.shape[1:], dtype=moment.dtype)
+            _map[mask] = moment
+            maps.append(_map)
+
+        return maps
+
+    def _masked_fascicle_mean_metric(self, metrics, axis=0):
+        return self._fascicle_moments(metrics, ("mean",), axis)[0]
 
     def _color_metric(self, name, evecs=None, add_keys=(), **kwargs):
         evecs = [e[1] for e in self._get_eigs()] if evecs is None else evecs
@@ -186,57 +247,53 @@ class DiamondMetric(BaseMetric, metaclass=ABCMeta):
 
 
 class FmdMetric(DiamondMetric):
+    requires = ("eigs", "masks", "fractions")
+
     def measure(self):
         for i, eig_set in enumerate(self._get_eigs()):
             img = compute_md(eig_set, self._get_fascicle_mask(i))
             self.cache["t{}_md".format(i)] = img
 
-            nib.save(
-                nib.Nifti1Image(img, self.affine),
-                "{}_t{}_md.nii.gz".format(self.output, i)
-            )
+            self._save_image(img, "{}_t{}_md.nii.gz".format(self.output, i))
 
         self._weight_over_tensors("md")
 
 
 class FadMetric(DiamondMetric):
+    requires = ("eigs", "masks", "fractions")
+
     def measure(self):
         for i, eig_set in enumerate(self._get_eigs()):
             img = compute_ad(eig_set, self._get_fascicle_mask(i))
             self.cache["t{}_ad".format(i)] = img
 
-            nib.save(
-                nib.Nifti1Image(img, self.affine),
-                "{}_t{}_ad.nii.gz".format(self.output, i)
-            )
+            self._save_image(img, "{}_t{}_ad.nii.gz".format(self.output, i))
 
         self._weight_over_tensors("ad")
 
 
 class FrdMetric(DiamondMetric):
+    requires = ("eigs", "masks", "fractions")
+
     def measure(self):
         for i, eig_set in enumerate(self._get_eigs()):
             img = compute_rd(eig_set, self._get_fascicle_mask(i))
             self.cache["t{}_rd".format(i)] = img
 
-            nib.save(
-                nib.Nifti1Image(img, self.affine),
-                "{}_t{}_rd.nii.gz".format(self.output, i)
-            )
+            self._save_image(img, "{}_t{}_rd.nii.gz".format(self.output, i))
 
         self._weight_over_tensors("rd")
 
 
 class FfaMetric(DiamondMetric):
+    requires = ("eigs", "masks", "fractions")
+
     def measure(self):
         for i, eig_set in enumerate(self._get_eigs()):
             img = compute_fa(eig_set, self._get_fascicle_mask(i))
             self.cache["t{}_fa".format(i)] = img
 
-            nib.save(
-                nib.Nifti1Image(img, self.affine),
-                "{}_t{}_fa.nii.gz".format(self.output, i)
-            )
+            self._save_image(img, "{}_t{}_fa.nii.gz".format(self.output, i))
 
         self._weight_over_tensors("fa")
         self._color("fa")
@@ -246,10 +303,7 @@ class FfaMetric(DiamondMetric):
         x, y, z = indices(ffa.shape[1:])
         ffa = ffa[maxidxs, x, y, z]
         evecs = array([e[1] for e in self._get_eigs()])
-        nib.save(
-            nib.Nifti1Image(ffa, self.affine),
-            "{}_max_ffa.nii.gz".format(self.output)
-        )
+        self._save_image(ffa, "{}_max_ffa.nii.gz".format(self.output))
         self.cache["max_ffa"] = ffa
         if self.colors:
             BaseMetric._color_metric(
@@ -258,25 +312,28 @@ class FfaMetric(DiamondMetric):
 
 
 class FfMetric(DiamondMetric):
+    requires = ("fractions",)
+
     def measure(self):
         fractions = self._get_fascicle_fractions()
 
         for i, fraction in enumerate(moveaxis(fractions, -1, 0)):
-            nib.save(
-                nib.Nifti1Image(fraction, self.affine),
-                "{}_t{}_fraction.nii.gz".format(self.output, i)
+            self._save_image(
+                fraction, "{}_t{}_fraction.nii.gz".format(self.output, i)
             )
 
-        nib.save(
-            nib.Nifti1Image(
-                self._load_image("{}_fractions.nii.gz".format(self.prefix)),
-                self.affine
-            ),
+        self._save_image(
+            self._load_image("{}_fractions.nii.gz".format(self.prefix)),
             "{}_fractions.nii.gz".format(self.output)
         )
 
 
 class RfMetric(DiamondMetric):
+    def inputs(self):
+        return super().inputs() + [
+            "{}_isotropic2Fraction.nii.gz".format(self.prefix)
+        ]
+
     def measure(self):
         if self.res:
             fraction = self.load_from_cache(
@@ -285,13 +342,15 @@ class RfMetric(DiamondMetric):
                 )
             )
 
-            nib.save(
-                nib.Nifti1Image(fraction, self.affine),
-                "{}_restricted_fraction.nii.gz".format(self.output)
+            self._save_image(
+                fraction, "{}_restricted_fraction.nii.gz".format(self.output)
             )
 
 
 class HfMetric(DiamondMetric):
+    def inputs(self):
+        return super().inputs() + ["{}_icvf.nii.gz".format(self.prefix)]
+
     def measure(self):
         if self.hin:
             if any(
@@ -302,8 +361,8 @@ class HfMetric(DiamondMetric):
                 )
                 for i, fraction in enumerate(moveaxis(fractions, -1, 0)):
                     self.cache["t{}_hf".format(i)] = fraction.squeeze()
-                    nib.save(
-                        nib.Nifti1Image(fraction.squeeze(), self.affine),
+                    self._save_image(
+                        fraction.squeeze(),
                         "{}_t{}_hindered_fraction.nii.gz".format(
                             self.output, i
                         )
@@ -311,17 +370,19 @@ class HfMetric(DiamondMetric):
 
 
 class WfMetric(DiamondMetric):
+    requires = ("fractions",)
+
     def measure(self):
         if self.fw:
             fractions = self._get_fractions()
-
-            nib.save(
-                nib.Nifti1Image(fractions[..., -1], self.affine),
-                "{}_fFW.nii.gz".format(self.output)
+            self._save_image(
+                fractions[..., -1], "{}_fFW.nii.gz".format(self.output)
             )
 
 
 class PeaksMetric(DiamondMetric):
+    requires = ("eigs", "masks")
+
     def measure(self):
         if "peaks" in self.cache:
             peaks = self.cache["peaks"]
@@ -341,26 +402,14 @@ class PeaksMetric(DiamondMetric):
 
             self.cache["peaks"] = peaks
 
-        nib.save(
-            nib.Nifti1Image(peaks, self.affine),
-            "{}_peaks.nii.gz".format(self.output)
-        )
+        self._save_image(peaks, "{}_peaks.nii.gz".format(self.output))
 
 
 class HaeberlenConvention(DiamondMetric):
-    def measure(self):
-        tensors = self._get_tensors()
+    requires = ("haeberlen",)
 
-        for i, tensor_set in enumerate(tensors):
-            if not "t{}_diso".format(i) in self.cache:
-                diso, daniso, ddelta, deta = compute_haeberlen(
-                    tensor_set, self._get_fascicle_mask(i)
-                )
-
-                self.cache["t{}_diso".format(i)] = diso
-                self.cache["t{}_daniso".format(i)] = daniso
-                self.cache["t{}_ddelta".format(i)] = ddelta
-                self.cache["t{}_deta".format(i)] = deta
+    def measure(self):
+        self._compute_haeberlen()
 
 
 def haeberlen_loader(base_obj, metric, sub_cache=None):
@@ -368,7 +417,7 @@ def haeberlen_loader(base_obj, metric, sub_cache=None):
         return get_from_metric_cache(keys, HaeberlenConvention(
             base_obj.n, base_obj.prefix, base_obj.output, base_obj.cache,
             base_obj.affine, base_obj.mask, base_obj.shape,
-            base_obj.fw, base_obj.res
+            base_obj.fw, base_obj.res, dtype=base_obj.dtype
         ))
 
     sub_cache = base_obj.cache[sub_cache] if sub_cache else base_obj.cache
@@ -378,85 +427,80 @@ def haeberlen_loader(base_obj, metric, sub_cache=None):
 
 
 class DisoMetric(DiamondMetric):
+    requires = ("haeberlen",)
+
     def measure(self):
         for i, diso in enumerate(haeberlen_loader(self, "diso")):
-            nib.save(
-                nib.Nifti1Image(diso, self.affine),
-                "{}_t{}_diso.nii.gz".format(self.output, i)
-            )
+            self._save_image(diso, "{}_t{}_diso.nii.gz".format(self.output, i))
 
 
 class DanisoMetric(DiamondMetric):
+    requires = ("haeberlen",)
+
     def measure(self):
         for i, diso in enumerate(haeberlen_loader(self, "daniso")):
-            nib.save(
-                nib.Nifti1Image(diso, self.affine),
-                "{}_t{}_daniso.nii.gz".format(self.output, i)
+            self._save_image(
+                diso, "{}_t{}_daniso.nii.gz".format(self.output, i)
             )
 
 
 class MdisoMetric(DiamondMetric):
+    requires = ("mdiso",)
+
     def measure(self):
-        disos = haeberlen_loader(self, "diso")
+        mdiso = self._get_mdiso()
 
-        mdiso = self._masked_fascicle_mean_metric(disos)
-        self.cache["mdiso"] = mdiso
-
-        nib.save(
-            nib.Nifti1Image(mdiso, self.affine),
-            "{}_mdiso.nii.gz".format(self.output)
-        )
+        self._save_image(mdiso, "{}_mdiso.nii.gz".format(self.output))
 
 
 class MdanisoMetric(DiamondMetric):
+    requires = ("haeberlen", "masks", "fractions")
+
     def measure(self):
         danisos = haeberlen_loader(self, "daniso")
 
         mda = self._masked_fascicle_mean_metric(danisos)
 
-        nib.save(
-            nib.Nifti1Image(mda, self.affine),
-            "{}_mdaniso.nii.gz".format(self.output)
-        )
+        self._save_image(mda, "{}_mdaniso.nii.gz".format(self.output))
 
 
 class SraMetric(DiamondMetric):
+    requires = ("eigs", "haeberlen", "masks")
+
     def measure(self):
         eigs = self._get_eigs()
         disos = haeberlen_loader(self, "diso")
         for i, (eig, diso) in enumerate(zip(eigs, disos)):
             evals, evecs = eig
             mask = self._get_fascicle_mask(i) & ~isclose(diso, 0.)
-            sra = zeros(mask.shape)
+            sra = zeros(mask.shape, dtype=self.dtype)
 
             sra[mask] = 1. / diso[mask] * sqrt(
                 sum((evals - diso[..., None]) ** 2.) / 6.
             )
 
-            nib.save(
-                nib.Nifti1Image(sra, self.affine),
-                "{}_t{}_sra.nii.gz".format(self.output, i)
-            )
+            self._save_image(sra, "{}_t{}_sra.nii.gz".format(self.output, i))
 
 
 class VfMetric(DiamondMetric):
+    requires = ("eigs", "haeberlen", "masks")
+
     def measure(self):
         eigs = self._get_eigs()
         disos = haeberlen_loader(self, "diso")
         for i, (eig, diso) in enumerate(zip(eigs, disos)):
             evals, evecs = eig
             mask = self._get_fascicle_mask(i) & ~isclose(diso, 0.)
-            vf = zeros(mask.shape)
+            vf = zeros(mask.shape, dtype=self.dtype)
 
             vf[mask] = 1. - prod(evals[mask], 1) / (diso[mask] ** 3.)
 
-            nib.save(
-                nib.Nifti1Image(vf, self.affine),
-                "{}_t{}_vf.nii.gz".format(self.output, i)
-            )
+            self._save_image(vf, "{}_t{}_vf.nii.gz".format(self.output, i))
 
 
 class UaMetric(DiamondMetric):
+    requires = ("eigs", "haeberlen", "masks")
+
     def measure(self):
         eigs = self._get_eigs()
         disos = haeberlen_loader(self, "diso")
@@ -464,8 +508,9 @@ class UaMetric(DiamondMetric):
             evals, evecs = eig
             mask = self._get_fascicle_mask(i) & ~isclose(diso, 0.)
 
-            uas, uav = zeros(mask.shape), zeros(mask.shape)
-            uavs = zeros(mask.shape)
+            uas = zeros(mask.shape, dtype=self.dtype)
+            uav = zeros(mask.shape, dtype=self.dtype)
+            uavs = zeros(mask.shape, dtype=self.dtype)
 
             sq3_evals = sqrt(absolute(einsum(
                 "...l,...l", evals[mask], roll(evals[mask], -1, 1)
@@ -479,77 +524,53 @@ class UaMetric(DiamondMetric):
             mask[mask] &= mask2
             uavs[mask] = 1. - cbp_evals[mask2] / sq3_evals[mask2]
 
-            nib.save(
-                nib.Nifti1Image(uas, self.affine),
-                "{}_t{}_uas.nii.gz".format(self.output, i)
-            )
+            self._save_image(uas, "{}_t{}_uas.nii.gz".format(self.output, i))
 
-            nib.save(
-                nib.Nifti1Image(uav, self.affine),
-                "{}_t{}_uav.nii.gz".format(self.output, i)
-            )
+            self._save_image(uav, "{}_t{}_uav.nii.gz".format(self.output, i))
 
-            nib.save(
-                nib.Nifti1Image(uavs, self.affine),
-                "{}_t{}_uavs.nii.gz".format(self.output, i)
-            )
+            self._save_image(uavs, "{}_t{}_uavs.nii.gz".format(self.output, i))
 
 
 class VisoMetric(DiamondMetric):
+    requires = ("haeberlen", "mdiso", "masks", "fractions")
+
     def measure(self):
         disos = haeberlen_loader(self, "diso")
-        mdiso = self.load_from_cache("mdiso", lambda _: get_from_metric_cache(
-            ("mdiso",), MdisoMetric(
-                self.n, self.prefix, self.output, self.cache,
-                self.affine, self.mask, self.shape, self.fw, self.res
-            )
-        ))
+        mdiso = self._get_mdiso()
 
-        viso = self._masked_fascicle_mean_functional(
-            disos,
-            lambda a, mask: self._weighted(a ** 2.)[mask] - mdiso[mask] ** 2.
-        )
+        viso = self._fascicle_moments(disos, ("second",))[0] - mdiso ** 2.
 
-        nib.save(
-            nib.Nifti1Image(viso, self.affine),
-            "{}_viso.nii.gz".format(self.output)
-        )
+        self._save_image(viso, "{}_viso.nii.gz".format(self.output))
 
 
 class VeigMetric(DiamondMetric):
+    requires = ("haeberlen", "masks", "fractions")
+
     def measure(self):
         danisos = haeberlen_loader(self, "daniso")
 
-        veig = self._masked_fascicle_mean_functional(
-            danisos, lambda arr, mask: 2. * self._weighted(arr ** 2.)[mask]
-        )
+        veig = 2. * self._fascicle_moments(danisos, ("second",))[0]
 
-        nib.save(
-            nib.Nifti1Image(veig, self.affine),
-            "{}_veig.nii.gz".format(self.output)
-        )
+        self._save_image(veig, "{}_veig.nii.gz".format(self.output))
 
 
 class VdeltaMetric(DiamondMetric):
+    requires = ("haeberlen", "masks", "fractions")
+
     def measure(self):
         danisos = haeberlen_loader(self, "daniso")
-        mask = self._get_fascicles_mask()
 
-        danisos[mask] = danisos[mask] ** 2.
+        vdelta = 4. * self._fascicle_moments(
+            danisos ** 2., ("variance",)
+        )[0]
 
-        vdelta = self._masked_fascicle_mean_functional(
-            danisos, lambda arr, m: 4. * (
-                self._weighted(arr ** 2.)[m] - self._weighted(arr)[m] ** 2.
-            )
-        )
-
-        nib.save(
-            nib.Nifti1Image(vdelta, self.affine),
-            "{}_vdelta.nii.gz".format(self.output)
-        )
+        self._save_image(vdelta, "{}_vdelta.nii.gz".format(self.output))
 
 
-def get_eigs(fascicles, mask, cache, alternative=None, add_keys=()):
+def get_eigs(
+    fascicles, mask, cache, alternative=None, add_keys=(), solver="eigh",
+    dtype=float
+):
     f_eigs = []
     for i, fascicle in enumerate(fascicles):
         eigs = load_from_cache(
@@ -565,7 +586,9 @@ def get_eigs(fascicles, mask, cache, alternative=None, add_keys=()):
         else:
             f_mask = mask
 
-        eigs = compute_eigenvalues(f, f_mask) if npany(f_mask) else None
+        eigs = compute_eigenvalues(
+            f, f_mask, solver=solver, dtype=dtype
+        ) if npany(f_mask) else None
         sub_cache = cache
         for key in add_keys:
             sub_cache = sub_cache[key]
@@ -1,17 +1,16 @@
 from abc import ABCMeta
 
-import nibabel as nib
 from numpy import float32
 
 from mrHARDI.traits.metrics.base import BaseMetric, eigs_with_strides
-from mrHARDI.compute.math.linalg import (compute_ad,
-                                              compute_fa,
-                                              compute_md,
-                                              compute_peaks,
-                                              compute_rd)
+from mrHARDI.compute.math.linalg import (compute_dti_scalars,
+                                              compute_peaks)
 
 
 class DTIMetric(BaseMetric, metaclass=ABCMeta):
+    def inputs(self):
+        return super().inputs() + ["{}_dti.nii.gz".format(self.prefix)]
+
     def _get_eigs(self):
         return self.load_from_cache(
             "eigs", lambda _: eigs_with_strides(
@@ -20,26 +19,45 @@ class DTIMetric(BaseMetric, metaclass=ABCMeta):
                     "{}_dti.nii.gz".format(self.prefix)
                 ).squeeze(),
                 self.get_mask(),
-                (0, 3, 1, 4, 5, 2)
+                (0, 3, 1, 4, 5, 2),
+                solver=self.eigen_solver,
+                dtype=self.dtype
             )
         )
 
+    def _get_scalar(self, name):
+        return self.load_from_cache(
+            name, lambda _: self._compute_scalars((name,))[name]
+        )
+
+    def _compute_scalars(self, metrics):
+        return compute_dti_scalars(self._get_eigs(), self.get_mask(), metrics)
+
     def _get_peaks(self):
         return self.load_from_cache(
             "peaks", lambda _: compute_peaks(self._get_eigs(), self.get_mask())
         )
 
 
+class DTIScalars(DTIMetric):
+    def __init__(
+        self, prefix, output, cache, affine,
+        metrics=("fa", "md", "ad", "rd"), **kwargs
+    ):
+        super().__init__(prefix, output, cache, affine, **kwargs)
+        self.metrics = metrics
+
+    def measure(self):
+        missing = [m for m in self.metrics if m not in self.cache]
+        if len(missing) > 0:
+            self.cache.update(self._compute_scalars(missing))
+
+
 class FaMetric(DTIMetric):
     def measure(self):
-        fa = self.load_from_cache(
-            "fa", lambda _: compute_fa(self._get_eigs(), self.get_mask())
-        )
+        fa = self._get_scalar("fa")
 
-        nib.save(
-            nib.Nifti1Image(fa, self.affine),
-            "{}_fa.nii.gz".format(self.output)
-        )
+        self._save_image(fa, "{}_fa.nii.gz".format(self.output))
 
         _, evecs = self._get_eigs()
 
@@ -48,45 +66,29 @@ class FaMetric(DTIMetric):
 
 class MdMetric(DTIMetric):
     def measure(self):
-        md = self.load_from_cache(
-            "md", lambda _: compute_md(self._get_eigs(), self.get_mask())
-        )
+        md = self._get_scalar("md")
 
-        nib.save(
-            nib.Nifti1Image(md, self.affine),
-            "{}_md.nii.gz".format(self.output)
-        )
+        self._save_image(md, "{}_md.nii.gz".format(self.output))
 
 
 class AdMetric(DTIMetric):
     def measure(self):
-        ad = self.load_from_cache(
-            "ad", lambda _: compute_ad(self._get_eigs(), self.get_mask())
-        )
+        ad = self._get_scalar("ad")
 
-        nib.save(
-            nib.Nifti1Image(ad, self.affine),
-            "{}_ad.nii.gz".format(self.output)
-        )
+        self._save_image(ad, "{}_ad.nii.gz".format(self.output))
 
 
 class RdMetric(DTIMetric):
     def measure(self):
-        rd = self.load_from_cache(
-            "rd", lambda _: compute_rd(self._get_eigs(), self.get_mask())
-        )
+        rd = self._get_scalar("rd")
 
-        nib.save(
-            nib.Nifti1Image(rd, self.affine),
-            "{}_rd.nii.gz".format(self.output)
-        )
+        self._save_image(rd, "{}_rd.nii.gz".format(self.output))
 
 
 class PeaksMetric(DTIMetric):
     def measure(self):
         peaks = self._get_peaks()
 
-        nib.save(
-            nib.Nifti1Image(peaks.astype(float32), self.affine),
-            "{}_peaks.nii.gz".format(self.output)
+        self._save_image(
+            peaks.astype(float32), "{}_peaks.nii.gz".format(self.output)
         )
@@ -1,231 +1,180 @@
 from abc import ABCMeta
-from os.path import join
+from concurrent.futures import ThreadPoolExecutor
+from os.path import basename, exists, join, normpath
 
-import nibabel as nib
 from numpy import array, isclose, mean, ones, sqrt, zeros
 
-from mrHARDI.traits.metrics.base import get_from_metric_cache
-from mrHARDI.traits.metrics.diamond import (DiamondMetric,
-                                                 MdisoMetric,
-                                                 VisoMetric,
-                                                 haeberlen_loader)
+from mrHARDI.compute.math.tensor import compute_haeberlen
+from mrHARDI.traits.metrics.base import load_from_cache
+from mrHARDI.traits.metrics.cache import CacheScope
+from mrHARDI.traits.metrics.diamond import DiamondMetric, haeberlen_loader
 
 
-class MagicDiamondMetric(DiamondMetric, metaclass=ABCMeta):
-    def __init__(
-        self, n, in_prefix, out_prefix, cache, affine, linear_path,
-        spherical_path, planar_path=None, **kwargs
-    ):
-        super().__init__(
-            n, in_prefix, out_prefix, cache, affine, **kwargs
-        )
+_ENCODINGS = ("lin", "sph", "pla")
+
+
+def encoding_prefix(prefix, enc):
+    return join(prefix, enc, basename(normpath(prefix)))
+
+
+class EncodingMetric(DiamondMetric):
+    """
+    View over the diamond outputs of a single encoding, sharing the cache
+    of that encoding between all magic diamond metrics.
+    """
+    def measure(self):
+        pass
 
-        self.paths = {
-            "lin": linear_path, "sph": spherical_path, "pla": planar_path
+
+class MagicDiamondMetric(DiamondMetric, metaclass=ABCMeta):
+    serial = True
+
+    def __init__(self, n, in_prefix, out_prefix, cache, affine, **kwargs):
+        super().__init__(n, in_prefix, out_prefix, cache, affine, **kwargs)
+
+        # Views load the mask of their encoding, combined afterward
+        view_kwargs = dict(kwargs, mask=None)
+        self.views = {
+            enc: EncodingMetric(
+                n, encoding_prefix(in_prefix, enc), out_prefix,
+                CacheScope(cache, enc), affine, **view_kwargs
+            ) for enc in _ENCODINGS if exists(join(in_prefix, enc))
         }
-        self.cache["lin"] = {}
-        self.cache["sph"] = {}
-        self.cache["pla"] = {}
+
+        self._compound = False
+        mask = self.get_compound_mask()
+        for view in self.views.values():
+            view.mask = mask
+
+    def inputs(self):
+        return super().inputs() + [
+            f for view in self.views.values() for f in view.inputs()
+        ]
 
     def get_compound_mask(self):
-        if self.mask is not None:
-            return self.mask
-
-        prefix = self.prefix
-        mask = ones(self._get_shape())
-        for enc, path in filter(lambda it: it[1], self.paths.items()):
-            self.prefix = join(path, prefix)
-            try:
-                mask &= self.get_mask((enc,))
-            except Exception:
-                pass
-
-        self.prefix = prefix
-        return mask
-
-    def _get_eigs(self, add_keys=()):
-        prefix = self.prefix
-        eigs = []
-        for enc, path in filter(
-            lambda it: it[1], self.paths.values()
-        ):
-            self.prefix = join(path, prefix)
-            eigs.append(super()._get_eigs((enc,)))
-
-        self.prefix = prefix
-        return eigs
-
-    def _get_bvecs(self, add_keys=()):
-        prefix = self.prefix
-        bvecs = []
-        for enc, path in filter(
-            lambda it: it[1], self.paths.values()
-        ):
-            self.prefix = join(path, prefix)
-            bvecs.append(super()._get_bvecs((enc,)))
-
-        self.prefix = prefix
-        return bvecs
-
-    def _get_tensors(self, add_keys=()):
-        prefix = self.prefix
-        tensors = []
-        for enc, path in filter(
-            lambda it: it[1], self.paths.values()
-        ):
-            self.prefix = join(path, prefix)
-            tensors.append(super()._get_tensors((enc,)))
-
-        self.prefix = prefix
-        return tensors
-
-    def _haeberlen(self, enc, metric):
-        prefix = self.prefix
-        self.prefix = join(self.paths[enc], prefix)
-        lin_daniso = self.load_from_cache(
-            (enc, metric), lambda _: haeberlen_loader(
-                self, metric, enc
+        if not self._compound:
+            mask = ones(self._get_shape(), dtype=bool) if self.mask is None \
+                else self.mask.astype(bool)
+            for view in self.views.values():
+                mask &= view.get_mask().astype(bool)
+
+            self.mask, self._compound = mask, True
+
+        return self.mask
+
+    def _load_encodings(self):
+        views = list(self.views.values())
+        with ThreadPoolExecutor(len(views)) as executor:
+            list(executor.map(lambda v: (
+                v._get_tensors(), v._get_fractions(), v._get_fascicles_mask()
+            ), views))
+
+        # Haeberlen decomposition of every fascicle of every encoding
+        pending = [
+            (v, i) for v in views for i in range(v.n)
+            if "t{}_diso".format(i) not in v.cache
+        ]
+        if len(pending) > 0:
+            decomposition = compute_haeberlen(
+                array([v._get_tensor(i) for v, i in pending]),
+                array([v._get_fascicle_mask(i) for v, i in pending]),
+                dtype=self.dtype
             )
-        )
+            for j, (v, i) in enumerate(pending):
+                for name, values in zip(
+                    ["diso", "daniso", "ddelta", "deta"], decomposition
+                ):
+                    v.cache["t{}_{}".format(i, name)] = values[j]
+
+    def _moments(self, enc):
+        def _compute(_):
+            self._load_encodings()
+            view = self.views[enc]
+            mdiso, diso_2nd = view._fascicle_moments(
+                haeberlen_loader(view, "diso"), ("mean", "second")
+            )
+            daniso_2nd, = view._fascicle_moments(
+                haeberlen_loader(view, "daniso"), ("second",)
+            )
+            return mdiso, diso_2nd, daniso_2nd
 
-        self.prefix = prefix
-        return lin_daniso
+        # Cached as a tuple of arrays, accounted for by the metric cache
+        return dict(zip(
+            ["mdiso", "diso_2nd", "daniso_2nd"],
+            load_from_cache(self.views[enc].cache, "moments", _compute)
+        ))
 
     def _sph_2nd_moment(self):
-        prefix = self.prefix
-        self.prefix = join(self.paths["sph"], prefix)
-        sph_2nd_moment = self.load_from_cache(
-            ("sph", "viso"), lambda _: get_from_metric_cache(
-                ("sph", "viso"), VisoMetric(
-                    self.n, self.prefix, self.output,
-                    self.cache["sph"], self.get_mask(("sph",)),
-                    self.affine
-                )
-            )
-        )
-
-        self.prefix = prefix
-        return sph_2nd_moment
+        moments = self._moments("sph")
+        return moments["diso_2nd"] - moments["mdiso"] ** 2.
 
     def _lin_2nd_moment(self):
-        lin_daniso = self._haeberlen("lin", "daniso")
-        sph_2nd_moment = self._sph_2nd_moment()
+        return 4. / 5. * self._moments("lin")["daniso_2nd"] + \
+            self._sph_2nd_moment()
 
-        return self.load_from_cache(
-            ("lin", "2nd_mom"),
-            lambda _: 4. / 5. * mean(lin_daniso ** 2., -1) + sph_2nd_moment
-        )
-
-    def _build_lin_2nd_moment(self, *_):
-        lin_daniso = self._haeberlen("lin", "daniso")
-        sph_2nd_moment = self._sph_2nd_moment()
-        mask = self._get_fascicles_mask()
-        lin_daniso[mask] = lin_daniso[mask] ** 2.
-        return 4. / 5. * self._masked_fascicle_mean_metric(
-            lin_daniso, axis=-1
-        ) + sph_2nd_moment
+    def _md(self):
+        return mean(array([
+            self._moments(enc)["mdiso"] for enc in self.views
+        ]), axis=0)
 
 
 class UfaMetric(MagicDiamondMetric):
     def measure(self):
         sph_2nd_moment = self._sph_2nd_moment()
         lin_2nd_moment = self._lin_2nd_moment()
-        mask = self.get_compound_mask()
-
-        lin_md = self.load_from_cache(
-            ("lin", "mdiso"), lambda _: get_from_metric_cache(
-                ("lin", "mdiso"), MdisoMetric(
-                    self.n, self.prefix, self.output,
-                    self.cache["lin"], mask, self.affine
-                )
-            )
-        )
-
-        denom, ufa = zeros(mask.shape), zeros(mask.shape)
-        denom[mask] = lin_2nd_moment[mask] - sph_2nd_moment[mask]
+        lin_md = self._moments("lin")["mdiso"]
 
-        mask &= ~isclose(denom, 0)
+        denom = lin_2nd_moment - sph_2nd_moment
+        mask = self.get_compound_mask() & ~isclose(denom, 0)
 
-        ufa[mask] = sqrt(3. / 2.) * 1. / sqrt(1. + 2. / 5. * (
-                lin_md[mask] ** 2. + sph_2nd_moment[mask]
+        ufa = zeros(mask.shape, dtype=self.dtype)
+        ufa[mask] = sqrt(3. / 2.) / sqrt(1. + 2. / 5. * (
+            lin_md[mask] ** 2. + sph_2nd_moment[mask]
         ) / denom[mask])
 
-        nib.save(
-            nib.Nifti1Image(ufa, self.affine),
-            "{}_ufa.nii.gz".format(self.output)
-        )
+        self._save_image(ufa, "{}_ufa.nii.gz".format(self.output))
 
 
 class OpMetric(MagicDiamondMetric):
     def measure(self):
-        sph_2nd_moment = self._sph_2nd_moment()
-        lin_2nd_moment = self._lin_2nd_moment()
-        mask = self.get_compound_mask()
-
-        eigs = array(self._get_eigs())
-        md_par, md_per = zeros(mask.shape), zeros(mask.shape)
-        md_par[mask] = mean(eigs[:, mask, 0, 0], axis=-1)
-        md_per[mask] = mean(eigs[:, mask, 0, 1:], axis=-1)
-
-        fa_2nd_moment, denom = zeros(mask.shape), zeros(mask.shape)
-        op = zeros(mask.shape)
-
-        denom[mask] = lin_2nd_moment[mask] - sph_2nd_moment[mask]
-
-        mask = mask & ~isclose(denom, 0)
-
-        fa_2nd_moment[mask] = 4. / 45. * (md_par[mask] - md_per[mask]) ** 2.
-
-        op[mask] = sqrt(fa_2nd_moment[mask] / denom[mask])
-
-        nib.save(
-            nib.Nifti1Image(op, self.affine),
-            "{}_op.nii.gz".format(self.output)
+        denom = self._lin_2nd_moment() - self._sph_2nd_moment()
+        mask = self.get_compound_mask() & ~isclose(denom, 0)
+
+        view = self.views["lin"]
+        evals = array([
+            zeros(mask.shape + (3,)) if eigs is None else eigs[0]
+            for eigs in view._get_eigs()
+        ])
+        md_par = view._masked_fascicle_mean_metric(evals[..., 0])
+        md_per = view._masked_fascicle_mean_metric(evals[..., 1:].mean(-1))
+
+        op = zeros(mask.shape, dtype=self.dtype)
+        op[mask] = sqrt(
+            4. / 45. * (md_par[mask] - md_per[mask]) ** 2. / denom[mask]
         )
 
+        self._save_image(op, "{}_op.nii.gz".format(self.output))
 
-class Mkiso(MagicDiamondMetric):
-    def measure(self):
-        sph_2nd_moment = self._sph_2nd_moment()
-        mask = self.get_compound_mask()
-
-        disos = [
-            self._haeberlen(enc, "diso")
-            for enc, _ in filter(lambda it: it[1], self.paths)
-        ]
 
-        md, mkiso = zeros(mask.shape), zeros(mask.shape)
-        md[mask] = self._masked_fascicle_mean_metric(array(disos))[mask]
+class MkisoMetric(MagicDiamondMetric):
+    def measure(self):
+        md = self._md()
+        mask = self.get_compound_mask() & ~isclose(md, 0.)
 
-        mask = mask & ~isclose(md, 0.)
-        mkiso[mask] = 2. * sph_2nd_moment[mask] / (md[mask] ** 2.)
+        mkiso = zeros(mask.shape, dtype=self.dtype)
+        mkiso[mask] = 2. * self._sph_2nd_moment()[mask] / (md[mask] ** 2.)
 
-        nib.save(
-            nib.Nifti1Image(mkiso, self.affine),
-            "{}_mkiso.nii.gz".format(self.output)
-        )
+        self._save_image(mkiso, "{}_mkiso.nii.gz".format(self.output))
 
 
-class Mkaniso(MagicDiamondMetric):
+class MkanisoMetric(MagicDiamondMetric):
     def measure(self):
-        sph_2nd_moment = self._sph_2nd_moment()
-        lin_2nd_moment = self._lin_2nd_moment()
-        mask = self.get_compound_mask()
-
-        disos = [
-            self._haeberlen(enc, "diso")
-            for enc, _ in filter(lambda it: it[1], self.paths)
-        ]
-
-        md, mkaniso = zeros(mask.shape), zeros(mask.shape)
-        md[mask] = self._masked_fascicle_mean_metric(array(disos))[mask]
+        md = self._md()
+        mask = self.get_compound_mask() & ~isclose(md, 0.)
 
-        mask = mask & ~isclose(md, 0.)
+        mkaniso = zeros(mask.shape, dtype=self.dtype)
         mkaniso[mask] = 3. * (
-                lin_2nd_moment[mask] - sph_2nd_moment[mask]
+            self._lin_2nd_moment()[mask] - self._sph_2nd_moment()[mask]
         ) / (md[mask] ** 2.)
 
-        nib.save(
-            nib.Nifti1Image(mkaniso, self.affine),
-            "{}_mkaniso.nii.gz".format(self.output)
-        )
+        self._save_image(mkaniso, "{}_mkaniso.nii.gz".format(self.output))
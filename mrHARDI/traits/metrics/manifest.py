@@ -0,0 +1,113 @@
+import hashlib
+import json
+import sys
+from functools import lru_cache
+from inspect import getsourcefile, ismodule
+from os import replace
+from os.path import exists, getmtime, getsize
+
+from mrHARDI.base.utils import hash_file
+
+
+def _package_modules(module):
+    # The module and the package modules it imports names from
+    modules = {module.__name__}
+    for value in vars(module).values():
+        name = value.__name__ if ismodule(value) else \
+            getattr(value, "__module__", None)
+        if isinstance(name, str) and name.split(".")[0] == "mrHARDI":
+            modules.add(name)
+
+    return modules
+
+
+@lru_cache(maxsize=None)
+def implementation_hash(metric_class):
+    """
+    Hash of the sources of the modules defining a metric class and its
+    bases, and of the package modules they use.
+    """
+    modules = set()
+    for cls in metric_class.__mro__:
+        if cls.__module__.split(".")[0] == "mrHARDI":
+            modules |= _package_modules(sys.modules[cls.__module__])
+
+    _hash = hashlib.sha1()
+    for fname in sorted(set(
+        getsourcefile(sys.modules[m]) for m in modules if m in sys.modules
+    )):
+        _hash.update(hash_file(fname).encode())
+
+    return _hash.hexdigest()
+
+
+class MetricsManifest:
+    """
+    Record of the metrics written to an output prefix, with the hashes of
+    their implementation, of the inputs they were computed from and the
+    parameters they were computed with. A metric is current when all of
+    those are unchanged and its outputs still exist, in which case it
+    doesn't need to be computed again. Inputs shared by all metrics are
+    given to the manifest, the ones of each metric by its inputs method.
+    Hashes are reused from the previous manifest when the size and the
+    modification time of an input didn't change.
+    """
+    def __init__(self, fname, inputs, parameters, force=False):
+        self.fname = fname
+        self.parameters = parameters
+        self.force = force
+
+        self._previous = {}
+        if exists(fname):
+            with open(fname) as f:
+                self._previous = json.load(f)
+
+        self.common_inputs = [i for i in inputs if i]
+        self.inputs = {}
+        self.metrics = dict(self._previous.get("metrics", {}))
+
+    def _hash_input(self, fname):
+        if fname not in self.inputs:
+            known = self._previous.get("inputs", {})
+            stamp = [getsize(fname), getmtime(fname)]
+            if fname in known and known[fname]["stamp"] == stamp:
+                self.inputs[fname] = known[fname]
+            else:
+                self.inputs[fname] = {
+                    "stamp": stamp, "hash": hash_file(fname)
+                }
+
+        return self.inputs[fname]["hash"]
+
+    def _signature(self, metric):
+        inputs = sorted(set(self.common_inputs + list(metric.inputs())))
+        return {
+            "implementation": implementation_hash(type(metric)),
+            "parameters": self.parameters,
+            "inputs": {i: self._hash_input(i) for i in inputs if exists(i)}
+        }
+
+    def is_current(self, name, metric):
+        if self.force or name not in self.metrics:
+            return False
+
+        entry = self.metrics[name]
+        return entry["signature"] == self._signature(metric) and all(
+            exists(o) for o in entry["outputs"]
+        )
+
+    def record(self, name, metric):
+        self.metrics[name] = {
+            "signature": self._signature(metric),
+            "outputs": sorted(set(metric.outputs))
+        }
+
+    def save(self):
+        tmp_fname = "{}.tmp".format(self.fname)
+        with open(tmp_fname, "w+") as f:
+            json.dump({
+                "inputs": self.inputs,
+                "metrics": self.metrics
+            }, f, indent=4)
+
+        replace(tmp_fname, self.fname)
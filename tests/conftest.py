@@ -0,0 +1,54 @@
+from time import perf_counter
+
+import pytest
+
+
+def pytest_addoption(parser):
+    parser.addoption(
+        "--benchmark", action="store_true", default=False,
+        help="Run the benchmarks against the reference implementations"
+    )
+
+
+def pytest_configure(config):
+    config.addinivalue_line(
+        "markers", "benchmark: timing comparison, run with --benchmark"
+    )
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption("--benchmark"):
+        return
+
+    skip = pytest.mark.skip(reason="Benchmarks only run with --benchmark")
+    for item in items:
+        if "benchmark" in item.keywords:
+            item.add_marker(skip)
+
+
+def best_time(fn, repeats=3):
+    timings = []
+    for _ in range(repeats):
+        start = perf_counter()
+        fn()
+        timings.append(perf_counter() - start)
+
+    return min(timings)
+
+
+@pytest.fixture
+def compare_timings(capsys):
+    """
+    Best timings of a reference and an optimized callable, printed even
+    when the output is captured.
+    """
+    def _compare(name, reference, optimized, repeats=3):
+        t_ref = best_time(reference, repeats)
+        t_opt = best_time(optimized, repeats)
+        with capsys.disabled():
+            print("\n{} : reference {:.3f}s, optimized {:.3f}s "
+                  "({:.1f}x)".format(name, t_ref, t_opt, t_ref / t_opt))
+
+        return t_ref, t_opt
+
+    return _compare
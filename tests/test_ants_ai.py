@@ -0,0 +1,168 @@
+import os
+import stat
+
+import nibabel as nib
+import numpy as np
+import pytest
+from scipy.spatial.transform import Rotation
+
+from mrHARDI.apps.register.ants import AntsRegistration
+from mrHARDI.base.shell import launch_shell_process
+from mrHARDI.compute.image import image_similarity
+from mrHARDI.compute.transforms import LinearTransform, load_transform
+from mrHARDI.config.ants import AntsConfiguration
+
+
+# Stand-in for antsAI, taking a fixed time per rotation of the grid it is
+# asked to search, the rotations being evaluated one after the other on
+# the downsampled inputs. It always returns the identity.
+FAKE_ANTS_AI = """#!/bin/sh
+while [ $# -gt 0 ]; do
+    case "$1" in
+        -s) search="$2"; shift ;;
+        --output) output="$2"; shift ;;
+    esac
+    shift
+done
+duration=$(echo "$search" | awk -F '[][,]' -v t={sample_time} '{{
+    n = int(2. * $3 * 180. / $2 + 1E-6) + 1; print n * n * n * t
+}}')
+sleep "$duration"
+cp {identity} "$output"
+"""
+
+AI_PARAMS = "-d 3 -m Mattes[{t0},{m0},32,Regular,0.2] -t Rigid[0.2]"
+
+
+@pytest.fixture
+def ants_ai(tmp_path, monkeypatch):
+    def _install(sample_time):
+        bin_dir = tmp_path / "bin"
+        bin_dir.mkdir(exist_ok=True)
+        LinearTransform(np.eye(4)).save(str(bin_dir / "identity.mat"))
+        with open(str(bin_dir / "antsAI"), "w") as f:
+            f.write(FAKE_ANTS_AI.format(
+                sample_time=sample_time, identity=bin_dir / "identity.mat"
+            ))
+        os.chmod(str(bin_dir / "antsAI"), stat.S_IRWXU)
+        monkeypatch.setenv(
+            "PATH", "{}:{}".format(bin_dir, os.environ["PATH"])
+        )
+
+    return _install
+
+
+def write_pair(tmp_path, motion=np.eye(4)):
+    # Elongated blob centered on the origin, moved in the moving image
+    grid = np.stack(np.meshgrid(*[np.arange(24.)] * 3, indexing="ij"), -1)
+    blob = np.exp(-np.sum(
+        ((grid - 11.5) / np.array([8., 4., 3.])) ** 2., axis=-1
+    ))
+
+    affine = np.diag([2., 2., 2., 1.])
+    affine[:3, 3] = -23.
+    nib.save(nib.Nifti1Image(blob, affine), str(tmp_path / "t0.nii.gz"))
+    nib.save(
+        nib.Nifti1Image(blob, motion @ affine), str(tmp_path / "m0.nii.gz")
+    )
+
+    return {"t0": str(tmp_path / "t0.nii.gz"),
+            "m0": str(tmp_path / "m0.nii.gz")}
+
+
+def rotation_z(degrees):
+    _m = np.eye(4)
+    _m[:3, :3] = Rotation.from_euler("z", degrees, degrees=True).as_matrix()
+    return _m
+
+
+def search_sectors(tmp_path, ai_config_dict, splits, early_stop, workers=2):
+    config = AntsConfiguration()
+    config.ai_search_splits = splits
+    config.ai_early_stop = early_stop
+    config.ai_workers = workers
+
+    AntsRegistration()._search_ants_ai_sectors(
+        config, AI_PARAMS, ai_config_dict, 1,
+        str(tmp_path / "sectors.mat"), angular_step=5.625,
+        angular_range=22.5, base_dir=str(tmp_path)
+    )
+    return str(tmp_path / "sectors.mat")
+
+
+def search_serial(tmp_path, ai_config_dict):
+    # The antsAI call made when the rotation grid is not split
+    launch_shell_process("antsAI {} -s [{},{}] --output {}".format(
+        AI_PARAMS.format(**ai_config_dict), 5.625, 22.5 / 180.,
+        str(tmp_path / "serial.mat")
+    ))
+    return str(tmp_path / "serial.mat")
+
+
+def test_search_sectors(tmp_path, ants_ai):
+    ants_ai(0.)
+    ai_config_dict = write_pair(tmp_path, rotation_z(-15.))
+
+    transform = load_transform(
+        search_sectors(tmp_path, ai_config_dict, 3, 0.)
+    )
+
+    # Searches return the identity, so the motion is recovered from the
+    # center of the best sector
+    np.testing.assert_allclose(transform, rotation_z(15.), atol=1E-6)
+    assert image_similarity(
+        ai_config_dict["t0"], ai_config_dict["m0"], transform
+    ) > image_similarity(ai_config_dict["t0"], ai_config_dict["m0"])
+    assert len(list(tmp_path.glob("ants_ai_sector*.mat"))) == 27
+
+
+def test_search_sectors_early_stop(tmp_path, ants_ai):
+    ants_ai(0.)
+    ai_config_dict = write_pair(tmp_path, rotation_z(-15.))
+
+    full = load_transform(search_sectors(tmp_path, ai_config_dict, 3, 0., 1))
+    for f in tmp_path.glob("ants_ai_sector*.mat"):
+        f.unlink()
+
+    pruned = load_transform(
+        search_sectors(tmp_path, ai_config_dict, 3, 0.25, 1)
+    )
+    assert len(list(tmp_path.glob("ants_ai_sector*.mat"))) < 27
+    np.testing.assert_allclose(pruned, full)
+
+
+@pytest.mark.benchmark
+def test_search_sectors_benchmark(tmp_path, ants_ai, compare_timings):
+    # Fine stage grid, 9 rotations per axis, searched as a whole or split
+    # in 27 sectors of 3 rotations per axis
+    ants_ai(0.002)
+    ai_config_dict = write_pair(tmp_path)
+
+    t_ref, t_opt = compare_timings(
+        "antsAI search of 729 rotations",
+        lambda: search_serial(tmp_path, ai_config_dict),
+        lambda: search_sectors(tmp_path, ai_config_dict, 3, 0.25),
+        repeats=1
+    )
+    assert t_opt < t_ref
+
+
+def test_pyramid_cache(tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    registration = AntsRegistration()
+    base_dir = str(tmp_path / "work")
+
+    # Levels outlive the working directory of a registration by default
+    assert registration._pyramid(base_dir).cache_dir == \
+        str(tmp_path / "cache" / "mrHARDI" / "pyramid")
+
+    registration.configuration.pyramid_cache = str(tmp_path / "subject")
+    assert registration._pyramid(base_dir).cache_dir == \
+        str(tmp_path / "subject")
+
+    registration.configuration.pyramid_cache = None
+    with open(str(tmp_path / "unwritable"), "w") as f:
+        f.write("not a directory")
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "unwritable"))
+    assert registration._pyramid(base_dir).cache_dir == \
+        os.path.join(base_dir, "pyramid")
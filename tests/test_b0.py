@@ -0,0 +1,137 @@
+import numpy as np
+import pytest
+
+from mrHARDI.compute.b0 import (B0PostProcess,
+                                B0Reference,
+                                b0_normalization_scales,
+                                normalize_to_b0)
+
+
+def reference_normalize_to_b0(
+    data, bvals, mean=B0PostProcess.batch,
+    ref_strategy=B0Reference.linear, ref_mean=None,
+    ceil=0.9, b0_comp=np.less_equal
+):
+    # Per-cluster loop replaced by the per-volume scales. The dwi volumes
+    # are iterated over their indexes and single volume clusters get a
+    # null weight, where the loop used to fail
+    data = np.array(data, dtype=float)
+    reference_last = ref_strategy == B0Reference.last
+
+    if reference_last:
+        data = data[..., ::-1]
+        bvals = bvals[::-1]
+        ref_strategy = B0Reference.first
+
+    b0_mask = b0_comp(bvals, ceil)
+    mask = np.ma.masked_array(b0_mask)
+    mask[~b0_mask] = np.ma.masked
+
+    b0_clusters = list(np.ma.notmasked_contiguous(mask, axis=0))
+    dwi_clusters = list(np.ma.clump_masked(mask))
+
+    if ref_mean is None:
+        ref_mean = np.mean(data[..., b0_clusters[0]])
+
+    if not b0_comp(bvals[0], ceil):
+        dwi_clusters = dwi_clusters[1:]
+    if not b0_comp(bvals[-1], ceil):
+        if mean == B0PostProcess.batch:
+            mean_val = np.mean(data[..., b0_clusters[-1]])
+        else:
+            mean_val = np.mean(data[..., b0_clusters[-1].start])
+
+        if not np.isclose(mean_val, 0):
+            data[..., dwi_clusters[-1]] *= ref_mean / mean_val
+
+        dwi_clusters = dwi_clusters[:-1]
+
+    for i in range(len(dwi_clusters)):
+        len_cl = dwi_clusters[i].stop - dwi_clusters[i].start
+
+        if mean == B0PostProcess.batch:
+            mean_val = np.mean(data[..., b0_clusters[i]])
+        else:
+            mean_val = np.mean(data[..., b0_clusters[i].stop - 1])
+
+        if ref_strategy == B0Reference.linear:
+            weight = np.arange(len_cl).astype(float) / max(len_cl - 1., 1.)
+            if mean == B0PostProcess.batch:
+                mean_val_p1 = np.mean(data[..., b0_clusters[i + 1]])
+            else:
+                mean_val_p1 = np.mean(data[..., b0_clusters[i + 1].start])
+            modif = weight * mean_val_p1 + (1. - weight) * mean_val
+        else:
+            modif = [mean_val] * len_cl
+
+        for mod, cl in zip(
+            modif, range(dwi_clusters[i].start, dwi_clusters[i].stop)
+        ):
+            if not np.isclose(mod, 0.):
+                data[..., cl] *= ref_mean / mod
+
+    for i in range(len(b0_clusters)):
+        mean_cluster = np.mean(data[..., b0_clusters[i]])
+        if not np.isclose(mean_cluster, 0.):
+            data[..., b0_clusters[i]] *= ref_mean / mean_cluster
+
+    if reference_last:
+        data = data[..., ::-1]
+
+    return data, ref_mean
+
+
+def acquisition(bvals, seed=0):
+    bvals = np.array(bvals, dtype=float)
+    rng = np.random.default_rng(seed)
+    drift = np.linspace(1., 0.8, len(bvals))
+    signal = np.where(bvals > 0, 0.4, 1.) * drift
+    return rng.uniform(0.5, 1.5, (5, 4, 3, 1)) * signal, bvals
+
+
+SCHEMES = [
+    [0, 1000, 1000, 1000, 0, 1000, 1000, 0],
+    [0, 0, 1000, 2000, 0, 1000, 0, 0, 2000],
+    [1000, 1000, 0, 1000, 1000, 1000, 0, 1000],
+    [0, 1000, 0, 1000, 0, 1000, 0],
+    [0, 1000, 1000, 1000, 1000],
+    [0, 0, 0]
+]
+
+
+@pytest.mark.parametrize("bvals", SCHEMES)
+@pytest.mark.parametrize("mean", [B0PostProcess.batch, B0PostProcess.none])
+@pytest.mark.parametrize("ref_strategy", list(B0Reference))
+def test_normalize_to_b0(bvals, mean, ref_strategy):
+    data, bvals = acquisition(bvals)
+    output, ref_mean = normalize_to_b0(data, bvals, mean, ref_strategy)
+    ref_output, ref_ref_mean = reference_normalize_to_b0(
+        data, bvals, mean, ref_strategy
+    )
+
+    assert np.isclose(ref_mean, ref_ref_mean)
+    np.testing.assert_allclose(output, ref_output, rtol=1E-12)
+
+
+def test_normalize_to_b0_b0_only():
+    data, bvals = acquisition(np.zeros((4,)))
+    for ref_strategy in B0Reference:
+        scales, ref_mean = b0_normalization_scales(
+            data.mean(axis=(0, 1, 2)), bvals, ref_strategy=ref_strategy
+        )
+        np.testing.assert_allclose(
+            scales, ref_mean / data.mean(axis=(0, 1, 2)).mean()
+        )
+
+
+def test_normalize_to_b0_dtype():
+    data, bvals = acquisition(SCHEMES[0])
+    output, _ = normalize_to_b0(
+        (data * 1000).astype(np.int16), bvals, dtype=np.float32, block_size=3
+    )
+    assert output.dtype == np.float32
+    np.testing.assert_allclose(
+        output,
+        normalize_to_b0((data * 1000).astype(np.int16), bvals)[0],
+        rtol=1E-6
+    )
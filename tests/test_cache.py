@@ -0,0 +1,72 @@
+import numpy as np
+
+from mrHARDI.traits.metrics.base import load_from_cache
+from mrHARDI.traits.metrics.cache import CacheScope, MetricCache
+
+
+def test_scope_entries():
+    cache = MetricCache()
+    lin, sph = CacheScope(cache, "lin"), CacheScope(cache, "sph")
+    lin["t0"] = np.zeros(10)
+    sph["t0"] = np.ones(10)
+
+    assert sorted(cache) == ["lin.t0", "sph.t0"]
+    assert list(lin) == ["t0"] and len(sph) == 1
+    assert "t0" in lin and "t1" not in lin
+    np.testing.assert_array_equal(sph["t0"], np.ones(10))
+
+    load_from_cache(lin, "moments", lambda _: (np.zeros(4), np.ones(4)))
+    assert "lin.moments" in cache
+    assert cache.nbytes == 8 * (10 + 10 + 8)
+
+    del lin["t0"]
+    assert sorted(cache) == ["lin.moments", "sph.t0"]
+
+
+def test_scope_memory_limit(tmp_path):
+    cache = MetricCache(8 * 150, str(tmp_path))
+    scopes = [CacheScope(cache, enc) for enc in ["lin", "sph", "pla"]]
+    for scope in scopes:
+        scope["t0"] = np.arange(100.)
+
+    # Arrays of every scope are spilled once over the limit
+    assert cache.nbytes <= 8 * 150
+    assert sorted(p.name for p in tmp_path.iterdir()) == [
+        "lin.t0.npy", "sph.t0.npy"
+    ]
+    for scope in scopes:
+        np.testing.assert_array_equal(scope["t0"], np.arange(100.))
+
+    cache.clear_spilled()
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_scope_release():
+    cache = MetricCache()
+    scope = CacheScope(cache, "lin")
+    scope["t0"] = np.zeros(10)
+    scope.retain("t0", 2)
+
+    scope.release("t0")
+    assert "t0" in scope
+    scope.release("t0")
+    assert "t0" not in scope and len(cache) == 0
+
+    # Plain dictionaries are scoped without reference counting
+    plain = CacheScope({}, "lin")
+    plain["t0"] = np.zeros(10)
+    plain.retain("t0")
+    plain.release("t0")
+    assert plain.cache == {"lin.t0": plain["t0"]}
+
+
+def test_scope_save(tmp_path):
+    cache = MetricCache()
+    CacheScope(cache, "lin")["t0"] = np.arange(3.)
+    CacheScope(cache, "lin")["eigs"] = (np.zeros(2), np.ones(2))
+    cache.save(str(tmp_path / "cache"))
+
+    loaded = CacheScope(MetricCache.load(str(tmp_path / "cache")), "lin")
+    assert sorted(loaded) == ["eigs", "t0"]
+    np.testing.assert_array_equal(loaded["t0"], np.arange(3.))
+    np.testing.assert_array_equal(loaded["eigs"][1], np.ones(2))
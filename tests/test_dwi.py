@@ -0,0 +1,288 @@
+import nibabel as nib
+import numpy as np
+import pytest
+from traitlets import TraitError
+
+from mrHARDI.compute.dwi import group_duplicated_directions, identify_shells
+
+
+def reference_identify_shells(
+    bvals, threshold=40.0, roundCentroids=False, sort=False
+):
+    # Greedy implementation replaced by the sorted centroids search
+    bval_centroids = [bvals[0]]
+    for bval in bvals[1:]:
+        diffs = np.abs(np.asarray(bval_centroids, dtype=float) - bval)
+        if not len(np.where(diffs < threshold)[0]):
+            bval_centroids.append(bval)
+    centroids = np.array(bval_centroids)
+
+    bvals_for_diffs = np.tile(bvals.reshape(bvals.shape[0], 1),
+                              (1, centroids.shape[0]))
+
+    shell_indices = np.argmin(np.abs(bvals_for_diffs - centroids), axis=1)
+
+    if roundCentroids:
+        centroids = np.round(centroids, decimals=-1)
+
+    if sort:
+        sort_index = np.argsort(centroids)
+        sorted_centroids = np.zeros(centroids.shape)
+        sorted_indices = np.zeros(shell_indices.shape)
+        for i in range(len(centroids)):
+            sorted_centroids[i] = centroids[sort_index[i]]
+            sorted_indices[shell_indices == i] = sort_index[i]
+        return sorted_centroids, sorted_indices
+
+    return centroids, shell_indices
+
+
+def random_bvals(n, seed=0, shells=(0, 300, 700, 1000, 2000, 3000)):
+    rng = np.random.default_rng(seed)
+    return rng.choice(shells, n) + rng.normal(0., 15., n)
+
+
+def assert_same_shells(shells, ref_shells):
+    np.testing.assert_array_equal(shells[0], ref_shells[0])
+    np.testing.assert_array_equal(shells[1], ref_shells[1])
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("threshold", [0., 20., 40., 100.])
+@pytest.mark.parametrize("sort", [False, True])
+def test_identify_shells(seed, threshold, sort):
+    bvals = random_bvals(500, seed)
+    assert_same_shells(
+        identify_shells(bvals, threshold, sort=sort),
+        reference_identify_shells(bvals, threshold, sort=sort)
+    )
+
+
+@pytest.mark.parametrize("bvals", [
+    np.array([1000.]),
+    np.array([0, 0, 1000, 1000, 2000, 0, 2000]),
+    np.array([0, 40, 80, 20, 60, 100]),
+    np.array([1000, 960, 1040, 1000, 980, 1020]),
+    np.round(random_bvals(300, 1), -1).astype(int)
+])
+def test_identify_shells_ties(bvals):
+    for sort in [False, True]:
+        assert_same_shells(
+            identify_shells(bvals, 40., True, sort),
+            reference_identify_shells(bvals, 40., True, sort)
+        )
+
+
+def test_identify_shells_empty():
+    with pytest.raises(ValueError):
+        identify_shells(np.array([]))
+
+
+@pytest.mark.benchmark
+def test_identify_shells_benchmark(compare_timings):
+    # Concatenated tables of many sessions, with site specific b-values
+    bvals = np.concatenate([
+        random_bvals(100, seed, shells=np.arange(0, 3000, 50) + seed % 7)
+        for seed in range(500)
+    ])
+
+    t_ref, t_opt = compare_timings(
+        "Shells of {} b-values".format(len(bvals)),
+        lambda: reference_identify_shells(bvals),
+        lambda: identify_shells(bvals)
+    )
+    assert t_opt < t_ref
+
+
+def reference_group_duplicated_directions(
+    bvals, bvecs, b0_threshold, threshold=1E-5
+):
+    # Every pair of volumes of a shell compared, groups numbered in the
+    # order of their first volume
+    bvecs = bvecs / np.linalg.norm(bvecs, axis=1, keepdims=True)
+    groups = -np.ones(len(bvals), dtype=int)
+    n_groups = 0
+    for i in range(len(bvals)):
+        if groups[i] < 0:
+            groups[i], stack = n_groups, [i]
+            n_groups += 1
+            while len(stack) > 0 and bvals[i] > b0_threshold:
+                j = stack.pop()
+                close = np.where(
+                    (groups < 0) & (bvals == bvals[j]) &
+                    (1. - np.abs(bvecs @ bvecs[j]) <= threshold)
+                )[0]
+                groups[close] = groups[i]
+                stack.extend(close)
+
+    return groups
+
+
+def random_directions(n, seed=0, duplicates=0.3):
+    # Directions of a few shells, some repeated or flipped, slightly noisy
+    rng = np.random.default_rng(seed)
+    bvals = rng.choice([0, 1000, 2000], n)
+    bvecs = rng.normal(size=(n, 3))
+    repeated = np.where(rng.random(n) < duplicates)[0]
+    repeated = repeated[repeated > 0]
+    origins = rng.integers(0, repeated, len(repeated))
+    bvals[repeated] = bvals[origins]
+    bvecs[repeated] = bvecs[origins] * rng.choice([-1., 1.], (
+        len(repeated), 1
+    ))
+    bvecs += rng.normal(0., 1E-4, bvecs.shape)
+    return bvals, bvecs / np.linalg.norm(bvecs, axis=1, keepdims=True)
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("threshold", [1E-8, 1E-5, 1E-2])
+def test_group_duplicated_directions(seed, threshold):
+    bvals, bvecs = random_directions(300, seed)
+    np.testing.assert_array_equal(
+        group_duplicated_directions(bvals, bvecs, 20, threshold),
+        reference_group_duplicated_directions(bvals, bvecs, 20, threshold)
+    )
+
+
+def in_plane_directions(distances):
+    # Directions 1 - u . v apart from the first one, followed by their
+    # antipodes
+    angles = np.arccos(1. - np.asarray(distances))
+    bvecs = np.stack([np.cos(angles), np.sin(angles), 0. * angles], -1)
+    return np.concatenate((bvecs, -bvecs))
+
+
+def test_group_duplicated_directions_threshold():
+    bvecs = in_plane_directions([0., 5E-6, 4E-5])
+    groups = group_duplicated_directions([1000] * 6, bvecs, 20, 1E-5)
+    np.testing.assert_array_equal(groups, [0, 0, 1, 0, 0, 1])
+
+    groups = group_duplicated_directions([1000] * 6, bvecs, 20, 1E-6)
+    np.testing.assert_array_equal(groups, [0, 1, 2, 0, 1, 2])
+
+    # Groups are closed over matching pairs, each 5E-6 apart here
+    bvecs = in_plane_directions([0., 5E-6, 2E-5])
+    groups = group_duplicated_directions([1000] * 6, bvecs, 20, 1E-5)
+    np.testing.assert_array_equal(groups, [0] * 6)
+
+    # Matching directions of other shells or b0 volumes are not grouped
+    groups = group_duplicated_directions(
+        [1000, 2000, 1000, 0, 10, 0], bvecs, 20, 1E-5
+    )
+    np.testing.assert_array_equal(groups, [0, 1, 2, 3, 4, 5])
+
+
+def test_group_duplicated_directions_numbering():
+    bvecs = np.array([
+        [0., 1., 0.], [1., 0., 0.], [0., 0., 1.],
+        [-1., 0., 0.], [0., -1., 0.], [0., 0., 0.]
+    ])
+    groups = group_duplicated_directions(
+        [1000, 1000, 1000, 1000, 1000, 0], bvecs, 20
+    )
+    np.testing.assert_array_equal(groups, [0, 1, 2, 1, 0, 3])
+
+
+@pytest.mark.parametrize("merging", ["first", "mean", "median"])
+def test_check_duplicated_bvecs(tmp_path, merging):
+    # The utils applications need dipy, which is not always installed
+    pytest.importorskip("dipy")
+    from mrHARDI.apps.utils.dwi import CheckDuplicatedBvecsInShell
+
+    # Volume 2 is the antipode of volume 1, volume 5 repeats it
+    bvals = np.array([0, 1000, 1000, 1000, 0, 1000])
+    bvecs = np.array([
+        [0., 0., 0.], [1., 0., 0.], [-1., 0., 0.],
+        [0., 1., 0.], [0., 0., 0.], [1., 0., 0.]
+    ])
+    base = np.arange(4, dtype=np.float32).reshape((2, 2, 1, 1))
+    data = base + 100. * np.arange(6, dtype=np.float32)
+    np.savetxt(str(tmp_path / "dwi.bval"), [bvals], fmt="%d")
+    np.savetxt(str(tmp_path / "dwi.bvec"), bvecs.T)
+    nib.save(nib.Nifti1Image(data, np.eye(4)), str(tmp_path / "dwi.nii.gz"))
+
+    app = CheckDuplicatedBvecsInShell(
+        dwi=str(tmp_path / "dwi.nii.gz"), bvals=str(tmp_path / "dwi.bval"),
+        bvecs=str(tmp_path / "dwi.bvec"), output=str(tmp_path / "out"),
+        merging=merging
+    )
+    app.execute()
+
+    np.testing.assert_array_equal(
+        np.loadtxt(str(tmp_path / "out.bval")), [0, 1000, 1000, 0]
+    )
+    np.testing.assert_allclose(
+        np.loadtxt(str(tmp_path / "out.bvec")).T, bvecs[[0, 1, 3, 4]]
+    )
+
+    # The first volume of a group is kept, whatever its sign
+    merged = {"first": 100., "mean": 800. / 3., "median": 200.}[merging]
+    np.testing.assert_allclose(
+        nib.load(str(tmp_path / "out.nii.gz")).get_fdata(),
+        base + [0., merged, 300., 400.], rtol=1E-6
+    )
+
+
+def extract_shells(tmp_path, **kwargs):
+    # The utils applications need dipy, which is not always installed
+    pytest.importorskip("dipy")
+    from mrHARDI.apps.utils.dwi import ExtractShells
+
+    bvals = np.array([0, 2010, 995, 1000, 0, 2000, 3000, 1005])
+    bvecs = np.random.default_rng(0).normal(size=(3, len(bvals)))
+    np.savetxt(str(tmp_path / "dwi.bval"), [bvals], fmt="%d")
+    np.savetxt(str(tmp_path / "dwi.bvec"), bvecs)
+    nib.save(
+        nib.Nifti1Image(
+            np.arange(len(bvals), dtype=np.int16).reshape((1, 1, 1, -1)),
+            np.eye(4)
+        ),
+        str(tmp_path / "dwi.nii.gz")
+    )
+
+    ExtractShells(
+        dwi=str(tmp_path / "dwi.nii.gz"), bvals=str(tmp_path / "dwi.bval"),
+        bvecs=str(tmp_path / "dwi.bvec"), output=str(tmp_path / "out"),
+        **kwargs
+    ).execute()
+
+    return {
+        f.name[:-len(".nii.gz")]: nib.load(str(f)).get_fdata().ravel()
+        for f in tmp_path.glob("out*.nii.gz")
+    }
+
+
+def test_extract_shells_split(tmp_path):
+    outputs = extract_shells(tmp_path, split_shells=True)
+    assert sorted(outputs) == ["out_b2010", "out_b3000", "out_b995"]
+    np.testing.assert_array_equal(outputs["out_b995"], [2, 3, 7])
+    np.testing.assert_array_equal(outputs["out_b2010"], [1, 5])
+    np.testing.assert_array_equal(outputs["out_b3000"], [6])
+    np.testing.assert_array_equal(
+        np.loadtxt(str(tmp_path / "out_b995.bval")), [995, 1000, 1005]
+    )
+
+
+def test_extract_shells_split_count(tmp_path):
+    # Shells with at most count volumes are left out
+    outputs = extract_shells(
+        tmp_path, split_shells=True, count=2, keep_b0=True
+    )
+    assert sorted(outputs) == ["out_b995"]
+    np.testing.assert_array_equal(outputs["out_b995"], [0, 2, 3, 4, 7])
+
+
+def test_extract_shells_groups(tmp_path):
+    outputs = extract_shells(tmp_path, shell_groups=["1000:3000", "2000"])
+    assert sorted(outputs) == ["out_b1000_b3000", "out_b2000"]
+    np.testing.assert_array_equal(outputs["out_b1000_b3000"], [2, 3, 6, 7])
+    np.testing.assert_array_equal(outputs["out_b2000"], [1, 5])
+
+
+@pytest.mark.parametrize("groups,count", [
+    (["1000", "1500"], 0), (["3000"], 1)
+])
+def test_extract_shells_groups_no_shell(tmp_path, groups, count):
+    with pytest.raises(TraitError):
+        extract_shells(tmp_path, shell_groups=groups, count=count)
+    assert len(list(tmp_path.glob("out*"))) == 0
@@ -0,0 +1,127 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+from mrHARDI.base.gradients import GradientScheme, scheme_filename_from
+from mrHARDI.compute.dwi import sh_order_from
+
+
+def write_gradients(path, bvals, bvecs=None):
+    path.mkdir(exist_ok=True)
+    np.savetxt(str(path / "dwi.bval"), [bvals], fmt="%d")
+    if bvecs is not None:
+        np.savetxt(str(path / "dwi.bvec"), bvecs)
+        return str(path / "dwi.bval"), str(path / "dwi.bvec")
+
+    return str(path / "dwi.bval"), None
+
+
+def scheme_gradients(seed=0):
+    rng = np.random.default_rng(seed)
+    bvals = np.array([0, 5] + [1000] * 12 + [0] + [2000] * 20 + [0])
+    bvecs = rng.normal(size=(3, len(bvals)))
+    bvecs /= np.linalg.norm(bvecs, axis=0)
+    bvecs[:, 14] = bvecs[:, 15]
+    return bvals, bvecs
+
+
+def test_from_gradients():
+    bvals, bvecs = scheme_gradients()
+    scheme = GradientScheme.from_gradients(bvals, bvecs)
+
+    np.testing.assert_array_equal(
+        scheme.b0_clusters, [[0, 2], [14, 15], [35, 36]]
+    )
+    np.testing.assert_array_equal(scheme.b0_mask, bvals <= 20)
+    np.testing.assert_array_equal(scheme.shells, [1000, 2000])
+    assert scheme.n_dwi == 32 and scheme.n_volumes == 36
+    assert scheme.n_directions == 32 and scheme.shell_directions == [12, 20]
+    assert scheme.sh_order() == sh_order_from(32)
+    assert scheme.sh_order(msmt=True) == sh_order_from(12)
+    assert scheme.sh_order(msmt=True, full_basis=True) == \
+        sh_order_from(12, True)
+
+
+def test_sh_order_without_directions():
+    bvals, _ = scheme_gradients()
+    scheme = GradientScheme.from_gradients(bvals)
+    assert scheme.shell_directions is None
+
+    for msmt in [False, True]:
+        with pytest.raises(ValueError):
+            scheme.sh_order(msmt)
+
+    # Mismatched b-vectors are only described by their shape
+    scheme = GradientScheme.from_gradients(bvals, np.ones((3, 10)))
+    assert scheme.bvecs_shape == [3, 10]
+    with pytest.raises(ValueError):
+        scheme.sh_order(True)
+
+    scheme = GradientScheme.from_gradients(np.zeros(4), np.ones((3, 4)))
+    with pytest.raises(ValueError):
+        scheme.sh_order(True)
+
+
+def test_load_cache_dir(tmp_path):
+    bvals, bvecs = write_gradients(tmp_path / "data", *scheme_gradients())
+    cache_dir = str(tmp_path / "cache")
+
+    scheme = GradientScheme.load(bvals, bvecs, cache_dir=cache_dir)
+    assert sorted(os.listdir(str(tmp_path / "data"))) == [
+        "dwi.bval", "dwi.bvec"
+    ]
+    assert os.listdir(cache_dir) == [
+        os.path.basename(scheme_filename_from(bvals, cache_dir))
+    ]
+
+    # The analysis is read back from the cache
+    sidecar = scheme_filename_from(bvals, cache_dir)
+    with open(sidecar) as f:
+        schemes = json.load(f)
+    schemes[scheme.key]["min_bval"] = -1.
+    with open(sidecar, "w") as f:
+        json.dump(schemes, f)
+
+    assert GradientScheme.load(bvals, bvecs, cache_dir=cache_dir).min_bval \
+        == -1.
+
+    # Other thresholds and changed gradients get their own analysis
+    other = GradientScheme.load(bvals, bvecs, 20, 100, cache_dir=cache_dir)
+    assert other.key != scheme.key and other.min_bval == 0.
+
+    np.savetxt(bvals, [scheme_gradients()[0] + 10], fmt="%d")
+    changed = GradientScheme.load(bvals, bvecs, cache_dir=cache_dir)
+    assert changed.min_bval == 10.
+    with open(sidecar) as f:
+        assert len(json.load(f)) == 3
+
+
+def test_load_resolves_paths(tmp_path, monkeypatch):
+    bvals, bvecs = write_gradients(tmp_path / "data", *scheme_gradients())
+    os.symlink(str(tmp_path / "data"), str(tmp_path / "link"))
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+
+    linked = str(tmp_path / "link" / "dwi.bval")
+    assert scheme_filename_from(linked) == scheme_filename_from(bvals)
+    assert scheme_filename_from(bvals).startswith(
+        str(tmp_path / "cache" / "mrHARDI" / "gradients")
+    )
+
+    GradientScheme.load(linked, bvecs)
+    assert os.path.exists(scheme_filename_from(bvals))
+    assert not any(f.endswith(".tmp") for f in os.listdir(
+        str(tmp_path / "cache" / "mrHARDI" / "gradients")
+    ))
+
+
+def test_load_unwritable_cache(tmp_path):
+    bvals, bvecs = write_gradients(tmp_path / "data", *scheme_gradients())
+    with open(str(tmp_path / "cache"), "w") as f:
+        f.write("not a directory")
+
+    scheme = GradientScheme.load(
+        bvals, bvecs, cache_dir=str(tmp_path / "cache")
+    )
+    assert scheme.shell_directions == [12, 20]
@@ -0,0 +1,27 @@
+import nibabel as nib
+import numpy as np
+import pytest
+
+from mrHARDI.compute.image import rewrite_affine
+
+
+@pytest.mark.parametrize("ext", ["nii", "nii.gz"])
+def test_rewrite_affine(tmp_path, ext):
+    data = np.random.default_rng(0).uniform(size=(6, 7, 8))
+    affine = np.diag([2., 2., 2., 1.])
+    fname = str(tmp_path / "image.{}".format(ext))
+    nib.save(nib.Nifti1Image(data, affine), fname)
+
+    matrix = np.eye(4)
+    matrix[:3, 3] = [1., 2., 3.]
+    out_fname = rewrite_affine(
+        fname, matrix, str(tmp_path / "moved.{}".format(ext))
+    )
+
+    moved = nib.load(out_fname)
+    np.testing.assert_array_equal(moved.affine, matrix @ affine)
+    np.testing.assert_array_equal(moved.get_fdata(), data)
+
+    rewrite_affine(fname, matrix)
+    np.testing.assert_array_equal(nib.load(fname).affine, matrix @ affine)
+    np.testing.assert_array_equal(nib.load(fname).get_fdata(), data)
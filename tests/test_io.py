@@ -0,0 +1,94 @@
+from os import utime
+from os.path import exists, getmtime
+
+import numpy as np
+import pytest
+
+from mrHARDI.base.io import load_text
+
+
+TABLES = {
+    "value": "1000\n",
+    "row": "0 1000 2000 995\n",
+    "column": "0\n1000\n2000\n",
+    "table": "0.1 0.2 0.3\n0.4 0.5 0.6\n",
+    "comments": "# header\n0.1 0.2 0.3 # first\n\n0.4 0.5 0.6\n# footer\n"
+}
+
+
+def write_table(tmp_path, name, content):
+    fname = str(tmp_path / "{}.txt".format(name))
+    with open(fname, "w") as f:
+        f.write(content)
+
+    return fname
+
+
+@pytest.mark.parametrize("cache", [False, True])
+@pytest.mark.parametrize("ndmin", [0, 1, 2])
+@pytest.mark.parametrize("name", list(TABLES))
+def test_load_text_parity(tmp_path, name, ndmin, cache):
+    fname = write_table(tmp_path, name, TABLES[name])
+
+    # The second load of a cached table comes from the .npy file
+    for _ in range(2):
+        table = load_text(fname, ndmin=ndmin, cache=cache)
+        ref = np.loadtxt(fname, ndmin=ndmin)
+        assert table.shape == ref.shape and table.dtype == ref.dtype
+        np.testing.assert_array_equal(table, ref)
+
+
+@pytest.mark.parametrize("cache", [False, True])
+def test_load_text_delimiter(tmp_path, cache):
+    fname = write_table(
+        tmp_path, "moco", "MetricPre,MetricPost,a,b\n1,2,3,4\n5,6,7,8\n"
+    )
+
+    table = load_text(fname, 2, delimiter=",", skiprows=1, cache=cache)
+    np.testing.assert_array_equal(
+        table, np.loadtxt(fname, delimiter=",", skiprows=1, ndmin=2)
+    )
+    assert exists("{}.skip1.npy".format(fname)) == cache
+
+
+def test_load_text_dtype(tmp_path):
+    fname = write_table(tmp_path, "index", "1 1 2 2\n")
+    for cache in [False, True]:
+        table = load_text(fname, dtype=int, cache=cache)
+        assert table.dtype == np.loadtxt(fname, dtype=int).dtype
+
+
+def test_load_text_cache_invalidation(tmp_path):
+    fname = write_table(tmp_path, "history", "1 2\n3 4\n")
+    np.testing.assert_array_equal(
+        load_text(fname, cache=True), [[1, 2], [3, 4]]
+    )
+
+    with open(fname, "w") as f:
+        f.write("5 6\n")
+    utime(fname, (getmtime(fname) + 10., getmtime(fname) + 10.))
+
+    np.testing.assert_array_equal(load_text(fname, cache=True), [5, 6])
+
+
+def test_load_text_ragged(tmp_path):
+    fname = write_table(tmp_path, "ragged", "1 2 3\n4 5\n6 7 8 9\n")
+    for cache in [False, True]:
+        with pytest.raises(ValueError):
+            load_text(fname, cache=cache)
+
+
+@pytest.mark.benchmark
+def test_load_text_cache_benchmark(tmp_path, compare_timings):
+    # Slice to volume eddy histories reach millions of lines
+    fname = str(tmp_path / "history.txt")
+    np.savetxt(fname, np.random.default_rng(0).normal(size=(2000000, 6)))
+    load_text(fname, cache=True)
+
+    t_ref, t_opt = compare_timings(
+        "Eddy history of 2M lines",
+        lambda: np.loadtxt(fname),
+        lambda: load_text(fname, cache=True),
+        repeats=1
+    )
+    assert t_opt < t_ref
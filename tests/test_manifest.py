@@ -0,0 +1,136 @@
+import os
+
+import nibabel as nib
+import numpy as np
+import pytest
+
+import mrHARDI.traits.metrics.manifest as manifest_module
+from mrHARDI.traits.metrics.dti import FaMetric, MdMetric
+from mrHARDI.traits.metrics.diamond import FmdMetric
+from mrHARDI.traits.metrics.manifest import (MetricsManifest,
+                                             implementation_hash)
+
+
+@pytest.fixture
+def dti_prefix(tmp_path):
+    prefix = str(tmp_path / "dwi")
+    nib.save(
+        nib.Nifti1Image(np.zeros((2, 2, 2, 6)), np.eye(4)),
+        "{}_dti.nii.gz".format(prefix)
+    )
+    nib.save(
+        nib.Nifti1Image(np.ones((2, 2, 2), dtype=np.uint8), np.eye(4)),
+        "{}_mask.nii.gz".format(prefix)
+    )
+    with open("{}_metadata.py".format(prefix), "w") as f:
+        f.write("c.DwiMetadata.n = 6\n")
+
+    return prefix
+
+
+def metric(cls, prefix, output):
+    _metric = cls(prefix, output, {}, np.eye(4))
+    name = "{}_{}.nii.gz".format(output, cls.__name__[:2].lower())
+    with open(name, "w") as f:
+        f.write("map")
+    _metric.outputs.append(name)
+    return _metric
+
+
+def record(prefix, output, metrics, **kwargs):
+    manifest = MetricsManifest(
+        "{}_manifest.json".format(output),
+        ["{}_metadata.py".format(prefix)], {"precision": "float64"}, **kwargs
+    )
+    for name, _metric in metrics.items():
+        manifest.record(name, _metric)
+    manifest.save()
+
+
+def current(prefix, output, metrics, parameters=None, **kwargs):
+    manifest = MetricsManifest(
+        "{}_manifest.json".format(output),
+        ["{}_metadata.py".format(prefix)],
+        parameters or {"precision": "float64"}, **kwargs
+    )
+    return sorted(
+        name for name, _metric in metrics.items()
+        if manifest.is_current(name, _metric)
+    )
+
+
+def test_manifest_current(dti_prefix, tmp_path):
+    output = str(tmp_path / "out")
+    metrics = {
+        "fa": metric(FaMetric, dti_prefix, output),
+        "md": metric(MdMetric, dti_prefix, output)
+    }
+    assert current(dti_prefix, output, metrics) == []
+
+    record(dti_prefix, output, metrics)
+    assert current(dti_prefix, output, metrics) == ["fa", "md"]
+    assert current(dti_prefix, output, metrics, force=True) == []
+    assert current(
+        dti_prefix, output, metrics, {"precision": "float32"}
+    ) == []
+
+    # Maps deleted since are computed again
+    os.remove("{}_fa.nii.gz".format(output))
+    assert current(dti_prefix, output, metrics) == ["md"]
+
+
+def test_manifest_inputs(dti_prefix, tmp_path):
+    output = str(tmp_path / "out")
+    metrics = {"fa": metric(FaMetric, dti_prefix, output)}
+    assert "{}_dti.nii.gz".format(dti_prefix) in metrics["fa"].inputs()
+    record(dti_prefix, output, metrics)
+
+    # Files the metric does not read leave it current
+    with open("{}_fractions.nii.gz".format(dti_prefix), "w") as f:
+        f.write("unrelated")
+    assert current(dti_prefix, output, metrics) == ["fa"]
+
+    # Changes to the tensors or the metadata invalidate it
+    nib.save(
+        nib.Nifti1Image(np.ones((2, 2, 2, 6)), np.eye(4)),
+        "{}_dti.nii.gz".format(dti_prefix)
+    )
+    assert current(dti_prefix, output, metrics) == []
+    record(dti_prefix, output, metrics)
+    assert current(dti_prefix, output, metrics) == ["fa"]
+
+    with open("{}_metadata.py".format(dti_prefix), "a") as f:
+        f.write("c.DwiMetadata.multiband_corrected = True\n")
+    assert current(dti_prefix, output, metrics) == []
+
+
+def test_manifest_implementation(dti_prefix, tmp_path, monkeypatch):
+    output = str(tmp_path / "out")
+    metrics = {"fa": metric(FaMetric, dti_prefix, output)}
+    record(dti_prefix, output, metrics)
+
+    monkeypatch.setattr(
+        manifest_module, "implementation_hash", lambda cls: "changed"
+    )
+    assert current(dti_prefix, output, metrics) == []
+
+
+def test_implementation_hash(monkeypatch):
+    assert implementation_hash(FaMetric) == implementation_hash(MdMetric)
+    assert implementation_hash(FaMetric) != implementation_hash(FmdMetric)
+
+    # Sources of the modules used by the metrics are part of the hash
+    def _hash_file(changed):
+        return lambda fname: "changed" if fname.endswith(changed) \
+            else fname
+
+    def _hash(cls, changed):
+        monkeypatch.setattr(manifest_module, "hash_file", _hash_file(changed))
+        return implementation_hash.__wrapped__(cls)
+
+    reference = _hash(FaMetric, "nothing.py")
+    for changed in ["dti.py", "base.py", "linalg.py"]:
+        assert _hash(FaMetric, changed) != reference
+
+    assert _hash(FaMetric, "stats.py") == reference
+    assert _hash(FmdMetric, "stats.py") != _hash(FmdMetric, "nothing.py")
@@ -0,0 +1,149 @@
+import numpy as np
+import pytest
+from traitlets.config.loader import ConfigError
+
+from mrHARDI.base.dwi import (DwiMetadata,
+                              VolumeTable,
+                              load_metadata_file,
+                              save_metadata)
+
+
+AP, PA = [0., 1., 0.], [0., -1., 0.]
+
+
+def metadata(n=6, topup_indexes=(1, 2), dataset_indexes=(0, 3)):
+    mt = DwiMetadata()
+    mt.n = n
+    mt.acquisition_types = ["Linear", "Planar"]
+    mt.acquisition_slices = [[0, n - 2], [n - 2, None]]
+    mt.directions = [
+        {"dir": AP, "range": (0, n // 2)},
+        {"dir": PA, "range": (n // 2, n)}
+    ]
+    mt.dataset_indexes = list(dataset_indexes)
+    mt.topup_indexes = list(topup_indexes)
+    mt.affine = np.eye(4).tolist()
+    return mt
+
+
+def per_volume(mt, values):
+    # Expands a per dataset list to every volume
+    bounds = mt.dataset_indexes[1:] + [mt.n]
+    return np.repeat(values, np.diff([0] + bounds)).tolist()
+
+
+def test_table_round_trip():
+    mt = metadata()
+    table = mt.to_table()
+
+    np.testing.assert_array_equal(table.dataset, [0, 0, 0, 1, 1, 1])
+    np.testing.assert_array_equal(table.topup, [1, 1, 1, 2, 2, 2])
+
+    out = table.to_metadata(DwiMetadata())
+    assert out.n == 6
+    assert out.acquisition_slices == [[0, 4], [4, 6]]
+    assert out.acquisition_types == ["Linear", "Planar"]
+    assert out.directions == mt.directions
+    assert out.dataset_indexes == [0, 3]
+    assert out.topup_indexes == [1, 2]
+
+
+@pytest.mark.parametrize("indexes,dataset_indexes,topup_indexes", [
+    ([0, 1, 2], [0], [1]),
+    ([3, 4], [0], [2]),
+    ([1, 4, 5], [0, 1], [1, 2]),
+    ([4, 0], [0, 1], [2, 1])
+])
+def test_select(indexes, dataset_indexes, topup_indexes):
+    mt = metadata()
+    mt.select(indexes)
+
+    assert mt.n == len(indexes)
+    assert mt.dataset_indexes == dataset_indexes
+    assert mt.topup_indexes == topup_indexes
+    assert per_volume(mt, mt.topup_indexes) == \
+        np.array([1, 1, 1, 2, 2, 2])[indexes].tolist()
+
+
+def test_select_slice():
+    mt = metadata()
+    mt.adapt_to_shape(2)
+
+    assert mt.n == 2 and mt.dataset_indexes == [0]
+    assert mt.topup_indexes == [1]
+    assert mt.acquisition_types == ["Linear"]
+
+
+def test_repeat():
+    mt = metadata()
+    mt.adapt_to_shape(12)
+
+    assert mt.n == 12
+    assert mt.dataset_indexes == [0, 6]
+    assert mt.topup_indexes == [1, 2]
+    assert mt.acquisition_slices == [[0, 8], [8, 12]]
+    assert mt.directions == [
+        {"dir": AP, "range": (0, 6)}, {"dir": PA, "range": (6, 12)}
+    ]
+
+    with pytest.raises(ConfigError):
+        mt.adapt_to_shape(13)
+
+
+def test_concat():
+    mt, oth = metadata(), metadata(4, [3], [0])
+    mt.extend(oth, (2, 2, 2))
+
+    assert mt.n == 10
+    assert mt.dataset_indexes == [0, 3, 6]
+    assert mt.topup_indexes == [1, 2, 3]
+    assert mt.acquisition_types == ["Linear", "Planar", "Linear", "Planar"]
+    assert mt.acquisition_slices == [[0, 4], [4, 6], [6, 8], [8, 10]]
+    assert mt.directions == [
+        {"dir": AP, "range": (0, 3)}, {"dir": PA, "range": (3, 6)},
+        {"dir": AP, "range": (6, 8)}, {"dir": PA, "range": (8, 10)}
+    ]
+
+    mt.select(slice(2, 7))
+    assert mt.dataset_indexes == [0, 1, 4]
+    assert mt.topup_indexes == [1, 2, 3]
+
+
+def test_topup_indexes_not_per_dataset():
+    # Tables leave topup indexes alone when they do not map to datasets
+    mt = metadata(topup_indexes=[1, 2, 3])
+    assert mt.to_table().topup is None
+
+    mt.select([0, 1])
+    assert mt.topup_indexes == [1, 2, 3]
+
+    mt = metadata(topup_indexes=[])
+    mt.extend(metadata(4, [3], [0]), (2, 2, 2))
+    assert mt.topup_indexes == [3]
+
+
+def test_table_concat_empty():
+    empty = VolumeTable([], [], [], [], [], [])
+    table = empty.concat(metadata().to_table())
+    np.testing.assert_array_equal(table.dataset, [0, 0, 0, 1, 1, 1])
+    np.testing.assert_array_equal(table.topup, [1, 1, 1, 2, 2, 2])
+
+
+def test_serialization_round_trip(tmp_path):
+    mt = metadata()
+    mt.extend(metadata(4, [3], [0]), (2, 2, 2))
+    mt.select([0, 3, 4, 7, 9])
+    save_metadata(str(tmp_path / "dwi"), mt)
+
+    loaded = load_metadata_file(str(tmp_path / "dwi_metadata.py"))
+    for trait in [
+        "n", "acquisition_types", "acquisition_slices", "directions",
+        "dataset_indexes", "topup_indexes"
+    ]:
+        assert getattr(loaded, trait) == getattr(mt, trait)
+
+    assert loaded.dataset_indexes == [0, 1, 3]
+    assert loaded.topup_indexes == [1, 2, 3]
+    np.testing.assert_array_equal(
+        loaded.to_table().topup, mt.to_table().topup
+    )
@@ -0,0 +1,128 @@
+import nibabel as nib
+import numpy as np
+import pytest
+from scipy.spatial.transform import Rotation
+
+from mrHARDI.compute.motion import (apply_motion_correction,
+                                    mean_motion_matrix,
+                                    rotate_bvecs)
+
+
+LPS = np.diag([-1., -1., 1., 1.])
+
+
+def moco_matrix(world_rotation, translation=np.zeros((3,))):
+    # Fixed to moving LPS matrix of a moving to fixed RAS motion
+    _m = np.eye(4)
+    _m[:3, :3], _m[:3, 3] = world_rotation, translation
+    return LPS @ np.linalg.inv(_m) @ LPS
+
+
+def random_bvecs(n, seed=0):
+    bvecs = np.random.default_rng(seed).normal(size=(3, n))
+    return bvecs / np.linalg.norm(bvecs, axis=0)
+
+
+def test_rotate_bvecs_ras():
+    rotations = Rotation.from_rotvec(
+        np.random.default_rng(0).uniform(-0.2, 0.2, (5, 3))
+    ).as_matrix()
+    bvecs = random_bvecs(5)
+    reference = nib.Nifti1Image(np.zeros((4, 4, 4)), np.diag([2., 2., 2., 1.]))
+
+    np.testing.assert_allclose(
+        rotate_bvecs(bvecs, [moco_matrix(r) for r in rotations], reference),
+        np.einsum("vij,jv->iv", rotations, bvecs)
+    )
+
+
+@pytest.mark.parametrize("axcodes", [("L", "A", "S"), ("L", "P", "S")])
+def test_rotate_bvecs_oriented(axcodes):
+    rotations = Rotation.from_rotvec(
+        np.random.default_rng(1).uniform(-0.2, 0.2, (5, 3))
+    ).as_matrix()
+    bvecs = random_bvecs(5, 1)
+
+    # b-vectors follow the voxel axes, flipped against RAS in the image
+    flip = np.diag([1. if c in "RAS" else -1. for c in axcodes])
+    reference = nib.Nifti1Image(
+        np.zeros((4, 4, 4)), np.diag(np.append(2. * np.diag(flip), 1.))
+    )
+
+    np.testing.assert_allclose(
+        rotate_bvecs(bvecs, [moco_matrix(r) for r in rotations], reference),
+        np.einsum("vij,jv->iv", flip @ rotations @ flip, bvecs)
+    )
+
+
+def test_rotate_bvecs_affine_scaling():
+    rotation = Rotation.from_rotvec([0., 0., 0.3]).as_matrix()
+    bvecs = random_bvecs(1)
+    reference = nib.Nifti1Image(np.zeros((4, 4, 4)), np.eye(4))
+
+    rotated = rotate_bvecs(
+        bvecs, [moco_matrix(rotation @ np.diag([1.1, 0.9, 1.05]))], reference
+    )
+    np.testing.assert_allclose(np.linalg.norm(rotated, axis=0), 1.)
+
+
+def test_mean_motion_matrix_rigid():
+    rotations = Rotation.from_rotvec(
+        np.random.default_rng(2).uniform(-0.3, 0.3, (10, 3))
+    ).as_matrix()
+    translations = np.random.default_rng(2).uniform(-2., 2., (10, 3))
+    matrices = np.array([
+        moco_matrix(r, t) for r, t in zip(rotations, translations)
+    ])
+
+    _m = mean_motion_matrix(matrices)
+    np.testing.assert_allclose(
+        _m[:3, :3] @ _m[:3, :3].T, np.eye(3), atol=1E-12
+    )
+    assert np.isclose(np.linalg.det(_m[:3, :3]), 1.)
+    np.testing.assert_allclose(_m[:3, 3], matrices[:, :3, 3].mean(axis=0))
+    np.testing.assert_array_equal(_m[3], [0., 0., 0., 1.])
+
+    # Opposite rotations average to no rotation
+    opposite = Rotation.from_rotvec([0., 0., 0.2]).as_matrix()
+    _m = mean_motion_matrix([
+        moco_matrix(opposite), moco_matrix(opposite.T)
+    ])
+    np.testing.assert_allclose(_m, np.eye(4), atol=1E-12)
+
+
+def test_apply_motion_correction_mask():
+    rng = np.random.default_rng(3)
+    affine = np.diag([2., 2., 2., 1.])
+    affine[:3, 3] = -10.
+    data = rng.uniform(size=(10, 10, 10, 4))
+    reference = nib.Nifti1Image(data[..., 0], affine)
+
+    matrices = np.array([
+        moco_matrix(Rotation.from_rotvec(r).as_matrix(), t)
+        for r, t in zip(
+            rng.uniform(-0.1, 0.1, (4, 3)), rng.uniform(-1., 1., (4, 3))
+        )
+    ])
+
+    # 3D images are resampled as a single volume moved by the rigid mean
+    mask = (data[..., 0] > 0.5).astype(np.uint8)
+    out = apply_motion_correction(
+        nib.Nifti1Image(mask, affine), matrices, reference, order=0
+    )
+    expected = apply_motion_correction(
+        nib.Nifti1Image(mask[..., None], affine),
+        mean_motion_matrix(matrices)[None], reference, order=0
+    )
+    assert out.shape == mask.shape and out.dtype == np.uint8
+    np.testing.assert_array_equal(out, expected[..., 0])
+
+    out = apply_motion_correction(
+        nib.Nifti1Image(data, affine), matrices, reference
+    )
+    assert out.shape == data.shape and out.dtype == np.float32
+
+    with pytest.raises(ValueError):
+        apply_motion_correction(
+            nib.Nifti1Image(data, affine), matrices[:3], reference
+        )
@@ -0,0 +1,119 @@
+import nibabel as nib
+import numpy as np
+import pytest
+
+from mrHARDI.compute.math.linalg import color, compute_dti_scalars
+from mrHARDI.compute.math.stats import weighted_moments
+from mrHARDI.compute.math.tensor import compute_eigenvalues, compute_haeberlen
+from mrHARDI.traits.metrics.base import BaseMetric
+
+from test_tensor import field
+
+
+# Deviations of float32 from float64, relative to the largest eigenvalue
+EIGENVALUES_RTOL = 1E-5
+EIGENVECTORS_ATOL = 1E-4
+SCALARS_ATOL = 1E-5
+# Principal directions of nearly isotropic tensors are ill-conditioned
+COLORS_ATOL = 1E-3
+
+
+@pytest.fixture(scope="module")
+def tensor_field():
+    return field(100000)
+
+
+@pytest.mark.parametrize("solver", ["eigh", "analytic"])
+def test_eigenvalues_float32(tensor_field, solver):
+    tensors, mask = tensor_field
+    evals, evecs = compute_eigenvalues(
+        tensors, mask, solver=solver, dtype=np.float32
+    )
+    ref_evals, ref_evecs = compute_eigenvalues(tensors, mask, solver=solver)
+
+    assert evals.dtype == evecs.dtype == np.float32
+    scale = ref_evals.max()
+    assert np.abs(evals - ref_evals).max() < EIGENVALUES_RTOL * scale
+
+    dots = np.abs(np.sum(evecs[mask] * ref_evecs[mask], axis=-1))
+    assert np.abs(dots - 1.).max() < EIGENVECTORS_ATOL
+
+
+def test_dti_scalars_float32(tensor_field):
+    tensors, mask = tensor_field
+    eigs = compute_eigenvalues(tensors, mask, dtype=np.float32)
+    ref_eigs = compute_eigenvalues(tensors, mask)
+
+    maps = compute_dti_scalars(eigs, mask)
+    ref_maps = compute_dti_scalars(ref_eigs, mask)
+    scale = ref_eigs[0].max()
+    for metric, ref_map in ref_maps.items():
+        assert maps[metric].dtype == np.float32
+        atol = SCALARS_ATOL if metric == "fa" else EIGENVALUES_RTOL * scale
+        assert np.abs(maps[metric] - ref_map).max() < atol
+
+    colors = color(maps["fa"], eigs[1], mask)
+    assert colors.dtype == np.float32
+    assert np.abs(
+        colors - color(ref_maps["fa"], ref_eigs[1], mask)
+    ).max() < COLORS_ATOL
+
+
+def test_haeberlen_float32(tensor_field):
+    tensors, mask = tensor_field
+    diso, daniso, ddelta, deta = compute_haeberlen(
+        tensors, mask, dtype=np.float32
+    )
+    ref_diso, ref_daniso, ref_ddelta, ref_deta = compute_haeberlen(
+        tensors, mask
+    )
+
+    assert diso.dtype == daniso.dtype == ddelta.dtype == deta.dtype == \
+        np.float32
+
+    scale = np.abs(ref_diso).max()
+    assert np.abs(diso - ref_diso).max() < EIGENVALUES_RTOL * scale
+    assert np.abs(daniso - ref_daniso).max() < EIGENVALUES_RTOL * scale
+    assert np.abs(ddelta - ref_ddelta).max() < SCALARS_ATOL
+
+    # The asymmetry is unbounded when the anisotropy vanishes
+    anisotropic = np.abs(ref_ddelta) > 1E-2
+    assert np.all(np.isclose(
+        deta[anisotropic], ref_deta[anisotropic], rtol=1E-2, atol=0.
+    ))
+
+
+def test_weighted_moments_float32(tensor_field):
+    tensors, mask = tensor_field
+    values = tensors[..., :3].transpose(2, 0, 1)
+    weights = np.random.default_rng(0).dirichlet(
+        np.ones(3), mask.shape
+    ).transpose(2, 0, 1)
+
+    moments = weighted_moments(
+        values.astype(np.float32), weights.astype(np.float32)
+    )
+    for moment, ref_moment in zip(
+        moments, weighted_moments(values, weights)
+    ):
+        assert moment.dtype == np.float32
+        assert np.abs(moment - ref_moment).max() < \
+            EIGENVALUES_RTOL * np.abs(ref_moment).max()
+
+
+def test_save_image_float32(tmp_path):
+    metric = BaseMetric(
+        "", str(tmp_path), {}, np.eye(4), dtype="float32"
+    )
+    data = np.random.default_rng(0).uniform(size=(4, 4, 4))
+    metric._save_image(data, str(tmp_path / "metric.nii.gz"))
+    metric._save_image(
+        (data > 0.5).astype(np.uint8), str(tmp_path / "mask.nii.gz")
+    )
+
+    img = nib.load(str(tmp_path / "metric.nii.gz"))
+    assert img.get_data_dtype() == np.float32
+    np.testing.assert_allclose(img.get_fdata(), data, rtol=1E-6)
+    assert nib.load(
+        str(tmp_path / "mask.nii.gz")
+    ).get_data_dtype() != np.float32
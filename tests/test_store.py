@@ -0,0 +1,96 @@
+from concurrent.futures import ProcessPoolExecutor
+
+import nibabel as nib
+import numpy as np
+
+from mrHARDI.base.io import load_text
+from mrHARDI.base.store import ChunkedStore, export_nifti, import_nifti
+
+
+def test_store_read(tmp_path):
+    data = np.random.default_rng(0).uniform(size=(20, 15, 10, 6))
+    store = ChunkedStore(str(tmp_path / "store"), n_threads=2)
+    store.write("data", data, chunks=(8, 8, 8, 4))
+
+    np.testing.assert_array_equal(store.read("data"), data)
+    np.testing.assert_array_equal(
+        store.read("data", (slice(3, 17, 2), 4, slice(None), -1)),
+        data[3:17:2, 4, :, -1]
+    )
+    np.testing.assert_array_equal(store.read_volume("data", 2), data[..., 2])
+
+    mask = data[..., 0] > 0.8
+    np.testing.assert_array_equal(store.read_masked("data", mask), data[mask])
+
+    reopened = ChunkedStore(str(tmp_path / "store"))
+    assert reopened.datasets == ["data"]
+    assert reopened.shape("data") == data.shape
+
+
+def test_store_shared_index(tmp_path):
+    # Stores opened on the same directory keep each other's datasets
+    first = ChunkedStore(str(tmp_path / "store"))
+    second = ChunkedStore(str(tmp_path / "store"))
+    first.write("a", np.zeros((4, 4, 4)))
+    second.write("b", np.ones((4, 4, 4)))
+    first.write("c", np.ones((2, 2, 2)))
+
+    assert sorted(ChunkedStore(str(tmp_path / "store")).datasets) == [
+        "a", "b", "c"
+    ]
+    np.testing.assert_array_equal(second.read("a"), np.zeros((4, 4, 4)))
+
+    second.delete("c")
+    first.delete("b")
+    assert ChunkedStore(str(tmp_path / "store")).datasets == ["a"]
+
+
+def write_dataset(directory, i):
+    ChunkedStore(directory).write(
+        "data{}".format(i), np.full((8, 8, 8, 2), i), chunks=(4, 4, 4, 1)
+    )
+
+
+def test_store_concurrent_writes(tmp_path):
+    directory = str(tmp_path / "store")
+    ChunkedStore(directory)
+    with ProcessPoolExecutor(4) as executor:
+        list(executor.map(write_dataset, [directory] * 16, range(16)))
+
+    store = ChunkedStore(directory)
+    assert sorted(store.datasets) == sorted(
+        "data{}".format(i) for i in range(16)
+    )
+    for i in range(16):
+        np.testing.assert_array_equal(
+            store.read("data{}".format(i)), np.full((8, 8, 8, 2), i)
+        )
+
+
+def test_nifti_round_trip(tmp_path):
+    data = np.random.default_rng(0).integers(0, 1000, (8, 9, 10, 4))
+    img = nib.Nifti1Image(data.astype(np.int16), np.diag([2., 2., 2., 1.]))
+    img.header.set_zooms((2., 2., 2., 3.5))
+    img.header.set_xyzt_units("mm", "sec")
+    img.header["descrip"] = b"round trip"
+    nib.save(img, str(tmp_path / "dwi.nii.gz"))
+    np.savetxt(str(tmp_path / "dwi.bval"), [[0, 1000, 2000, 995]], fmt="%d")
+    np.savetxt(str(tmp_path / "dwi.bvec"), np.eye(3, 4))
+
+    store = ChunkedStore(str(tmp_path / "store"))
+    import_nifti(store, "dwi", str(tmp_path / "dwi.nii.gz"))
+    export_nifti(store, "dwi", str(tmp_path / "out"))
+
+    out = nib.load(str(tmp_path / "out.nii.gz"))
+    np.testing.assert_array_equal(out.get_fdata(), data)
+    np.testing.assert_array_equal(out.affine, img.affine)
+    assert out.get_data_dtype() == np.int16
+    assert out.header.get_zooms() == (2., 2., 2., 3.5)
+    assert out.header.get_xyzt_units() == ("mm", "sec")
+    assert out.header["descrip"] == b"round trip"
+
+    with open(str(tmp_path / "out.bval")) as f:
+        assert f.read().split() == ["0", "1000", "2000", "995"]
+    np.testing.assert_array_equal(
+        load_text(str(tmp_path / "out.bvec")), np.eye(3, 4)
+    )
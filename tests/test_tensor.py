@@ -0,0 +1,198 @@
+from functools import partial
+
+import numpy as np
+import pytest
+
+from mrHARDI.compute.math.tensor import (analytic_eigh,
+                                         compute_eigenvalues,
+                                         compute_haeberlen,
+                                         vec_to_tens,
+                                         vec_to_tens_field)
+
+
+def random_tensors(n, seed=0, isotropic=0):
+    """
+    Diffusion tensors with eigenvalues in the range of brain tissues, as
+    6 components (xx, xy, yy, xz, yz, zz). The last isotropic ones have a
+    single eigenvalue.
+    """
+    rng = np.random.default_rng(seed)
+    evals = rng.uniform(1E-4, 3E-3, (n, 3))
+    evals[n - isotropic:] = evals[n - isotropic:, :1]
+
+    q, r = np.linalg.qr(rng.normal(size=(n, 3, 3)))
+    rotations = q * np.sign(np.diagonal(r, axis1=-2, axis2=-1))[:, None, :]
+    tensors = rotations @ (evals[..., None] * rotations.transpose(0, 2, 1))
+
+    return tensors[:, [0, 0, 1, 0, 1, 2], [0, 1, 1, 2, 2, 2]]
+
+
+def reference_eigenvalues(
+    tensors, mask, convention=(0, 1, 2, 3, 4, 5), reorder=True
+):
+    # Per-voxel implementation replaced by the vectorized eigensolver
+    vtt = partial(vec_to_tens, convention=convention)
+    evals, evecs = np.zeros(mask.shape + (3,)), np.zeros(mask.shape + (3, 3))
+    evals[mask], evecs[mask] = np.linalg.eigh(
+        np.apply_along_axis(vtt, 1, tensors[mask])
+    )
+
+    evals[evals < 0] = 0.
+
+    if reorder:
+        evals = np.flip(evals, -1)
+        evecs = np.moveaxis(np.flip(evecs, -1), -2, -1)
+
+    return evals, evecs
+
+
+def reference_haeberlen(tensors, mask):
+    # Full 3x3 implementation replaced by the closed-form decomposition
+    diso, daniso = np.zeros(mask.shape), np.zeros(mask.shape)
+    ddelta, deta = np.zeros(mask.shape), np.zeros(mask.shape)
+
+    tensors = np.apply_along_axis(
+        vec_to_tens, 1, tensors.reshape((-1, 6))
+    ).reshape(mask.shape + (3, 3))
+
+    diso[mask] = np.trace(tensors[mask], axis1=-2, axis2=-1) / 3.
+    daniso[mask] = np.trace(
+        (tensors - diso[..., None, None])[mask] @ np.diag([-1., -1., 0.5]),
+        axis1=-2, axis2=-1
+    ) / 3.
+
+    mask = mask & ~np.isclose(diso, 0.)
+    ddelta[mask] = daniso[mask] / diso[mask]
+
+    mask &= ~np.isclose(ddelta, 0.)
+    deta[mask] = np.trace(
+        (
+            (
+                tensors[mask] / diso[mask, None, None] - np.eye(3)
+            ) / ddelta[mask, None, None] - np.diag([-1, -1, 2])
+        )[..., :-1, :-1] @ np.diag([-1, 1]),
+        axis1=-2, axis2=-1
+    ) / 2.
+
+    return diso, daniso, ddelta, deta
+
+
+def assert_same_eigs(eigs, ref_eigs, mask, rtol=1E-7, atol=1E-12):
+    np.testing.assert_allclose(eigs[0], ref_eigs[0], rtol=rtol, atol=atol)
+
+    # Eigenvectors are defined up to their sign
+    dots = np.abs(np.sum(eigs[1][mask] * ref_eigs[1][mask], axis=-1))
+    np.testing.assert_allclose(dots, 1., atol=max(rtol, 1E-7) * 1E3)
+
+
+def field(n, seed=0, isotropic=0):
+    tensors = random_tensors(n, seed, isotropic).reshape((n // 100, 100, 6))
+    mask = np.random.default_rng(seed).uniform(size=tensors.shape[:-1]) > 0.2
+    return tensors, mask
+
+
+def test_vec_to_tens_field():
+    tensors = random_tensors(10)
+    convention = (0, 2, 5, 1, 3, 4)
+    np.testing.assert_array_equal(
+        vec_to_tens_field(tensors, convention),
+        np.array([vec_to_tens(t, convention) for t in tensors])
+    )
+
+
+@pytest.mark.parametrize("solver", ["eigh", "analytic"])
+def test_compute_eigenvalues(solver):
+    tensors, mask = field(2000)
+    ref_eigs = reference_eigenvalues(tensors, mask)
+
+    eigs = compute_eigenvalues(tensors, mask, solver=solver)
+    assert_same_eigs(
+        eigs, ref_eigs, mask, 1E-7 if solver == "eigh" else 1E-6
+    )
+    np.testing.assert_array_equal(eigs[0][~mask], 0.)
+
+
+def test_compute_eigenvalues_blocks():
+    tensors, mask = field(2000)
+    eigs = compute_eigenvalues(tensors, mask)
+    blocks = compute_eigenvalues(tensors, mask, block_size=37)
+
+    np.testing.assert_array_equal(blocks[0], eigs[0])
+    np.testing.assert_array_equal(blocks[1], eigs[1])
+
+
+def test_compute_eigenvalues_convention():
+    tensors, mask = field(1000)
+    convention = (0, 2, 5, 1, 3, 4)
+    shuffled = np.empty_like(tensors)
+    shuffled[..., convention] = tensors
+
+    assert_same_eigs(
+        compute_eigenvalues(shuffled, mask, convention),
+        reference_eigenvalues(shuffled, mask, convention), mask
+    )
+
+
+def test_analytic_eigh_degenerate():
+    tensors = vec_to_tens_field(random_tensors(1000, isotropic=100))
+    evals, evecs = analytic_eigh(tensors)
+    ref_evals, _ = np.linalg.eigh(tensors)
+
+    np.testing.assert_allclose(evals, ref_evals, rtol=1E-6, atol=1E-12)
+    np.testing.assert_allclose(
+        evecs @ (evals[..., None] * np.swapaxes(evecs, -2, -1)), tensors,
+        rtol=1E-6, atol=1E-12
+    )
+
+
+def test_compute_haeberlen():
+    tensors, mask = field(2000, isotropic=100)
+    tensors[:3] = 0.
+    mask_copy = mask.copy()
+
+    for values, ref_values in zip(
+        compute_haeberlen(tensors, mask), reference_haeberlen(tensors, mask)
+    ):
+        np.testing.assert_allclose(values, ref_values, rtol=1E-7, atol=1E-12)
+
+    np.testing.assert_array_equal(mask, mask_copy)
+
+
+def test_compute_haeberlen_stacked():
+    tensors, mask = field(2000)
+    stacked = compute_haeberlen(
+        np.stack([tensors, tensors[::-1]]), np.stack([mask, mask[::-1]])
+    )
+
+    for i, (t, m) in enumerate([(tensors, mask), (tensors[::-1], mask[::-1])]):
+        for values, ref_values in zip(stacked, compute_haeberlen(t, m)):
+            np.testing.assert_array_equal(values[i], ref_values)
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize("solver", ["eigh", "analytic"])
+def test_compute_eigenvalues_benchmark(compare_timings, solver):
+    tensors = random_tensors(1000000).reshape((100, 100, 100, 6))
+    mask = np.ones(tensors.shape[:-1], dtype=bool)
+
+    t_ref, t_opt = compare_timings(
+        "Eigen decomposition of 1M tensors ({})".format(solver),
+        lambda: reference_eigenvalues(tensors, mask),
+        lambda: compute_eigenvalues(tensors, mask, solver=solver),
+        repeats=1
+    )
+    assert t_opt < t_ref
+
+
+@pytest.mark.benchmark
+def test_compute_haeberlen_benchmark(compare_timings):
+    tensors = random_tensors(1000000).reshape((100, 100, 100, 6))
+    mask = np.random.default_rng(0).uniform(size=tensors.shape[:-1]) > 0.3
+
+    t_ref, t_opt = compare_timings(
+        "Haeberlen decomposition of 1M tensors",
+        lambda: reference_haeberlen(tensors, mask),
+        lambda: compute_haeberlen(tensors, mask),
+        repeats=1
+    )
+    assert t_opt < t_ref
@@ -0,0 +1,224 @@
+import nibabel as nib
+import numpy as np
+import pytest
+from scipy.spatial.transform import Rotation
+
+from mrHARDI.compute.image import merge_transforms
+from mrHARDI.compute.transforms import (AffineTransform,
+                                        DisplacementField,
+                                        EulerTransform,
+                                        LinearTransform,
+                                        TransformChain,
+                                        euler_matrices,
+                                        load,
+                                        load_transform,
+                                        save_transform,
+                                        write_displacement_field)
+
+
+LPS = np.diag([-1., -1., 1., 1.])
+
+
+def rx(a):
+    c, s = np.cos(a), np.sin(a)
+    return np.array([[1., 0., 0.], [0., c, -s], [0., s, c]])
+
+
+def ry(a):
+    c, s = np.cos(a), np.sin(a)
+    return np.array([[c, 0., s], [0., 1., 0.], [-s, 0., c]])
+
+
+def rz(a):
+    c, s = np.cos(a), np.sin(a)
+    return np.array([[c, -s, 0.], [s, c, 0.], [0., 0., 1.]])
+
+
+def random_affine(seed=0, rigid=False):
+    rng = np.random.default_rng(seed)
+    _m = np.eye(4)
+    _m[:3, :3] = Rotation.from_rotvec(rng.uniform(-0.3, 0.3, 3)).as_matrix()
+    if not rigid:
+        _m[:3, :3] = _m[:3, :3] @ np.diag(rng.uniform(0.9, 1.1, 3))
+    _m[:3, 3] = rng.uniform(-10., 10., 3)
+    return _m
+
+
+def write_itk_text(filename, transform_type, parameters, fixed):
+    with open(filename, "w") as f:
+        f.write("#Insight Transform File V1.0\n#Transform 0\n")
+        f.write("Transform: {}\n".format(transform_type))
+        f.write("Parameters: {}\n".format(" ".join(map(str, parameters))))
+        f.write("FixedParameters: {}\n".format(" ".join(map(str, fixed))))
+
+
+def apply(matrix, point):
+    return (matrix @ np.append(point, 1.))[:3]
+
+
+def test_euler_zxy_order():
+    ax, ay, az = 0.1, -0.2, 0.3
+    center, translation = np.array([1., 2., 3.]), np.array([4., 5., 6.])
+    params = [ax, ay, az, *translation]
+
+    # Euler3DTransform applies the Y, then X, then Z rotations by default
+    _m = euler_matrices(params, center)[0]
+    np.testing.assert_allclose(_m[:3, :3], rz(az) @ rx(ax) @ ry(ay))
+    np.testing.assert_allclose(
+        apply(_m, center + 1.), _m[:3, :3] @ np.ones(3) + translation + center
+    )
+
+    _m = euler_matrices(params, center, compute_zyx=True)[0]
+    np.testing.assert_allclose(_m[:3, :3], rz(az) @ ry(ay) @ rx(ax))
+
+    transform = EulerTransform.from_parameters(params, center)
+    np.testing.assert_allclose(transform.parameters(center), params)
+
+
+def test_itk_text_conventions(tmp_path):
+    # Fixed points x map to A (x - c) + t + c in the moving space
+    quarter = rz(np.pi / 2.)
+    write_itk_text(
+        str(tmp_path / "affine.txt"), "AffineTransform_double_3_3",
+        [*quarter.flatten(), 1., 2., 3.], [10., 0., 0.]
+    )
+    write_itk_text(
+        str(tmp_path / "euler.txt"), "Euler3DTransform_double_3_3",
+        [0., 0., np.pi / 2., 1., 2., 3.], [10., 0., 0., 0.]
+    )
+
+    for name in ["affine.txt", "euler.txt"]:
+        transform = load(str(tmp_path / name))
+        np.testing.assert_allclose(
+            apply(transform.matrix, [10., 1., 0.]), [10., 2., 3.], atol=1E-12
+        )
+        np.testing.assert_allclose(
+            apply(load(str(tmp_path / name), True).matrix, [10., 2., 3.]),
+            [10., 1., 0.], atol=1E-12
+        )
+
+
+def test_fixed_moving_inversion():
+    _m = random_affine()
+    transform = LinearTransform(_m)
+
+    np.testing.assert_allclose(transform.inverted().matrix, np.linalg.inv(_m))
+    np.testing.assert_allclose(transform.inverted().inverted().matrix, _m)
+
+    # World matrices map moving to fixed points, in the requested frame
+    np.testing.assert_allclose(
+        transform.world_matrix(), np.linalg.inv(LPS @ _m @ LPS)
+    )
+    np.testing.assert_allclose(transform.world_matrix(
+        nib.orientations.axcodes2ornt(("L", "P", "S"))
+    ), np.linalg.inv(_m))
+    np.testing.assert_allclose(
+        LinearTransform.from_world(transform.world_matrix()).matrix, _m
+    )
+
+
+def test_chain_composition():
+    a, b, c = (random_affine(seed) for seed in range(3))
+    chain = TransformChain([
+        LinearTransform(a), LinearTransform(b).inverted(), LinearTransform(c)
+    ])
+
+    # The last transform is the first applied to fixed points
+    np.testing.assert_allclose(chain.matrix, a @ np.linalg.inv(b) @ c)
+
+    field = DisplacementField("warp.nii.gz")
+    chain = TransformChain([
+        LinearTransform(a), LinearTransform(b), field, LinearTransform(c)
+    ])
+    assert not chain.linear
+    with pytest.raises(ValueError):
+        chain.matrix
+
+    collapsed = chain.collapse().transforms
+    assert len(collapsed) == 3 and collapsed[1] is field
+    np.testing.assert_allclose(collapsed[0].matrix, a @ b)
+    np.testing.assert_allclose(collapsed[2].matrix, c)
+
+
+@pytest.mark.parametrize("out_type,rigid", [
+    ("AffineTransform_double_3_3", False),
+    ("Euler3DTransform_double_3_3", True)
+])
+def test_save_load_round_trip(tmp_path, out_type, rigid):
+    _m = random_affine(1, rigid)
+    center = np.array([5., -3., 12.])
+    out_name = str(tmp_path / "transform.mat")
+
+    save_transform(_m, out_type, out_name, center)
+    np.testing.assert_allclose(load_transform(out_name), _m, atol=1E-10)
+
+    # Matrices are returned in the frame of the requested orientation
+    flip = np.diag([-1., 1., 1., 1.])
+    np.testing.assert_allclose(load_transform(
+        out_name, nib.orientations.axcodes2ornt(("L", "A", "S"))
+    ), flip @ _m @ flip, atol=1E-10)
+
+
+def test_save_load_translation(tmp_path):
+    _m = np.eye(4)
+    _m[:3, 3] = [1., -2., 3.]
+    out_name = str(tmp_path / "transform.mat")
+
+    save_transform(_m, "MatrixOffsetTransformBase_double_3_3", out_name)
+    np.testing.assert_allclose(load_transform(out_name), _m, atol=1E-12)
+    assert isinstance(load(out_name), AffineTransform)
+
+
+def test_load_transform_non_linear(tmp_path):
+    nib.save(
+        nib.Nifti1Image(np.zeros((2, 2, 2, 1, 3), np.float32), np.eye(4)),
+        str(tmp_path / "warp.nii.gz")
+    )
+    with pytest.raises(ValueError):
+        load_transform(str(tmp_path / "warp.nii.gz"))
+
+
+def test_write_displacement_field(tmp_path):
+    affine = np.array([
+        [-2., 0., 0., 30.],
+        [0., 0., 2., -20.],
+        [0., 2., 0., -10.],
+        [0., 0., 0., 1.]
+    ])
+    nib.save(
+        nib.Nifti1Image(np.zeros((6, 7, 8), dtype=np.uint8), affine),
+        str(tmp_path / "ref.nii.gz")
+    )
+
+    a, b = random_affine(0), random_affine(1)
+    chain = TransformChain([LinearTransform(a), LinearTransform(b)])
+    write_displacement_field(
+        chain, str(tmp_path / "ref.nii.gz"), str(tmp_path / "field.nii.gz")
+    )
+
+    field = nib.load(str(tmp_path / "field.nii.gz"))
+    assert field.shape == (6, 7, 8, 1, 3)
+    np.testing.assert_array_equal(field.affine, affine)
+
+    data = field.get_fdata()
+    for ijk in [(0, 0, 0), (5, 6, 7), (2, 4, 1)]:
+        point = (LPS @ affine @ np.append(ijk, 1.))[:3]
+        np.testing.assert_allclose(
+            data[ijk][0], apply(a @ b, point) - point, rtol=1E-5, atol=1E-3
+        )
+
+
+def test_merge_transforms(tmp_path):
+    a, b = random_affine(0), random_affine(1)
+    LinearTransform(a).save(str(tmp_path / "a.mat"))
+    LinearTransform(b).save(str(tmp_path / "b.mat"), [1., 2., 3.])
+
+    # Transforms are given in the order they are applied
+    merge_transforms(
+        str(tmp_path / "ab.mat"), str(tmp_path / "log.txt"),
+        str(tmp_path / "a.mat"), str(tmp_path / "b.mat")
+    )
+    np.testing.assert_allclose(load(str(tmp_path / "ab.mat")).matrix, b @ a)
+
+    with pytest.raises(ValueError):
+        merge_transforms(str(tmp_path / "out.mat"), str(tmp_path / "log.txt"))
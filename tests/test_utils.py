@@ -0,0 +1,92 @@
+from threading import Lock
+from time import sleep
+
+import numpy as np
+import pytest
+
+from mrHARDI.base.utils import search_ranked
+
+
+def sectors(n, seed=0):
+    # Initial similarities of the sectors, and the one reached by a search
+    rng = np.random.default_rng(seed)
+    initial = rng.uniform(-0.5, -0.3, n)
+    final = initial + rng.uniform(0., 0.1, n)
+    return [(i, k) for k, i in enumerate(initial)], final
+
+
+class CountingSearch:
+    def __init__(self, final, duration=0.):
+        self.final = final
+        self.duration = duration
+        self.searched = []
+        self._lock = Lock()
+
+    def __call__(self, k):
+        sleep(self.duration)
+        with self._lock:
+            self.searched.append(k)
+
+        return self.final[k], k
+
+
+@pytest.mark.parametrize("n_workers", [1, 2, 8])
+def test_search_ranked_all(n_workers):
+    candidates, final = sectors(27)
+    search = CountingSearch(final)
+
+    score, k = search_ranked(candidates, search, n_workers, 0.)
+    assert sorted(search.searched) == list(range(27))
+    assert k == np.argmax(final) and score == final.max()
+
+
+@pytest.mark.parametrize("n_workers", [1, 2])
+def test_search_ranked_early_stop(n_workers):
+    candidates, final = sectors(27)
+    search = CountingSearch(final, 0.01)
+
+    score, k = search_ranked(candidates, search, n_workers, 0.25)
+
+    assert len(search.searched) < 27
+    assert score == final[search.searched].max() and k in search.searched
+
+    # Candidates are searched in ranked order, skipping the worst ones
+    ranks = np.argsort([-i for i, _ in candidates])
+    assert sorted(search.searched) == sorted(ranks[:len(search.searched)])
+
+
+@pytest.mark.parametrize("gain", [0., 0.05, 0.4])
+def test_search_ranked_early_stop_gain(gain):
+    candidates, _ = sectors(27)
+    initial = np.array([i for i, _ in candidates])
+    search = CountingSearch(initial + gain)
+
+    # Initial scores are raised by the gain of the searches before being
+    # compared to the best score
+    score, _ = search_ranked(candidates, search, 1, 0.25)
+    assert score == (initial + gain).max()
+    assert sorted(search.searched) == sorted(np.flatnonzero(
+        initial + gain >= score - 0.25 * abs(score)
+    ))
+
+
+def test_search_ranked_workers_bound():
+    candidates, final = sectors(27)
+    search = CountingSearch(final, 0.01)
+    running, peak, lock = [0], [0], Lock()
+
+    def _search(k):
+        with lock:
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+        result = search(k)
+        with lock:
+            running[0] -= 1
+        return result
+
+    search_ranked(candidates, _search, 3, 0.)
+    assert peak[0] <= 3
+
+
+def test_search_ranked_empty():
+    assert search_ranked([], lambda k: (0., k)) == (None, None)